@@ -0,0 +1,184 @@
+# coding=utf-8
+"""find ad segments from the media playlist alone, before downloading.
+
+Only segments the playlist clearly marks are reported:
+
+- segments inside an SCTE-35 ad break, signalled by #EXT-X-CUE-OUT /
+  #EXT-X-CUE-IN or an #EXT-X-DATERANGE with SCTE35-OUT.
+- short discontinuity groups served from another host or directory than the
+  main content, when the main content makes up most of the playlist.
+- only when asked for (durations=True): discontinuity groups lasting a
+  standard ad length, AD_DURATIONS, give or take AD_DURATION_TOLERANCE.
+  It is off by default because a chapter or recap of the main content can
+  last 30s too, and wouldn't even be downloaded.
+
+Anything less certain is left to CutInsertTs, which checks the downloaded
+fragments.
+
+"""
+
+import copy
+import posixpath
+import re
+from urllib.parse import urlparse
+
+from aiom3u8downloader.playlist import parse_attributes
+
+# a group longer than this is never assumed to be an ad by its url alone.
+MAX_AD_GROUP_DURATION = 120.0
+# the main content prefix must cover this share of the playlist duration.
+MIN_MAIN_SHARE = 0.8
+# standard ad spot lengths in seconds.
+AD_DURATIONS = (15.0, 30.0, 60.0)
+AD_DURATION_TOLERANCE = 0.5
+
+REASON_CUE = 'cue'
+REASON_PREFIX = 'prefix'
+REASON_DURATION = 'duration'
+REASON_FINGERPRINT = 'fingerprint'
+
+CUE_DURATION_PATTERN = re.compile(r'(?:DURATION=)?([0-9.]+)')
+
+
+def url_prefix(url):
+    """return scheme, host and directory of url."""
+    parsed = urlparse(url)
+    return '%s://%s%s' % (parsed.scheme, parsed.netloc, posixpath.dirname(parsed.path))
+
+
+def cue_out_duration(tag):
+    """return planned break duration of a cue-out tag, 0 if unknown, None if
+    tag doesn't start an ad break."""
+    name, _, value = tag.partition(':')
+    if name == '#EXT-X-CUE-OUT':
+        mo = CUE_DURATION_PATTERN.search(value)
+        return float(mo.group(1)) if mo else 0.0
+    if name == '#EXT-X-DATERANGE':
+        attrs = parse_attributes(value)
+        if 'SCTE35-OUT' not in attrs:
+            return None
+        for attr in ('DURATION', 'PLANNED-DURATION'):
+            if attr in attrs:
+                return float(attrs[attr])
+        return 0.0
+    return None
+
+
+def is_cue_in(tag):
+    name, _, value = tag.partition(':')
+    if name == '#EXT-X-CUE-IN':
+        return True
+    return name == '#EXT-X-DATERANGE' and 'SCTE35-IN' in value
+
+
+def cue_ad_segments(playlist):
+    """return seqs of segments inside SCTE-35 ad breaks.
+
+    A break ends after its duration or at the cue-in. A break without a
+    duration is only cut once a cue-in closes it, an open-ended one is left
+    to CutInsertTs.
+    """
+    ads = set()
+    remaining = None
+    # seqs of a break without duration, waiting for its cue-in.
+    pending = None
+    for segment in playlist.segments:
+        for tag in segment.tags:
+            if is_cue_in(tag):
+                if pending:
+                    ads.update(pending)
+                remaining = pending = None
+            duration = cue_out_duration(tag)
+            if duration is not None:
+                remaining = duration or None
+                pending = None if duration else []
+        if pending is not None:
+            pending.append(segment.seq)
+            continue
+        if remaining is None:
+            continue
+        ads.add(segment.seq)
+        remaining -= segment.duration
+        if remaining <= 0.01:
+            remaining = None
+    return ads
+
+
+def prefix_ad_segments(playlist):
+    """return seqs of short groups served from a foreign url prefix."""
+    groups = [x for x in playlist.discontinuity_groups() if x]
+    if len(groups) < 2:
+        return set()
+    prefix_duration = {}
+    for segment in playlist.segments:
+        prefix = url_prefix(segment.url)
+        prefix_duration[prefix] = prefix_duration.get(prefix, 0) + segment.duration
+    total = sum(prefix_duration.values())
+    main_prefix, main_duration = max(prefix_duration.items(), key=lambda x: x[1])
+    if not total or main_duration / total < MIN_MAIN_SHARE:
+        return set()
+
+    ads = set()
+    for group in groups:
+        if sum(x.duration for x in group) > MAX_AD_GROUP_DURATION:
+            continue
+        if any(url_prefix(x.url) == main_prefix for x in group):
+            continue
+        ads.update(x.seq for x in group)
+    return ads
+
+
+def duration_ad_segments(playlist):
+    """return seqs of discontinuity groups lasting a standard ad length.
+
+    Nothing is returned unless the other groups make up most of the playlist.
+    """
+    groups = [x for x in playlist.discontinuity_groups() if x]
+    if len(groups) < 2:
+        return set()
+    total = sum(x.duration for x in playlist.segments)
+    ads = set()
+    ad_duration = 0
+    for group in groups:
+        duration = sum(x.duration for x in group)
+        if any(abs(duration - x) <= AD_DURATION_TOLERANCE for x in AD_DURATIONS):
+            ads.update(x.seq for x in group)
+            ad_duration += duration
+    if not total or (total - ad_duration) / total < MIN_MAIN_SHARE:
+        return set()
+    return ads
+
+
+def find_ad_segments(playlist, durations=False):
+    """return {seq: reason} of segments that are ads for sure.
+
+    Args:
+        durations: also report groups lasting a standard ad length.
+
+    """
+    ads = {}
+    if durations:
+        ads.update(dict.fromkeys(duration_ad_segments(playlist), REASON_DURATION))
+    ads.update(dict.fromkeys(prefix_ad_segments(playlist), REASON_PREFIX))
+    ads.update(dict.fromkeys(cue_ad_segments(playlist), REASON_CUE))
+    return ads
+
+
+def without_segments(playlist, seqs):
+    """return a copy of playlist without the segments in seqs.
+
+    The segment following a removed run starts a discontinuity.
+    """
+    result = copy.copy(playlist)
+    segments = []
+    removed = False
+    for segment in playlist.segments:
+        if segment.seq in seqs:
+            removed = True
+            continue
+        if removed and segments:
+            segment.discontinuity = True
+        removed = False
+        segments.append(segment)
+    result.segments = segments
+    return result
@@ -0,0 +1,139 @@
+# coding=utf-8
+"""ad fingerprints shared by the jobs of a batch.
+
+The same inserted ads show up in many playlists of a site. AdIndex counts in
+how many unrelated jobs every fragment checksum was seen; a discontinuity
+group made of fragments that recur in min_jobs unrelated jobs is an ad.
+Episodes of one series share intros and recaps, which would look like ads,
+so jobs whose urls have the same host and first series_depth directories
+count as one. A site serving every video from the same directories needs a
+larger series_depth, or no video counts as unrelated. Urls
+and checksums of such groups are remembered, so later jobs skip the urls
+before downloading and cut the checksums without probing. With a path the
+index is saved as json when the downloader closes and reused by the next
+batch.
+
+Only fragments of ad candidates, short groups that are not the main
+content, are counted. Every table keeps the max_entries most recently
+added entries, so a long-lived index doesn't grow without bound.
+
+"""
+
+import itertools
+import json
+import logging
+import os
+import posixpath
+from urllib.parse import urlparse
+
+# share of a group's fragments that must be known ads.
+AD_GROUP_SHARE = 0.5
+MAX_ENTRIES = 100000
+
+
+def trim(table, max_entries):
+    """drop the oldest entries of dict table beyond max_entries."""
+    for key in list(itertools.islice(table, max(0, len(table) - max_entries))):
+        del table[key]
+
+
+def series_key(url, depth):
+    """return host and the first depth directories of the path of url."""
+    parsed = urlparse(url)
+    dirs = [x for x in posixpath.dirname(parsed.path).split('/') if x]
+    return '/'.join([parsed.netloc] + dirs[:depth])
+
+
+class AdIndex:
+    """
+    Args:
+        path: json file to load and save the index, None to keep it in
+              memory only.
+        min_jobs: unrelated jobs a fragment must appear in to count as ad.
+        series_depth: leading url directories naming a series, jobs of the
+                      same series are related.
+        max_entries: entries kept in each table, the oldest are dropped.
+
+    An unreadable index file is logged and the index starts empty, it is
+    replaced on save.
+
+    """
+
+    def __init__(
+        self,
+        path=None,
+        min_jobs=3,
+        series_depth=1,
+        max_entries=MAX_ENTRIES,
+        logger: logging.Logger = logging.getLogger(),
+    ):
+        self.path = path
+        self.min_jobs = max(2, min_jobs)
+        self.series_depth = series_depth
+        self.max_entries = max_entries
+        self.logger = logger
+        # checksum -> series it was seen in, at most min_jobs of them.
+        self.seen = {}
+        # ordered like seen, dicts with None values.
+        self.ad_checksums = {}
+        self.ad_urls = {}
+        self.changed = False
+        if path and os.path.exists(path):
+            try:
+                self.load(path)
+            except (OSError, ValueError) as e:
+                self.logger.warning('ignoring unreadable ad index %s: %s', path, e)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError('expected a json object')
+        self.seen = {k: set(v) for k, v in data.get('seen', {}).items()}
+        self.ad_checksums = dict.fromkeys(data.get('ad_checksums', []))
+        self.ad_urls = dict.fromkeys(data.get('ad_urls', []))
+
+    def add_job(self, job_url, checksums):
+        """count checksums of the ad candidates of a job."""
+        series = series_key(job_url, self.series_depth)
+        for checksum in checksums:
+            # moved to the end, recently seen fragments are dropped last.
+            jobs = self.seen.pop(checksum, set())
+            if len(jobs) < self.min_jobs:
+                jobs.add(series)
+            self.seen[checksum] = jobs
+            self.changed = True
+        trim(self.seen, self.max_entries)
+
+    def is_ad(self, checksum):
+        if checksum in self.ad_checksums:
+            return True
+        return len(self.seen.get(checksum, ())) >= self.min_jobs
+
+    def is_ad_group(self, checksums):
+        if not checksums:
+            return False
+        known = sum(1 for x in checksums if self.is_ad(x))
+        return known / len(checksums) >= AD_GROUP_SHARE
+
+    def mark_ads(self, urls, checksums):
+        self.ad_urls.update(dict.fromkeys(urls))
+        self.ad_checksums.update(dict.fromkeys(checksums))
+        trim(self.ad_urls, self.max_entries)
+        trim(self.ad_checksums, self.max_entries)
+        self.changed = True
+
+    def save(self):
+        """write the index to path if it changed since it was loaded."""
+        if not self.path or not self.changed:
+            return
+        data = {
+            'seen': {k: sorted(v) for k, v in self.seen.items()},
+            'ad_checksums': list(self.ad_checksums),
+            'ad_urls': list(self.ad_urls),
+        }
+        part_file = self.path + '.part'
+        with open(part_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(part_file, self.path)
+        self.changed = False
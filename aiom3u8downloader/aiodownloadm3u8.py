@@ -13,15 +13,19 @@ from __future__ import print_function, unicode_literals
 
 import argparse
 import asyncio
+import functools
+import hashlib
+import inspect
 import logging
 import os
 import os.path
 import re
 import shutil
 import signal
-import subprocess
 import sys
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dat
 from pathlib import Path
 from tempfile import gettempdir
@@ -30,9 +34,70 @@ from urllib.parse import urljoin, urlparse
 import aiohttp
 
 import aiom3u8downloader
+from aiom3u8downloader.adfilter import (
+    MAX_AD_GROUP_DURATION,
+    REASON_FINGERPRINT,
+    find_ad_segments,
+    without_segments,
+)
+from aiom3u8downloader.adindex import AdIndex
+from aiom3u8downloader.concat import concat_parts
 from aiom3u8downloader.cut_insert_ts import CutInsertTs
+from aiom3u8downloader.decrypt import (
+    decrypt_file,
+    decrypted_path,
+    load_key,
+    segment_iv,
+    unsupported_reason,
+)
+from aiom3u8downloader.journal import DownloadJournal, has_journaled_size
+from aiom3u8downloader.live import LiveRecording, is_live_playlist
+from aiom3u8downloader.metrics import (
+    BYTES,
+    ERRORS,
+    FRAGMENT_SECONDS,
+    FRAGMENTS,
+    RESULT_FAILED,
+    RESULT_OK,
+    RETRIES,
+    TTFB_SECONDS,
+    Metrics,
+    MetricsExporter,
+    url_label,
+)
+from aiom3u8downloader.pipemux import PipedMuxer
+from aiom3u8downloader.playlist import (
+    KEY_URI_PATTERN,
+    ByteRangeRequest,
+    coalesce_byte_ranges,
+    parse_playlist,
+    render_media_playlist,
+)
+from aiom3u8downloader.retry import (
+    RetryPolicy,
+    failure_cause,
+    response_retry_after,
+    response_status,
+)
+from aiom3u8downloader.scheduler import (
+    THROTTLE_STATUSES,
+    FairShareLimiter,
+    LatencyTracker,
+    RateWatchdog,
+    get_host,
+)
+from aiom3u8downloader.trace import NULL_TRACER, Tracer
 
 IMG_SUFFIX_LIST = ['.png', '.jpg', '.jpeg', '.bmp']
+# size of the fake image header in front of image-disguised ts fragments.
+IMG_HEADER_SIZE = 212
+# read size when streaming a response body to disk.
+CHUNK_SIZE = 64 * 1024
+# suffix of files that are still being downloaded.
+PART_SUFFIX = '.part'
+# suffix of the .part file written by a hedged duplicate request.
+HEDGE_PART_SUFFIX = '.hedge.part'
+CONTENT_RANGE_PATTERN = re.compile(r'bytes\s+(\d+)-\d+/(?:\d+|\*)')
 
 
 def get_local_file_for_url(tempdir, url, path_line=None):
@@ -56,6 +121,18 @@ def get_local_file_for_url(tempdir, url, path_line=None):
     return os.path.normpath(os.path.join(tempdir, repath))
 
 
+def get_fragment_file(job, url, path_line=None):
+    """get local file path of a fragment of job, see get_local_file_for_url.
+
+    Fragments decrypted in-process are stored under their own name.
+
+    """
+    local_file = get_local_file_for_url(job.subtempdir, url, path_line)
+    if url in job.ciphers:
+        return decrypted_path(local_file)
+    return local_file
+
+
 def is_higher_resolution(new_resolution, old_resolution):
     """return True if new_resolution is higher than old_resolution.
 
@@ -69,6 +146,12 @@ def is_higher_resolution(new_resolution, old_resolution):
     return int(new_resolution.split('x')[0]) > int(old_resolution.split('x')[0])
 
 
+def content_range_start(value):
+    """return the first byte of a Content-Range header value, or None."""
+    mo = CONTENT_RANGE_PATTERN.match((value or '').strip())
+    return int(mo.group(1)) if mo else None
+
+
 def filesize_mib(filename):
     s = os.stat(filename)
     return s.st_size / 1024 / 1024.0
@@ -106,6 +189,8 @@ def keep_ts_suffix(path: str):
 def rewrite_key_uri(tempdir, m3u8_url, key_line):
     """rewrite key URI in given '#EXT-X-KEY:' line.
 
+    '#EXT-X-MAP:' lines are rewritten the same way.
+
     Args:
         tempdir: temp download dir.
         m3u8_url: playlist url.
@@ -115,8 +200,7 @@ def rewrite_key_uri(tempdir, m3u8_url, key_line):
         a new line with URI rewritten to local path.
 
     """
-    pattern = re.compile(r'^(.*URI=")([^"]+)(".*)$')
-    mo = pattern.match(key_line)
+    mo = KEY_URI_PATTERN.match(key_line)
     if not mo:
         raise RuntimeError("key line doesn't have URI")
     prefix = mo.group(1)
@@ -139,6 +223,37 @@ def rewrite_key_uri(tempdir, m3u8_url, key_line):
     return keep_ts_suffix(prefix + local_key_file + suffix)
 
 
+def ffmpeg_mux_command(media_path, target_mp4):
+    """return ffmpeg command muxing a local media playlist into target_mp4."""
+    return [
+        'ffmpeg',
+        '-nostdin',
+        '-loglevel',
+        'info',
+        '-fflags',
+        '+genpts',
+        '-allowed_extensions',
+        'ALL',
+        '-i',
+        str(media_path),
+        '-acodec',
+        'copy',
+        '-vcodec',
+        'copy',
+        '-bsf:a',
+        'aac_adtstoasc',
+        target_mp4,
+    ]
+
+
+def file_md5(filename):
+    hasher = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 def windows_safe_filename_without_path(name):
     # see
     # https://docs.microsoft.com/en-us/windows/desktop/fileio/naming-a-file
@@ -202,22 +317,248 @@ def write_file(file_path, content):
         f.write(content)
 
 
+class DownloadJob:
+    """state of a single m3u8 url download.
+
+    every url in a batch owns one job, so several jobs can run at the same
+    time without stepping on each other.
+
+    """
+
+    def __init__(self, url, subtempdir):
+        self.url = url
+        # job label of metrics.
+        self.label = url_label(url)
+        self.subtempdir = subtempdir
+        self.media_playlist_local_file = None
+        self.total_fragments = 0
+        self.fragments = OrderedDict()
+        self.journal = None
+        self.playlist = None
+        self.target_mp4 = None
+        # size of target_mp4 once written, its directory may be tempdir.
+        self.output_size = None
+        self.muxer = None
+        self.byte_ranges = []
+        # in-process decryption: url -> (key, iv) of encrypted fragments.
+        self.decrypt = False
+        self.ciphers = {}
+        self.key_bytes = {}
+        # md5 of downloaded fragments, None where unknown.
+        self.checksums = {}
+        self.latency = LatencyTracker()
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.output_filename = None
+        # urls of fragments that failed after all retries.
+        self.failed_fragments = []
+        # segments left out of a concatenated output, see fragment_parts.
+        self.skipped_fragments = 0
+        # called with a DownloadProgress after every fragment.
+        self.progress = None
+        # metrics.JobProgress, set when the download starts.
+        self.stats = None
+        self.bytes_received = 0
+
+    def __repr__(self):
+        return f'<DownloadJob {self.url}>'
+
+
+class DownloadProgress:
+    """progress of a running download, passed to progress callbacks.
+
+    Args:
+        url: the m3u8 url.
+        fragments_done: fragments on disk, including ones from earlier runs.
+        fragments_total: fragments known so far, grows while recording live
+                         playlists.
+        bytes_received: response bytes received by this run.
+        elapsed: seconds since the download started.
+        eta: estimated seconds left, None until it can be estimated.
+
+    """
+
+    def __init__(
+        self, url, fragments_done, fragments_total, bytes_received, elapsed, eta
+    ):
+        self.url = url
+        self.fragments_done = fragments_done
+        self.fragments_total = fragments_total
+        self.bytes_received = bytes_received
+        self.elapsed = elapsed
+        self.eta = eta
+
+    def __repr__(self):
+        return (
+            f'<DownloadProgress {self.fragments_done}/{self.fragments_total} '
+            f'{self.url}>'
+        )
+
+
+class DownloadResult:
+    """outcome of AioM3u8Downloader.download().
+
+    Args:
+        url: the m3u8 url.
+
+    Attributes:
+        success: True if the output file was written.
+        output: path of the output file, None on failure.
+        output_size: size of the output file in bytes.
+        bytes_received: response bytes received by this run.
+        fragments: fragments of the playlist.
+        failed_fragments: urls of fragments that failed after all retries.
+        skipped_fragments: segments missing from the output because they
+                           failed, at most 5% of them are tolerated.
+        started: wall clock time the download started.
+        elapsed: seconds the download took.
+        error: message of the exception that stopped the download, if any.
+
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.success = False
+        self.output = None
+        self.output_size = 0
+        self.bytes_received = 0
+        self.fragments = 0
+        self.failed_fragments = []
+        self.skipped_fragments = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.error = None
+
+    def __bool__(self):
+        return self.success
+
+    def __repr__(self):
+        state = 'ok' if self.success else 'failed'
+        return f'<DownloadResult {state} {self.url}>'
+
+
 class AioM3u8Downloader:
+    """download m3u8 urls and mux them into mp4 files.
+
+    start() downloads urls given to the constructor in its own event loop.
+    Inside a running loop use the async API instead::
+
+        async with AioM3u8Downloader(session=session) as downloader:
+            result = await downloader.download(url, 'foo.mp4', progress=print)
+
+    download() may be awaited concurrently, at most max_jobs run at a time
+    and all of them share the limit_conn budget. Cancelling the awaiting
+    task stops the download, downloaded fragments are kept in tempdir and
+    reused by the next download of the same url.
+
+    An external aiohttp ClientSession is used as is, with its own timeouts
+    and connection pool, and is not closed.
+    """
+
     def __init__(
         self,
-        urls,
-        output_filename,
+        urls=(),
+        output_filename=None,
         tempdir='.',
         limit_conn=100,
         auto_rename=False,
         cut_ads=False,
+        ad_durations=False,
+        max_jobs=1,
+        pipe_mux=False,
+        pipe_window=256,
+        live=False,
+        live_max_time=None,
+        live_max_size=None,
+        adaptive_conn=False,
+        hedge=False,
+        hedge_factor=2.0,
+        connect_timeout=10,
+        first_byte_timeout=30,
+        total_timeout=600,
+        min_rate=0,
+        min_rate_window=20,
+        retry_policy=None,
+        range_merge_size=8 * 1024 * 1024,
+        output_ts=False,
+        decrypt=False,
+        ad_index=None,
+        ad_min_jobs=3,
+        ad_series_depth=1,
+        metrics_port=None,
+        metrics_host='127.0.0.1',
+        metrics_file=None,
+        metrics_interval=5.0,
+        trace=None,
+        session=None,
         logger: logging.Logger = logging.getLogger(),
     ):
         # self.start_url = urls
-        self.urls = urls
+        self.urls = list(urls)
         self.logger = logger
+        self.tempdir = tempdir
+
+        self.output_filename = None
+        if output_filename:
+            self.output_filename = self.safe_output_path(output_filename)
+
+        self.url_subtempdir = {}
+        for url in self.urls:
+            self.get_subtempdir(url)
+        # jobs between new_job and the end of download(), see _start_async.
+        self.active_jobs = set()
+        # subtempdir -> lock, jobs of the same url run one after another.
+        self.subtempdir_locks = {}
 
-        # make sure output_filename is a safe filename on platform.
+        self.limit_conn = limit_conn
+        self.max_jobs = max(1, max_jobs)
+        self.auto_rename = True if len(urls) > 1 else auto_rename
+        self.cut_ads = cut_ads
+        self.ad_durations = ad_durations
+        self.pipe_mux = pipe_mux
+        self.pipe_window = pipe_window
+        self.live = live
+        self.live_max_time = live_max_time
+        self.live_max_size = live_max_size
+        self.limiter = FairShareLimiter(limit_conn, adaptive=adaptive_conn)
+        self.reserved_paths = set()
+        self.hedge = hedge
+        self.hedge_factor = hedge_factor
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.total_timeout = total_timeout
+        self.min_rate = min_rate
+        self.min_rate_window = min_rate_window
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.range_merge_size = range_merge_size
+        self.output_ts = output_ts
+        self.decrypt = decrypt
+        self._decrypt_pool = None
+        self.ad_index = AdIndex(
+            ad_index,
+            min_jobs=ad_min_jobs,
+            series_depth=ad_series_depth,
+            logger=logger,
+        )
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # spans of phases and requests, NULL_TRACER records nothing.
+        self.tracer = Tracer(trace) if trace else NULL_TRACER
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.session = None
+        self.hedge_session = None
+        self.external_session = session
+        self._users = 0
+        self._open_lock = None
+        self._job_slots = None
+        self._exporter = None
+
+    def safe_output_path(self, output_filename):
+        """return output_filename made a safe filename on the platform."""
         # mainly for windows.
         safe_output_filename = os.path.join(
             os.path.dirname(output_filename),
@@ -226,35 +567,32 @@ class AioM3u8Downloader:
 
         if safe_output_filename != output_filename:
             output_filename = safe_output_filename
-            logger.warning('using modified output_filename=%s', output_filename)
+            self.logger.warning('using modified output_filename=%s', output_filename)
         else:
-            logger.debug('output_filename=%s', output_filename)
-        self.output_filename = get_fullpath(output_filename)
+            self.logger.debug('output_filename=%s', output_filename)
+        return get_fullpath(output_filename)
 
-        self.url_subtempdir = {}
-        for url in urls:
-            _subtempdir = self.getTempdirFullpath(tempdir, url, output_filename)
-            self._make_subtempdir(_subtempdir)
-            self.url_subtempdir[url] = _subtempdir
+    def get_subtempdir(self, url):
+        """return the temp dir of url, create it if needed.
 
-        self.subtempdir = None
-        self.media_playlist_local_file = None
-        self.limit_conn = limit_conn
-        self.auto_rename = True if len(urls) > 1 else auto_rename
-        self.total_fragments = 0
-        self.cut_ads = cut_ads
-        self.fragments = OrderedDict()
-        self.session = None
+        The dir is removed after a successful job, so it is created again
+        for the next job of the same url.
+        """
+        if url not in self.url_subtempdir:
+            self.url_subtempdir[url] = self.getTempdirFullpath(self.tempdir, url, None)
+        _subtempdir = self.url_subtempdir[url]
+        self._make_subtempdir(_subtempdir)
+        return _subtempdir
 
     @staticmethod
     def getTempdirFullpath(tempdir, url, output_filename):
         urlParts = Path(url).parts
-        return get_fullpath(
-            os.path.join(
-                tempdir,
-                '_'.join(re.sub(r'\W+', '_', p) for p in [urlParts[1], *urlParts[-3:-1]] if p)
-            )
+        name = '_'.join(
+            re.sub(r'\W+', '_', p) for p in [urlParts[1], *urlParts[-3:-1]] if p
         )
+        # urls differing only in query or file name must not share a dir.
+        digest = hashlib.md5(url.encode('utf-8')).hexdigest()[:12]
+        return get_fullpath(os.path.join(tempdir, '%s_%s' % (name, digest)))
 
     def _make_subtempdir(self, subtempdir):
         try:
@@ -264,10 +602,44 @@ class AioM3u8Downloader:
             self.logger.exception('create subtempdir failed for: %s', subtempdir)
             raise
 
+    def new_session(self, force_close=False):
+        my_conn = aiohttp.TCPConnector(limit=self.limit_conn, force_close=force_close)
+        # a socket without any data for a whole min rate window is stalled.
+        timeout = aiohttp.ClientTimeout(
+            total=self.total_timeout,
+            connect=self.connect_timeout,
+            sock_read=self.min_rate_window if self.min_rate else None,
+        )
+        return aiohttp.ClientSession(
+            connector=my_conn,
+            timeout=timeout,
+            trace_configs=self.tracer.trace_configs(),
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36 Edg/142.0.0.0'
+            },
+        )
+
+    def report_failure(self, host, exc, attempt, budget_keys):
+        """tell the limiter about a failed attempt and ask the retry policy.
+
+        Return:
+            seconds to wait before the next attempt, None to give up.
+
+        """
+        status = response_status(exc)
+        retry_after = None
+        if status in THROTTLE_STATUSES:
+            retry_after = response_retry_after(exc)
+        self.limiter.report_error(host, status, retry_after)
+        return self.retry_policy.next_delay(exc, attempt, budget_keys)
+
     async def aio_get_url_content(self, url):
         """async fetch url, return content as bytes."""
-        interval = [1, 5, 10]
-        for sec in interval:
+        host = get_host(url)
+        budget_keys = [('host', host)]
+        attempt = 0
+        while True:
+            self.retry_policy.on_request(budget_keys)
             try:
                 self.logger.debug('GET %s', url)
                 async with self.session.get(url) as response:
@@ -281,61 +653,586 @@ class AioM3u8Downloader:
                         raise
                     return await response.read()
             except Exception as e:
-                self.logger.debug('GET failed (%s), retrying in %s s: %s', e, sec, url)
+                sec = self.report_failure(host, e, attempt, budget_keys)
+                if sec is None:
+                    self.logger.error('GET failed (%s), giving up: %s', e, url)
+                    return None
+                self.logger.debug('GET failed (%s), retrying in %.1f s: %s', e, sec, url)
                 await asyncio.sleep(sec)
-        # all retries failed
-        self.logger.exception('fragment download failed after retries: %s', url)
-        return None
+                attempt += 1
+
+    async def aio_stream_url_to_file(
+        self,
+        job,
+        url,
+        local_file,
+        skip_bytes=0,
+        session=None,
+        part_suffix=PART_SUFFIX,
+        slot_acquired=None,
+    ):
+        """async fetch url, write the body to local_file chunk by chunk.
+
+        Memory use is bounded by CHUNK_SIZE no matter how large the response
+        is. The body goes to a "<local_file>.part" file which is renamed to
+        local_file only once it is complete, so local_file never holds a
+        truncated download. A .part file left by an interrupted run is
+        resumed with a Range request when the server supports it.
+
+        Every attempt holds a connection slot of job, outcomes are reported
+        to the limiter so it can adapt the host concurrency.
+
+        Args:
+            job: the DownloadJob the resource belongs to.
+            url: resource url.
+            local_file: final file path.
+            skip_bytes: amount of leading body bytes to drop, e.g. the fake
+                        image header of image-disguised fragments.
+            session: ClientSession to use, default self.session.
+            part_suffix: suffix of the in-progress file.
+            slot_acquired: optional asyncio.Event, set when the first
+                           attempt holds a connection slot.
+
+        Return:
+            md5 hex digest of the written file on success, None if all
+            retries failed.
+
+        """
+        part_file = local_file + part_suffix
+
+        async def attempt():
+            have = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+            headers = None
+            if have:
+                headers = {'Range': 'bytes=%d-' % (skip_bytes + have)}
+            checksum = await self._aio_stream_attempt(
+                job, session or self.session, url, part_file, have, headers, skip_bytes
+            )
+            if checksum is not None:
+                os.replace(part_file, local_file)
+            return checksum
+
+        # on failure the .part file is kept for the next run.
+        return await self.aio_with_retries(
+            job, url, attempt, slot_acquired=slot_acquired
+        )
+
+    async def aio_with_retries(self, job, url, attempt, slot_acquired=None):
+        """run attempt() under a connection slot until it succeeds.
+
+        Failures are reported to the limiter, and the retry policy decides
+        whether and when to try again.
+
+        Args:
+            attempt: coroutine function doing one request, it returns the
+                     result or None to try again right away.
+            slot_acquired: optional asyncio.Event, set when the first
+                           attempt holds a connection slot.
+
+        Return:
+            result of attempt(), None if the retry policy gave up.
+
+        """
+        host = get_host(url)
+        budget_keys = [('job', job.url), ('host', host)]
+        labels = (job.label, host)
+        tries = 0
+        while True:
+            self.retry_policy.on_request(budget_keys)
+            try:
+                queued = time.monotonic()
+                async with self.metrics.slot(self.limiter.slot(job, host), labels):
+                    if slot_acquired is not None:
+                        slot_acquired.set()
+                    with self.tracer.request(job, url, queued):
+                        result = await attempt()
+                if result is not None:
+                    return result
+                tries += 1
+                if tries >= self.retry_policy.max_attempts:
+                    return None
+                self.metrics.inc(RETRIES, labels + ('restart',))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                sec = self.report_failure(host, e, tries, budget_keys)
+                cause = failure_cause(e)
+                self.metrics.inc(ERRORS, labels + (cause,))
+                if sec is not None:
+                    self.metrics.inc(RETRIES, labels + (cause,))
+                if sec is None:
+                    self.logger.error('GET failed (%s), giving up: %s', e, url)
+                    return None
+                self.logger.debug('GET failed (%s), retrying in %.1f s: %s', e, sec, url)
+                await asyncio.sleep(sec)
+                tries += 1
+
+    async def _aio_stream_attempt(
+        self, job, session, url, part_file, have, headers, skip_bytes
+    ):
+        """one GET of aio_stream_url_to_file.
+
+        The response headers must arrive within first_byte_timeout, and the
+        body is aborted with SlowTransferError once it transfers slower than
+        min_rate over a min_rate_window. The caller retries it, resuming the
+        .part file.
+
+        Return:
+            md5 hex digest of the complete .part file, None if the .part file
+            was stale or the response doesn't resume it, and was removed.
+
+        """
+        host = get_host(url)
+        labels = (job.label, host)
+        self.logger.debug('GET %s (headers=%s)', url, headers)
+        started = time.monotonic()
+        response = await asyncio.wait_for(
+            session.get(url, headers=headers), self.first_byte_timeout
+        )
+        async with response:
+            headers_received = time.monotonic()
+            latency = headers_received - started
+            self.metrics.observe(TTFB_SECONDS, labels, latency)
+            self.tracer.lane_span(
+                'response headers', started, headers_received, status=response.status
+            )
+            if response.status == 416:
+                # stale .part, e.g. the resource changed. start over right
+                # away.
+                self.logger.debug('range not satisfiable, restart: %s', url)
+                os.remove(part_file)
+                return None
+            try:
+                response.raise_for_status()
+            except Exception:
+                # non-2xx response
+                self.logger.warning(
+                    'bad response status=%s for %s', response.status, url
+                )
+                raise
+            if response.status == 206 and have:
+                start = content_range_start(response.headers.get('Content-Range'))
+                if start != skip_bytes + have:
+                    # appending to the .part file would corrupt it.
+                    self.logger.warning(
+                        'Content-Range %r does not resume at byte %s, restart: %s',
+                        response.headers.get('Content-Range'),
+                        skip_bytes + have,
+                        url,
+                    )
+                    os.remove(part_file)
+                    return None
+            hasher = hashlib.md5()
+            if response.status == 206 and have:
+                self.logger.debug('resume %s from byte %s', url, have)
+                mode = 'ab'
+                to_skip = 0
+                with open(part_file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+            else:
+                # full body, server ignored the Range header.
+                mode = 'wb'
+                to_skip = skip_bytes
+            written = 0
+            write_time = 0.0
+            watchdog = RateWatchdog(self.min_rate, self.min_rate_window)
+            with open(part_file, mode) as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    written += len(chunk)
+                    job.bytes_received += len(chunk)
+                    self.metrics.inc(BYTES, labels, len(chunk))
+                    watchdog.update(len(chunk))
+                    if to_skip:
+                        if len(chunk) <= to_skip:
+                            to_skip -= len(chunk)
+                            continue
+                        chunk = memoryview(chunk)[to_skip:]
+                        to_skip = 0
+                    hasher.update(chunk)
+                    write_started = time.monotonic()
+                    f.write(chunk)
+                    write_time += time.monotonic() - write_started
+            self.tracer.lane_span(
+                'transfer',
+                headers_received,
+                time.monotonic(),
+                bytes=written,
+                disk_write_ms=round(write_time * 1000, 3),
+            )
+            # content_length is the encoded size, only check it on
+            # identity bodies.
+            if (
+                response.content_length is not None
+                and not response.headers.get('Content-Encoding')
+                and written != response.content_length
+            ):
+                raise aiohttp.ClientPayloadError(
+                    'got %s of %s bytes' % (written, response.content_length)
+                )
+        self.limiter.report_success(host, written, latency)
+        return hasher.hexdigest()
+
+    async def aio_download_byte_range(self, job, byte_range):
+        """download a ByteRangeRequest into its sparse local file.
+
+        The bytes are written at their original offsets, so the local
+        playlist keeps its EXT-X-BYTERANGE tags. Progress is tracked by the
+        journal only, a partly written range is requested again.
+
+        Return:
+            (journal key, local file, success)
+
+        """
+        local_file = get_local_file_for_url(job.subtempdir, byte_range.url)
+        if not os.path.exists(local_file):
+            # ranges are written into one sparse file, create it once.
+            ensure_dir_exists_for(local_file)
+            open(local_file, 'ab').close()
+
+        async def attempt():
+            return await self._aio_range_attempt(
+                job,
+                url=byte_range.url,
+                local_file=local_file,
+                offset=byte_range.offset,
+                length=byte_range.length,
+            )
+
+        started = time.monotonic()
+        checksum = await self.aio_with_retries(job, byte_range.url, attempt)
+        self.observe_fragment(job, byte_range.url, started, checksum is not None)
+        if checksum is None:
+            return byte_range.key, None, False
+        if job.journal:
+            job.journal.mark_done(
+                byte_range.key, byte_range.seq, local_file, byte_range.length, checksum
+            )
+        return byte_range.key, local_file, True
+
+    async def _aio_range_attempt(self, job, url, local_file, offset, length):
+        """one Range GET of aio_download_byte_range, return md5 hex digest."""
+        host = get_host(url)
+        labels = (job.label, host)
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        self.logger.debug('GET %s (headers=%s)', url, headers)
+        started = time.monotonic()
+        response = await asyncio.wait_for(
+            self.session.get(url, headers=headers), self.first_byte_timeout
+        )
+        async with response:
+            headers_received = time.monotonic()
+            latency = headers_received - started
+            self.metrics.observe(TTFB_SECONDS, labels, latency)
+            self.tracer.lane_span(
+                'response headers', started, headers_received, status=response.status
+            )
+            response.raise_for_status()
+            # a 200 means the server ignored Range, skip to our offset.
+            to_skip = 0 if response.status == 206 else offset
+            remaining = length
+            hasher = hashlib.md5()
+            write_time = 0.0
+            watchdog = RateWatchdog(self.min_rate, self.min_rate_window)
+            with open(local_file, 'r+b') as f:
+                f.seek(offset)
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    job.bytes_received += len(chunk)
+                    self.metrics.inc(BYTES, labels, len(chunk))
+                    watchdog.update(len(chunk))
+                    if to_skip:
+                        if len(chunk) <= to_skip:
+                            to_skip -= len(chunk)
+                            continue
+                        chunk = memoryview(chunk)[to_skip:]
+                        to_skip = 0
+                    if len(chunk) > remaining:
+                        chunk = memoryview(chunk)[:remaining]
+                    hasher.update(chunk)
+                    write_started = time.monotonic()
+                    f.write(chunk)
+                    write_time += time.monotonic() - write_started
+                    remaining -= len(chunk)
+                    if not remaining:
+                        break
+            self.tracer.lane_span(
+                'transfer',
+                headers_received,
+                time.monotonic(),
+                bytes=length - remaining,
+                disk_write_ms=round(write_time * 1000, 3),
+            )
+            if remaining:
+                raise aiohttp.ClientPayloadError(
+                    'got %s of %s bytes' % (length - remaining, length)
+                )
+        self.limiter.report_success(host, length, latency)
+        return hasher.hexdigest()
+
+    async def aio_hedged_stream_url_to_file(self, job, url, local_file, skip_bytes=0):
+        """aio_stream_url_to_file with a hedged duplicate request.
 
-    def rewrite_http_link_in_m3u8_file(self, local_m3u8_filename, m3u8_url):
+        When the download runs hedge_factor times longer than the p95
+        fragment time of job, the same url is requested again on a fresh
+        connection. The first copy to finish wins and the other is cancelled.
+        The time is counted from when the request holds a connection slot,
+        and nothing is hedged before job has enough samples for a p95.
+
+        """
+        slot_acquired = asyncio.Event()
+        primary = asyncio.ensure_future(
+            self.aio_stream_url_to_file(
+                job, url, local_file, skip_bytes, slot_acquired=slot_acquired
+            )
+        )
+        waiting = asyncio.ensure_future(slot_acquired.wait())
+        tasks = {primary: PART_SUFFIX}
+        checksum = None
+        try:
+            await asyncio.wait({primary, waiting}, return_when=asyncio.FIRST_COMPLETED)
+            started = time.monotonic()
+            p95 = job.latency.percentile(95)
+            if p95 is not None and not primary.done():
+                await asyncio.wait({primary}, timeout=p95 * self.hedge_factor)
+            if p95 is not None and not primary.done():
+                self.logger.debug('hedge slow fragment after %.1fs: %s', p95, url)
+                job.hedges_fired += 1
+                self.hedges_fired += 1
+                hedge = asyncio.ensure_future(
+                    self.aio_stream_url_to_file(
+                        job,
+                        url,
+                        local_file,
+                        skip_bytes,
+                        session=self.hedge_session,
+                        part_suffix=HEDGE_PART_SUFFIX,
+                    )
+                )
+                tasks[hedge] = HEDGE_PART_SUFFIX
+            pending = set(tasks)
+            while pending and checksum is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None and task.result() is not None:
+                        checksum = task.result()
+                        if task is not primary:
+                            job.hedges_won += 1
+                            self.hedges_won += 1
+                        break
+        finally:
+            waiting.cancel()
+            losers = [x for x in tasks if not x.done()]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                part_file = local_file + tasks[task]
+                if checksum is not None and os.path.exists(part_file):
+                    os.remove(part_file)
+        if checksum is not None:
+            job.latency.add(time.monotonic() - started)
+        return checksum
+
+    def rewrite_http_link_in_m3u8_file(self, job, local_m3u8_filename, m3u8_url):
         """rewrite fragment url to local relative file path."""
         with open(local_m3u8_filename, 'r') as f:
-            content = f.read()
+            playlist = parse_playlist(f.read(), m3u8_url)
+        self.write_local_media_playlist(job, playlist, local_m3u8_filename)
+
+    def write_local_media_playlist(self, job, playlist, local_m3u8_filename):
+        """write MediaPlaylist with keys and segments pointing to local files."""
+        ensure_dir_exists_for(local_m3u8_filename)
+        content = render_media_playlist(
+            playlist,
+            segment_uri=lambda x: get_fragment_file(job, x.url, x.uri),
+            key_line=lambda x: (
+                '#EXT-X-KEY:METHOD=NONE'
+                if job.decrypt
+                else rewrite_key_uri(job.subtempdir, playlist.url, x.line)
+            ),
+            map_line=lambda x: rewrite_key_uri(job.subtempdir, playlist.url, x.line),
+        )
         with open(local_m3u8_filename, 'w') as f:
-            for line in content.split('\n'):
-                if line.startswith('#'):
-                    if line == '#EXT-X-KEY:METHOD=NONE':
-                        continue
-                    if line.startswith('#EXT-X-KEY:'):
-                        f.write(rewrite_key_uri(self.subtempdir, m3u8_url, line))
-                    else:
-                        f.write(line)
-                    f.write('\n')
-                elif line.strip() == '':
-                    f.write(line)
-                    f.write('\n')
-                else:
-                    f.write(
-                        get_local_file_for_url(
-                            self.subtempdir, urljoin(m3u8_url, line), line
-                        )
-                    )
-                    f.write('\n')
+            f.write(content)
         self.logger.info('http links rewrote in m3u8 file: %s', local_m3u8_filename)
 
     def remake_path(self, target_mp4_path):
         folder_path = os.path.dirname(target_mp4_path)
         file_name_list = os.listdir(folder_path)
         file_name = os.path.basename(target_mp4_path)
-        if file_name in file_name_list:
+        if file_name in file_name_list or target_mp4_path in self.reserved_paths:
             self.logger.info(f'File "{file_name}" already exists')
             timestamp = int(dat.now().timestamp())
             remake_path = f'{target_mp4_path[:-4]}_{timestamp}.mp4'
+            # jobs of a batch may finish in the same second.
+            count = 1
+            while os.path.exists(remake_path) or remake_path in self.reserved_paths:
+                remake_path = f'{target_mp4_path[:-4]}_{timestamp}_{count}.mp4'
+                count += 1
             self.logger.info(f'Rename to "{remake_path}"')
+            self.reserved_paths.add(remake_path)
             return remake_path
+        self.reserved_paths.add(target_mp4_path)
         return target_mp4_path
 
+    async def __aenter__(self):
+        """open sessions and exporters, shared by nested and concurrent
+        users, the last one to leave closes them."""
+        if self._open_lock is None:
+            # created in the loop, not in __init__.
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._users == 0:
+                await self._open()
+            self._users += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._open_lock:
+            self._users -= 1
+            if self._users == 0:
+                await self._close()
+                # bound to this loop, the next user may run in another.
+                self._open_lock = None
+        return False
+
+    async def _open(self):
+        self._job_slots = asyncio.Semaphore(self.max_jobs)
+        self.limiter.reset()
+        self.session = self.external_session or self.new_session()
+        if self.hedge:
+            # hedged requests never reuse a (possibly stalled) connection.
+            self.hedge_session = self.new_session(force_close=True)
+        self._exporter = MetricsExporter(
+            self.metrics,
+            port=self.metrics_port,
+            host=self.metrics_host,
+            path=self.metrics_file,
+            interval=self.metrics_interval,
+            logger=self.logger,
+        )
+        await self._exporter.start()
+
+    async def _close(self):
+        # failures to write metrics, trace or ad index don't fail downloads.
+        try:
+            try:
+                await self._exporter.stop()
+            except Exception:
+                self.logger.exception('stopping the metrics exporter failed')
+            try:
+                self.tracer.save()
+            except Exception:
+                self.logger.exception('saving the trace failed')
+            try:
+                self.ad_index.save()
+            except Exception:
+                self.logger.exception('saving the ad index failed')
+        finally:
+            if self.hedge_session is not None:
+                await self.hedge_session.close()
+            if self.session is not None and self.session is not self.external_session:
+                await self.session.close()
+            self.session = None
+            self.hedge_session = None
+            if self._decrypt_pool is not None:
+                self._decrypt_pool.shutdown()
+                self._decrypt_pool = None
+
+    def new_job(self, url, output_filename=None, progress=None):
+        output_filename = (
+            self.safe_output_path(output_filename)
+            if output_filename
+            else self.output_filename
+        )
+        if not output_filename:
+            raise ValueError('no output filename for %s' % url)
+        job = DownloadJob(url, self.get_subtempdir(url))
+        job.output_filename = output_filename
+        job.progress = progress
+        return job
+
+    async def download(self, url, output_filename=None, progress=None):
+        """download url and mux it into output_filename.
+
+        Args:
+            url: m3u8 url.
+            output_filename: output mp4 path, default the one given to the
+                             constructor.
+            progress: optional callable taking a DownloadProgress, called
+                      after every fragment. A returned awaitable is
+                      scheduled as a task.
+
+        Return:
+            DownloadResult. Failures are reported in it, only cancellation
+            is raised.
+
+        """
+        job = self.new_job(url, output_filename, progress)
+        result = DownloadResult(url)
+        started = time.monotonic()
+        target_mp4 = None
+        self.active_jobs.add(job)
+        # they share the journal and fragments, the later one reuses them.
+        lock = self.subtempdir_locks.setdefault(job.subtempdir, asyncio.Lock())
+        try:
+            async with self:
+                async with lock, self._job_slots:
+                    try:
+                        target_mp4 = await self._start_async(job)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        self.logger.exception('download failed for url: %s', url)
+                        result.error = str(e) or type(e).__name__
+        finally:
+            self.active_jobs.discard(job)
+            self.forget_job(job)
+        result.elapsed = time.monotonic() - started
+        result.success = target_mp4 is not None
+        if not result.success and not result.error and job.failed_fragments:
+            result.error = '%s of %s fragments failed' % (
+                len(job.failed_fragments),
+                job.total_fragments,
+            )
+        if target_mp4:
+            result.output = target_mp4
+            result.output_size = job.output_size
+        result.bytes_received = job.bytes_received
+        result.fragments = job.total_fragments
+        result.failed_fragments = list(job.failed_fragments)
+        result.skipped_fragments = job.skipped_fragments
+        return result
+
+    def forget_job(self, job):
+        """drop the state kept for a finished job, so a long-lived downloader
+        doesn't grow with every url. Jobs of the same url still running keep
+        what they share.
+        """
+        self.reserved_paths.discard(job.target_mp4)
+        self.tracer.job_finished(job)
+        if not any(x.subtempdir == job.subtempdir for x in self.active_jobs):
+            self.subtempdir_locks.pop(job.subtempdir, None)
+        if not any(x.url == job.url for x in self.active_jobs):
+            self.url_subtempdir.pop(job.url, None)
+            self.retry_policy.forget(('job', job.url))
+        if job.stats is not None and not any(
+            x.label == job.label for x in self.active_jobs
+        ):
+            self.metrics.job_finished(job.url)
+
     def start(self):
         total = len(self.urls)
         success_count = 0
         failed_urls = []
 
         async def download_all():
-            results = []
-            for url in self.urls:
-                result = await self._start_async(url)
-                results.append(result)
-            return results
+            async with self:
+                return await asyncio.gather(
+                    *[self.download(url) for url in self.urls], return_exceptions=True
+                )
 
         results = asyncio.run(download_all())
 
@@ -343,6 +1240,11 @@ class AioM3u8Downloader:
             if isinstance(result, Exception):
                 failed_urls.append(url)
                 self.logger.error('download failed for url: %s, error: %s', url, result)
+            elif result.error:
+                failed_urls.append(url)
+                self.logger.error(
+                    'download failed for url: %s, error: %s', url, result.error
+                )
             elif result:
                 success_count += 1
                 self.logger.info('download successful for url: %s', url)
@@ -361,125 +1263,435 @@ class AioM3u8Downloader:
             self.logger.info('Failed URLs:')
             for failed_url in failed_urls:
                 self.logger.info('  - %s', failed_url)
+        self.logger.info(
+            'Retries: %d, requeued on exhausted retry budget: %d',
+            self.retry_policy.retries,
+            self.retry_policy.exhausted,
+        )
+        if self.hedge:
+            self.logger.info(
+                'Hedged requests: %d fired, %d won', self.hedges_fired, self.hedges_won
+            )
+        if self.limiter.hosts:
+            self.logger.info('Adaptive connection limits:')
+            for host, controller in self.limiter.hosts.items():
+                self.logger.info(
+                    '  - %s: settled at %d, %d requests, %d errors, %d throttled',
+                    host,
+                    controller.allowed,
+                    controller.requests,
+                    controller.errors,
+                    controller.throttled,
+                )
         self.logger.info('=' * 50)
 
-    async def _start_async(self, url):
-        self.subtempdir = self.url_subtempdir[url]
-        self.total_fragments = 0
-        self.fragments = OrderedDict()
+    def get_target_path(self, job):
+        """return the output mp4 path of job, decided once per job.
+
+        With --output_ts, playlists that are concatenated as MPEG-TS get a
+        .ts path instead.
+        """
+        if job.target_mp4:
+            return job.target_mp4
+        suffix = '.mp4'
+        if self.output_ts and self.can_concat(job) and not job.playlist.is_fmp4:
+            suffix = '.ts'
+        target_mp4 = job.output_filename
+        root, ext = os.path.splitext(target_mp4)
+        if ext in ('.mp4', '.ts'):
+            target_mp4 = root
+        target_mp4 += suffix
+
+        ensure_dir_exists_for(target_mp4)
+        if self.auto_rename:
+            target_mp4 = self.remake_path(target_mp4)
+        job.target_mp4 = target_mp4
+        return target_mp4
 
-        success = await self.aio_download_m3u8_link(url)
+    async def _start_async(self, job):
+        url = job.url
+        # removed by an earlier job of the same url since new_job.
+        self._make_subtempdir(job.subtempdir)
+        job.journal = DownloadJournal(job.subtempdir)
+
+        await self.limiter.register(job)
+        job.stats = self.metrics.job_started(url)
+        success = False
+        try:
+            with self.tracer.span(job, 'download'):
+                success = await self.aio_download_m3u8_link(job)
+        finally:
+            job.stats.finish(success)
+            await self.limiter.unregister(job)
+            job.journal.close()
+            if job.muxer and not success:
+                await job.muxer.abort()
 
         if not success:
             return None
 
-        target_mp4 = self.output_filename
-        if not target_mp4.endswith('.mp4'):
-            target_mp4 += '.mp4'
+        if job.muxer:
+            # fragments were muxed while they were downloaded.
+            target_mp4 = job.target_mp4
+        else:
+            with self.tracer.span(job, 'mux'):
+                target_mp4 = await self.aio_mux(job)
+            if not target_mp4:
+                return None
 
-        ensure_dir_exists_for(target_mp4)
-        if self.auto_rename:
-            target_mp4 = self.remake_path(target_mp4)
+        job.output_size = os.path.getsize(target_mp4)
+        self.logger.info(
+            'mp4 file created, size=%.1fMiB, filename=%s',
+            job.output_size / 1024 / 1024.0,
+            target_mp4,
+        )
+        if any(x.subtempdir == job.subtempdir for x in self.active_jobs - {job}):
+            # a waiting job of the same url reuses the fragments.
+            self.logger.info('keeping temp files for another job of the same url')
+            return target_mp4
+        self.logger.info('Removing temp files in dir: "%s"', job.subtempdir)
+        try:
+            if os.path.exists(job.subtempdir):
+                with self.tracer.span(job, 'remove temp files'):
+                    shutil.rmtree(job.subtempdir)
+        except Exception:
+            self.logger.exception('failed to remove temp dir: %s', job.subtempdir)
+        self.logger.info('temp files removed')
+
+        return target_mp4
+
+    async def aio_mux(self, job):
+        """combine downloaded fragments of job into mp4 with ffmpeg.
 
-        media_path = self.media_playlist_local_file
+        fMP4 playlists that allow it are concatenated instead, see
+        can_concat.
+
+        Return:
+            the mp4 path on success, None on failure.
+
+        """
+        target_mp4 = self.get_target_path(job)
+
+        if self.can_concat(job):
+            return await self.aio_concat(job)
+
+        media_path = job.media_playlist_local_file
         if self.cut_ads:
+            with self.tracer.span(job, 'cut known ads'):
+                await self.aio_cut_known_ads(job)
             cutInsertTs = CutInsertTs(logger=self.logger)
-            success = await cutInsertTs.cut(self.media_playlist_local_file)
+            with self.tracer.span(job, 'cut ads by probing'):
+                success = await cutInsertTs.cut(job.media_playlist_local_file)
 
             if success:
-                media_path = cutInsertTs.gen_cut_path(self.media_playlist_local_file)
-
-        cmd = [
-            'ffmpeg',
-            '-nostdin',
-            '-loglevel',
-            'info',
-            '-fflags',
-            '+genpts',
-            '-allowed_extensions',
-            'ALL',
-            '-i',
-            media_path,
-            '-acodec',
-            'copy',
-            '-vcodec',
-            'copy',
-            '-bsf:a',
-            'aac_adtstoasc',
-            target_mp4,
-        ]
+                media_path = cutInsertTs.gen_cut_path(job.media_playlist_local_file)
+
+        cmd = ffmpeg_mux_command(media_path, target_mp4)
         self.logger.info('Running: %s', cmd)
-        proc = subprocess.run(cmd, capture_output=True)
+        # run ffmpeg without blocking the loop, other jobs keep downloading.
+        with self.tracer.span(job, 'ffmpeg'):
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, stderr = await proc.communicate()
+            except asyncio.CancelledError:
+                # the download was cancelled, don't leave ffmpeg running.
+                proc.kill()
+                await proc.wait()
+                raise
 
         if proc.returncode != 0:
             self.logger.error('---------------------------------------------')
             self.logger.error(f'run ffmpeg command failed: exitcode={proc.returncode}')
-            if proc.stderr:
-                self.logger.error('=> ' + proc.stderr.decode('utf-8'))
+            if stderr:
+                self.logger.error('=> ' + stderr.decode('utf-8', 'replace'))
             self.logger.error('---------------------------------------------')
             # sys.exit(proc.returncode)
             return None
 
+        return target_mp4
+
+    def can_concat(self, job):
+        """return True if job's fragments can simply be concatenated.
+
+        That is an unencrypted fMP4 playlist with a single init section, or
+        with --output_ts an unencrypted MPEG-TS playlist.
+        """
+        playlist = job.playlist
+        if playlist is None or self.cut_ads:
+            return False
+        if playlist.keys() and not job.decrypt:
+            return False
+        if playlist.is_fmp4:
+            # compared by line, live reloads parse the same map again.
+            return len({x.line for x in playlist.init_sections()}) == 1
+        return self.output_ts and all(x.map is None for x in playlist.segments)
+
+    def fragment_parts(self, job):
+        """return (path, offset, length) of the init section and every
+        downloaded fragment of job in playlist order.
+
+        Segments that weren't downloaded are counted in job.skipped_fragments.
+        """
+        done_ranges = set()
+        for byte_range in job.byte_ranges:
+            if byte_range.key in job.fragments:
+                done_ranges.update(id(x) for x in byte_range.segments)
+        parts = []
+        current_map = None
+        job.skipped_fragments = 0
+        for segment in job.playlist.segments:
+            if segment.byterange is None:
+                if segment.url not in job.fragments:
+                    job.skipped_fragments += 1
+                    continue
+                part = (get_fragment_file(job, segment.url), 0, None)
+            else:
+                if id(segment) not in done_ranges:
+                    job.skipped_fragments += 1
+                    continue
+                length, offset = segment.byterange
+                part = (
+                    get_local_file_for_url(job.subtempdir, segment.url),
+                    offset,
+                    length,
+                )
+            if segment.map is not None and (
+                current_map is None or segment.map.line != current_map.line
+            ):
+                current_map = segment.map
+                init_file = get_local_file_for_url(job.subtempdir, current_map.url)
+                if current_map.byterange is None:
+                    parts.append((init_file, 0, None))
+                else:
+                    length, offset = current_map.byterange
+                    parts.append((init_file, offset or 0, length))
+            parts.append(part)
+        return parts
+
+    async def aio_concat(self, job):
+        """write init section and fragments of job into the output as is.
+
+        No subprocess and a single sequential write pass, see concat_parts.
+
+        Return:
+            the mp4 path on success, None on failure.
+
+        """
+        target_mp4 = self.get_target_path(job)
+        parts = self.fragment_parts(job)
+        if job.skipped_fragments:
+            self.logger.warning(
+                '%s of %s fragments failed and are left out of %s',
+                job.skipped_fragments,
+                len(job.playlist.segments),
+                target_mp4,
+            )
+        self.logger.info('concatenating %s files into %s', len(parts), target_mp4)
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        try:
+            with self.tracer.span(job, 'concat', parts=len(parts)):
+                await loop.run_in_executor(None, concat_parts, target_mp4, parts)
+        except (OSError, EOFError):
+            self.logger.exception('concatenating fragments failed')
+            return None
         self.logger.info(
-            'mp4 file created, size=%.1fMiB, filename=%s',
+            'concatenated %.1fMiB in %.2fs',
             filesize_mib(target_mp4),
-            target_mp4,
+            time.monotonic() - started,
         )
-        self.logger.info('Removing temp files in dir: "%s"', self.subtempdir)
-        try:
-            if os.path.exists(self.subtempdir):
-                shutil.rmtree(self.subtempdir)
-        except Exception:
-            self.logger.exception('failed to remove temp dir: %s', self.subtempdir)
-        self.logger.info('temp files removed')
-
         return target_mp4
 
-    async def aio_mirror_url_resource(self, remote_file_url: str):
-        """return fragment_file_local_path, reuse, success"""
-        local_file = get_local_file_for_url(self.subtempdir, remote_file_url)
+    async def aio_mirror_url_resource(self, job, remote_file_url: str, seq=None):
+        """return fragment_file_local_path, reuse, success
+
+        fragments (seq is not None) are recorded in the job journal.
+
+        """
+        cipher = job.ciphers.get(remote_file_url) if seq is not None else None
+        # an encrypted download keeps the name it has when ffmpeg decrypts.
+        download_file = local_file = get_local_file_for_url(
+            job.subtempdir, remote_file_url
+        )
+        if cipher is not None:
+            local_file = decrypted_path(download_file)
         if os.path.exists(local_file):
             self.logger.debug('skip downloaded resource: %s', remote_file_url)
+            if seq is not None and job.journal:
+                job.journal.mark_done(
+                    remote_file_url, seq, local_file, os.path.getsize(local_file)
+                )
             return local_file, True, True
-        content = await self.aio_get_url_content(remote_file_url)
-        if content is None:
-            return None, False, False
 
         ensure_dir_exists_for(local_file)
+        skip_bytes = 0
         if any(map(remote_file_url.lower().endswith, IMG_SUFFIX_LIST)):
             # image to ts
-            content = content[212:]
+            skip_bytes = IMG_HEADER_SIZE
 
-        write_file(local_file, content)
+        checksum = None
+        if cipher is not None and os.path.exists(download_file):
+            # downloaded by a previous run, only the decryption is missing.
+            self.logger.debug('decrypt downloaded resource: %s', remote_file_url)
+        else:
+            started = time.monotonic()
+            if self.hedge and seq is not None:
+                checksum = await self.aio_hedged_stream_url_to_file(
+                    job, remote_file_url, download_file, skip_bytes=skip_bytes
+                )
+            else:
+                checksum = await self.aio_stream_url_to_file(
+                    job, remote_file_url, download_file, skip_bytes=skip_bytes
+                )
+            if seq is not None:
+                success = checksum is not None
+                self.observe_fragment(job, remote_file_url, started, success)
+            if checksum is None:
+                return None, False, False
+        if cipher is not None:
+            if not await self.aio_decrypt_fragment(download_file, local_file, cipher):
+                return None, False, False
+        if seq is not None:
+            job.checksums[remote_file_url] = checksum
+        if seq is not None and job.journal:
+            job.journal.mark_done(
+                remote_file_url,
+                seq,
+                local_file,
+                os.path.getsize(local_file),
+                checksum,
+            )
         return local_file, False, True
 
-    async def aio_download_key(self, url, key_line):
+    def observe_fragment(self, job, url, started, success):
+        """record the download time and result of a fragment in metrics."""
+        labels = (job.label, get_host(url))
+        if success:
+            self.metrics.observe(FRAGMENT_SECONDS, labels, time.monotonic() - started)
+        self.metrics.inc(FRAGMENTS, labels + (RESULT_OK if success else RESULT_FAILED,))
+
+    @property
+    def decrypt_pool(self):
+        """thread pool decrypting fragments, one worker per cpu."""
+        if self._decrypt_pool is None:
+            self._decrypt_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return self._decrypt_pool
+
+    async def aio_decrypt_fragment(self, encrypted_file, local_file, cipher):
+        """decrypt a downloaded fragment on the decrypt pool.
+
+        Args:
+            cipher: (key, iv) of the fragment.
+
+        Return:
+            True on success. On failure the encrypted file is removed, so it
+            is downloaded again.
+
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(
+                self.decrypt_pool, decrypt_file, encrypted_file, local_file, *cipher
+            )
+        except (OSError, ValueError) as e:
+            self.logger.error('decrypting %s failed: %s', encrypted_file, e)
+            if os.path.exists(encrypted_file):
+                os.remove(encrypted_file)
+            return False
+        os.remove(encrypted_file)
+        return True
+
+    def prepare_decryption(self, job, playlist):
+        """load the downloaded keys of playlist and remember the cipher of
+        every encrypted segment.
+
+        Return:
+            True on success, False if a key file is unusable.
+
+        """
+        for segment in playlist.segments:
+            key = segment.key
+            if key is None:
+                continue
+            if key.line not in job.key_bytes:
+                key_file = get_local_file_for_url(job.subtempdir, key.url)
+                try:
+                    job.key_bytes[key.line] = load_key(key_file)
+                except (OSError, ValueError) as e:
+                    self.logger.error('can not use key %s: %s', key.url, e)
+                    return False
+            job.ciphers[segment.url] = (
+                job.key_bytes[key.line],
+                segment_iv(key, segment.seq),
+            )
+        return True
+
+    def use_decryption(self, job, playlist):
+        """decide whether job decrypts playlist in-process."""
+        if not self.decrypt or not playlist.keys():
+            return False
+        reason = unsupported_reason(playlist)
+        if reason:
+            self.logger.info('decrypting in ffmpeg instead: %s', reason)
+            return False
+        return True
+
+    async def aio_download_key(self, job, key):
         """download key.
 
         This will replicate key file in local dir.
 
         Args:
-            key_line: a line looks like #EXT-X-KEY:METHOD=AES-128,URI="key.key"
+            key: playlist.Key, e.g. of #EXT-X-KEY:METHOD=AES-128,URI="key.key"
 
         """
-        pattern = re.compile(r'URI="([^"]+)"')
-        mo = pattern.search(key_line)
-        if not mo:
+        if not key.url:
             raise RuntimeError("key line doesn't have URI")
-        uri = mo.group(1)
-        key_url = urljoin(url, uri)
-        local_key_file, reuse, success = await self.aio_download_fragment(key_url)
+        local_key_file, reuse, success = await self.aio_download_fragment(job, key.url)
         if reuse:
             self.logger.debug('reuse key at: %s', local_key_file)
         else:
             self.logger.debug('key downloaded at: %s', local_key_file)
         return success
 
-    async def aio_download_fragment(self, url):
+    async def aio_download_init_section(self, job, section):
+        """download the init section of an #EXT-X-MAP.
+
+        Args:
+            section: playlist.InitSection.
+
+        """
+        if not section.url:
+            raise RuntimeError("map line doesn't have URI")
+        if section.byterange is None:
+            _, _, success = await self.aio_download_fragment(job, section.url)
+            return success
+        length, offset = section.byterange
+        byte_range = ByteRangeRequest(section.url, offset or 0, length, [])
+        entry = None
+        if job.journal:
+            entry = job.journal.done_fragments().get(byte_range.key)
+        if entry and has_journaled_size(entry[1], entry[2], byte_range.end):
+            self.logger.debug('reuse init section: %s', byte_range.key)
+            return True
+        _, _, success = await self.aio_download_byte_range(job, byte_range)
+        return success
+
+    async def aio_download_fragment(self, job, url, seq=None):
         """download a video fragment."""
-        fragment_file_local_path, reuse, success = await self.aio_mirror_url_resource(
-            url
-        )
+        pipe = job.muxer if seq is not None else None
+        if pipe:
+            await pipe.wait_turn(seq)
+        fragment_file_local_path = None
+        try:
+            fragment_file_local_path, reuse, success = await self.aio_mirror_url_resource(
+                job, url, seq=seq
+            )
+        finally:
+            if pipe:
+                await pipe.fragment_done(seq, fragment_file_local_path)
         if fragment_file_local_path:
             if reuse:
                 self.logger.debug(
@@ -489,8 +1701,29 @@ class AioM3u8Downloader:
                 self.logger.debug(f'fragment created at: {fragment_file_local_path}')
         return (url, fragment_file_local_path, success)
 
-    def fragment_downloaded_from_future(self, future):
+    def notify_progress(self, job):
+        """call the progress callback of job, if any."""
+        if job.progress is None:
+            return
+        info = DownloadProgress(
+            job.url,
+            len(job.fragments),
+            job.total_fragments,
+            job.bytes_received,
+            job.stats.elapsed(),
+            job.stats.eta(),
+        )
+        try:
+            ret = job.progress(info)
+            if inspect.isawaitable(ret):
+                asyncio.ensure_future(ret)
+        except Exception:
+            self.logger.exception('progress callback failed for %s', job.url)
+
+    def fragment_downloaded_from_future(self, job, future):
         """apply_async callback."""
+        if future.cancelled():
+            return
         try:
             res = future.result()
         except Exception:
@@ -500,31 +1733,102 @@ class AioM3u8Downloader:
             return
         url, fragment_file_local_path, success = res
         if not success:
+            job.failed_fragments.append(url)
             return
-        self.fragments[url] = fragment_file_local_path
+        job.fragments[url] = fragment_file_local_path
+        job.stats.update(len(job.fragments), job.total_fragments)
+        self.notify_progress(job)
         # progress log
-        fetched_fragment = len(self.fragments)
-        if fetched_fragment == self.total_fragments:
-            self.logger.info('100%%, %s fragments fetched', self.total_fragments)
+        fetched_fragment = len(job.fragments)
+        if fetched_fragment == job.total_fragments:
+            self.logger.info(
+                '100%%, %s fragments fetched for %s', job.total_fragments, job.url
+            )
         elif fetched_fragment % 10 == 0:
             self.logger.info(
-                '[%2.0f%%] %3s/%s fragments fetched',
-                fetched_fragment * 100.0 / self.total_fragments,
+                '[%2.0f%%] %3s/%s fragments fetched for %s',
+                fetched_fragment * 100.0 / job.total_fragments,
                 fetched_fragment,
-                self.total_fragments,
+                job.total_fragments,
+                job.url,
             )
 
-    async def aio_download_fragments(self, fragment_urls):
-        self.total_fragments = len(fragment_urls)
-        self.logger.info('playlist has %s fragments', self.total_fragments)
+    async def aio_download_fragments(self, job, fragment_urls, byte_ranges=()):
+        """download fragments and coalesced byte range requests.
+
+        Args:
+            fragment_urls: urls of whole-file fragments in playlist order.
+            byte_ranges: ByteRangeRequest list for EXT-X-BYTERANGE segments.
+
+        """
+        job.total_fragments = len(fragment_urls) + len(byte_ranges)
+        self.logger.info('playlist has %s fragments', job.total_fragments)
+        if byte_ranges:
+            self.logger.info(
+                '%s byte range segments coalesced into %s requests',
+                sum(len(x.segments) for x in byte_ranges),
+                len(byte_ranges),
+            )
+
+        if job.journal:
+            done = job.journal.done_fragments()
+            done_bytes = 0
+            # (journal key, expected local file, byte range end)
+            journaled = [
+                (url, get_fragment_file(job, url), None)
+                for url in fragment_urls
+                if url in done
+            ]
+            journaled += [(x.key, None, x.end) for x in byte_ranges if x.key in done]
+            for url, expected_file, range_end in journaled:
+                _, local_file, size, checksum = done[url]
+                if expected_file is not None and local_file != expected_file:
+                    # journaled by a run with --decrypt, and this one without,
+                    # or the other way around.
+                    continue
+                if not has_journaled_size(local_file, size, range_end):
+                    self.logger.warning(
+                        'journaled fragment changed size, download it again: %s', url
+                    )
+                    job.journal.forget(url)
+                    if range_end is None and os.path.exists(local_file):
+                        # or it would be reused as a finished download.
+                        os.remove(local_file)
+                    continue
+                job.fragments[url] = local_file
+                job.checksums[url] = checksum
+                done_bytes += size or 0
+            self.logger.info(
+                'journal: %s/%s fragments (%.1fMiB) already done, %s remaining',
+                len(job.fragments),
+                job.total_fragments,
+                done_bytes / 1024 / 1024.0,
+                job.total_fragments - len(job.fragments),
+            )
+        job.stats.update(len(job.fragments), job.total_fragments)
+        self.notify_progress(job)
 
         tasks = []
-        for url in fragment_urls:
-            if url in self.fragments:
-                self.logger.info('skip downloaded fragment: %s', url)
+        for seq, url in enumerate(fragment_urls):
+            if url in job.fragments:
+                self.logger.debug('skip downloaded fragment: %s', url)
+                if job.muxer:
+                    await job.muxer.fragment_done(seq, job.fragments[url])
                 continue
-            task = asyncio.ensure_future(self.aio_download_fragment(url=url))
-            task.add_done_callback(self.fragment_downloaded_from_future)
+            task = asyncio.ensure_future(
+                self.aio_download_fragment(job, url=url, seq=seq)
+            )
+            task.add_done_callback(
+                functools.partial(self.fragment_downloaded_from_future, job)
+            )
+            tasks.append(task)
+        for byte_range in byte_ranges:
+            if byte_range.key in job.fragments:
+                continue
+            task = asyncio.ensure_future(self.aio_download_byte_range(job, byte_range))
+            task.add_done_callback(
+                functools.partial(self.fragment_downloaded_from_future, job)
+            )
             tasks.append(task)
         results = await asyncio.gather(*tasks, return_exceptions=True)
 
@@ -543,106 +1847,358 @@ class AioM3u8Downloader:
                 if not success:
                     failures += 1
 
-        if total == 0:
-            return True
-        if failures > total * 0.05:
+        if self.hedge:
+            self.logger.info(
+                'hedged requests for %s: %d fired, %d won',
+                job.url,
+                job.hedges_fired,
+                job.hedges_won,
+            )
+        if total and failures > total * 0.05:
             return False
+        if job.muxer:
+            with self.tracer.span(job, 'finish pipe mux'):
+                returncode = await job.muxer.finish()
+            return returncode == 0
         return True
 
-    async def aio_process_media_playlist(self, url, content=None):
+    async def aio_process_media_playlist(self, job, playlist):
         """replicate every file on the playlist in local temp dir.
 
         Args:
-            url: media playlist url
-            content: the playlist content for resource at the url.
+            playlist: the parsed MediaPlaylist.
 
         """
-        self.media_playlist_local_file, _, success = await self.aio_mirror_url_resource(
-            url
-        )
-        if not success:
-            return False
+        url = playlist.url
+        job.playlist = playlist
+        job.media_playlist_local_file = get_local_file_for_url(job.subtempdir, url)
 
-        # always try rewrite because we can't be sure whether the copy in
-        # cache dir has been rewritten yet.
-        self.rewrite_http_link_in_m3u8_file(self.media_playlist_local_file, url)
-        if content is None:
-            content = await self.aio_get_url_content(url)
+        if is_live_playlist(playlist):
+            if self.live:
+                return await self.aio_record_live_playlist(job, playlist)
+            self.logger.info(
+                'playlist has no #EXT-X-ENDLIST, only the current window is '
+                'downloaded, use --live to record it'
+            )
 
-            if content is None:
-                return False
+        if self.cut_ads:
+            playlist = self.skip_ad_segments(job, playlist)
+        job.decrypt = self.use_decryption(job, playlist)
 
-        fragment_urls = []
-        for line in content.decode('utf-8').split('\n'):
-            if line == '#EXT-X-KEY:METHOD=NONE':
-                continue
-            if line.startswith('#EXT-X-KEY'):
-                success = await self.aio_download_key(url, line)
+        keys = playlist.keys()
+        with self.tracer.span(job, 'keys', keys=len(keys)):
+            for key in keys:
+                success = await self.aio_download_key(job, key)
                 if not success:
                     return False
-                continue
-            if line.startswith('#') or line.strip() == '':
-                continue
-            if line.endswith('.m3u8'):
+        if job.decrypt and not self.prepare_decryption(job, playlist):
+            return False
+        # after prepare_decryption, decrypted fragments have their own paths.
+        self.write_local_media_playlist(job, playlist, job.media_playlist_local_file)
+        with self.tracer.span(job, 'init sections'):
+            for section in playlist.init_sections():
+                success = await self.aio_download_init_section(job, section)
+                if not success:
+                    return False
+
+        fragment_urls = []
+        range_segments = []
+        for segment in playlist.segments:
+            if segment.uri.endswith('.m3u8'):
                 self.logger.info('media playlist should not include .m3u8')
                 # raise RuntimeError("media playlist should not include .m3u8")
                 return False
-            fragment_urls.append(urljoin(url, line))
+            if segment.byterange is not None:
+                range_segments.append(segment)
+            else:
+                fragment_urls.append(segment.url)
+        byte_ranges = coalesce_byte_ranges(range_segments, self.range_merge_size)
+        job.byte_ranges = byte_ranges
+
+        if self.pipe_mux:
+            if (
+                (keys and not job.decrypt)
+                or self.cut_ads
+                or byte_ranges
+                or playlist.is_fmp4
+                or self.can_concat(job)
+            ):
+                # ffmpeg has to read the playlist for keys, byte ranges and
+                # fmp4, and ad cutting needs every fragment before deciding
+                # what to keep. concatenated playlists don't need ffmpeg.
+                self.logger.info('pipe mux not possible for this playlist, skip it')
+            else:
+                job.muxer = PipedMuxer(
+                    self.get_target_path(job), window=self.pipe_window, logger=self.logger
+                )
+                await job.muxer.start(len(fragment_urls))
 
-        success = await self.aio_download_fragments(fragment_urls)
+        with self.tracer.span(job, 'fragments', fragments=len(fragment_urls)):
+            success = await self.aio_download_fragments(job, fragment_urls, byte_ranges)
         self.logger.info('media playlist all fragments downloaded')
 
         return success
 
-    async def aio_process_master_playlist(self, url, content):
-        """choose the highest quality media playlist, and download it."""
-        last_resolution = None
-        target_media_playlist = None
-        replace_on_next_line = False
-        pattern = re.compile(r'RESOLUTION=([0-9]+x[0-9]+)')
-        for line in content.decode('utf-8').split('\n'):
-            mo = pattern.search(line)
-            if mo:
-                resolution = mo.group(1)
-                if is_higher_resolution(resolution, last_resolution):
-                    last_resolution = resolution
-                    replace_on_next_line = True
-            if line.startswith('#'):
+    def skip_ad_segments(self, job, playlist):
+        """drop segments the playlist marks as ads before they are fetched.
+
+        Return:
+            the playlist to download, also set as job.playlist.
+        """
+        ads = find_ad_segments(playlist, durations=self.ad_durations)
+        for segment in playlist.segments:
+            if segment.url in self.ad_index.ad_urls:
+                ads.setdefault(segment.seq, REASON_FINGERPRINT)
+        if not ads:
+            return playlist
+        skipped = [x for x in playlist.segments if x.seq in ads]
+        reasons = sorted(set(ads.values()))
+        self.logger.info(
+            'skip %s ad segments (%.1fs, by %s) before downloading',
+            len(skipped),
+            sum(x.duration for x in skipped),
+            ', '.join(reasons),
+        )
+        job.playlist = without_segments(playlist, ads)
+        return job.playlist
+
+    async def aio_fragment_checksums(self, job):
+        """return {url: md5} of the downloaded whole-file fragments of job."""
+        checksums = {}
+        missing = []
+        for segment in job.playlist.segments:
+            if segment.byterange is not None or segment.url not in job.fragments:
                 continue
-            if replace_on_next_line:
-                target_media_playlist = line
-                replace_on_next_line = False
-            if target_media_playlist is None:
-                target_media_playlist = line
+            checksum = job.checksums.get(segment.url)
+            if checksum:
+                checksums[segment.url] = checksum
+            else:
+                missing.append(segment.url)
+        if missing:
+            # e.g. fragments reused from an interrupted run.
+            loop = asyncio.get_event_loop()
+            for url in missing:
+                checksums[url] = await loop.run_in_executor(
+                    None, file_md5, get_fragment_file(job, url)
+                )
+        return checksums
+
+    async def aio_cut_known_ads(self, job):
+        """drop discontinuity groups whose fragments recur across jobs.
+
+        The fingerprints of job are added to self.ad_index first, groups that
+        turn out to be ads are removed from the local playlist and
+        remembered, so later jobs skip them before downloading.
+        """
+        groups = [x for x in job.playlist.discontinuity_groups() if x]
+        if len(groups) < 2:
+            return
+        checksums = await self.aio_fragment_checksums(job)
+        total = job.playlist.duration
+        # short groups that are not the main content, the rest isn't counted.
+        candidates = []
+        for group in groups:
+            duration = sum(x.duration for x in group)
+            if duration <= MAX_AD_GROUP_DURATION and duration * 2 <= total:
+                candidates.append(group)
+        self.ad_index.add_job(
+            job.url,
+            {checksums[x.url] for g in candidates for x in g if x.url in checksums},
+        )
+        ads = set()
+        for group in candidates:
+            group_checksums = [checksums[x.url] for x in group if x.url in checksums]
+            if self.ad_index.is_ad_group(group_checksums):
+                ads.update(x.seq for x in group)
+                self.ad_index.mark_ads([x.url for x in group], group_checksums)
+        if not ads:
+            return
+        self.logger.info('cut %s ad segments seen in other videos', len(ads))
+        job.playlist = without_segments(job.playlist, ads)
+        self.write_local_media_playlist(
+            job, job.playlist, job.media_playlist_local_file
+        )
+
+    async def aio_get_playlist_if_modified(self, url, recording):
+        """conditional GET of a live playlist.
+
+        Return:
+            (status, content). content is None when the playlist is not
+            modified (status 304) or the request failed (status None).
+
+        """
+        try:
+            self.logger.debug('GET %s', url)
+            async with self.session.get(
+                url, headers=recording.conditional_headers()
+            ) as response:
+                if response.status == 304:
+                    return 304, None
+                response.raise_for_status()
+                recording.remember_validators(response.headers)
+                return response.status, await response.read()
+        except Exception as e:
+            self.logger.warning('reload playlist failed (%s): %s', e, url)
+            return None, None
+
+    async def aio_record_live_playlist(self, job, playlist):
+        """record a live or EVENT playlist.
+
+        The playlist is reloaded every target duration and only segments with
+        a new media sequence number are downloaded. Recording stops on
+        #EXT-X-ENDLIST, --live_max_time or --live_max_size.
+
+        """
+        url = playlist.url
+        max_size = self.live_max_size * 1024 * 1024 if self.live_max_size else None
+        recording = LiveRecording(url, max_time=self.live_max_time, max_size=max_size)
+        job.decrypt = self.decrypt
+        reason = unsupported_reason(playlist) if self.decrypt else None
+        if reason:
+            self.logger.info('decrypting in ffmpeg instead: %s', reason)
+            job.decrypt = False
+        downloaded_keys = set()
+        downloaded_maps = set()
+        tasks = []
+        reload_failures = 0
+
+        def count_bytes(future):
+            if future.cancelled() or future.exception():
+                return
+            _, fragment_file_local_path, success = future.result()
+            if success:
+                recording.downloaded_bytes += os.path.getsize(fragment_file_local_path)
+
+        self.logger.info('recording live playlist: %s', url)
+        try:
+            while True:
+                if playlist is not None:
+                    missed = recording.missed
+                    new_segments = recording.update(playlist)
+                    if recording.missed > missed:
+                        self.logger.warning(
+                            '%s live segments left the playlist before they were seen',
+                            recording.missed - missed,
+                        )
+                    for key in playlist.keys():
+                        if key.line in downloaded_keys:
+                            continue
+                        if not await self.aio_download_key(job, key):
+                            return False
+                        downloaded_keys.add(key.line)
+                    if job.decrypt:
+                        reason = unsupported_reason(playlist)
+                        if reason:
+                            self.logger.error(
+                                'stop recording, can not decrypt: %s', reason
+                            )
+                            break
+                        if not self.prepare_decryption(job, playlist):
+                            return False
+                    for section in playlist.init_sections():
+                        if section.line in downloaded_maps:
+                            continue
+                        if not await self.aio_download_init_section(job, section):
+                            return False
+                        downloaded_maps.add(section.line)
+                    for segment in new_segments:
+                        job.total_fragments += 1
+                        task = asyncio.ensure_future(
+                            self.aio_download_fragment(
+                                job, url=segment.url, seq=segment.seq
+                            )
+                        )
+                        task.add_done_callback(
+                            functools.partial(self.fragment_downloaded_from_future, job)
+                        )
+                        task.add_done_callback(count_bytes)
+                        tasks.append(task)
+                if recording.ended:
+                    self.logger.info('live playlist ended: %s', url)
+                    break
+                if recording.limit_reached():
+                    self.logger.info('live recording limit reached: %s', url)
+                    break
+                await asyncio.sleep(
+                    recording.poll_interval(changed=playlist is not None)
+                )
+                status, content = await self.aio_get_playlist_if_modified(
+                    url, recording
+                )
+                playlist = None
+                if status is None:
+                    reload_failures += 1
+                    if reload_failures >= 3:
+                        self.logger.error(
+                            'live playlist is gone, stop recording: %s', url
+                        )
+                        break
+                else:
+                    reload_failures = 0
+                    if content is not None:
+                        playlist = parse_playlist(content.decode('utf-8'), url)
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # on an early return or cancellation, stop the fragments in flight.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if not job.fragments:
+            return False
         self.logger.info(
-            'chose resolution=%s uri=%s', last_resolution, target_media_playlist
+            'recorded %s/%s live segments, %.1fMiB',
+            len(job.fragments),
+            len(recording.segments),
+            recording.downloaded_bytes / 1024 / 1024.0,
         )
-        success = await self.aio_process_media_playlist(
-            urljoin(url, target_media_playlist)
+        job.playlist = recording.recorded_playlist(job.fragments)
+        self.write_local_media_playlist(
+            job, job.playlist, job.media_playlist_local_file
         )
+        return True
 
-        return success
+    async def aio_process_master_playlist(self, job, playlist):
+        """choose the highest quality media playlist, and download it."""
+        last_resolution = None
+        target = None
+        for variant in playlist.variants:
+            resolution = variant.resolution
+            if resolution and is_higher_resolution(resolution, last_resolution):
+                last_resolution = resolution
+                target = variant
+        if target is None and playlist.variants:
+            target = playlist.variants[0]
+        if target is None:
+            self.logger.error('master playlist has no variant: %s', playlist.url)
+            return False
+        self.logger.info('chose resolution=%s uri=%s', last_resolution, target.uri)
 
-    async def aio_download_m3u8_link(self, url):
-        """download video at m3u8 link."""
+        with self.tracer.span(job, 'fetch media playlist'):
+            content = await self.aio_get_url_content(target.url)
+        if content is None:
+            return False
+        media_playlist = parse_playlist(content.decode('utf-8'), target.url)
+        if media_playlist.is_master:
+            self.logger.info('media playlist should not include .m3u8')
+            return False
+        success = await self.aio_process_media_playlist(job, media_playlist)
 
-        my_conn = aiohttp.TCPConnector(limit=self.limit_conn)
-        async with aiohttp.ClientSession(
-            connector=my_conn,
-            headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36 Edg/142.0.0.0'
-            },
-        ) as session:
-            self.session = session
+        return success
 
+    async def aio_download_m3u8_link(self, job):
+        """download video at m3u8 link."""
+        url = job.url
+        with self.tracer.span(job, 'fetch playlist'):
             content = await self.aio_get_url_content(url)
-            if content is None:
-                return False
+        if content is None:
+            return False
 
-            if 'RESOLUTION' in content.decode('utf-8'):
-                success = await self.aio_process_master_playlist(url, content)
-            else:
-                success = await self.aio_process_media_playlist(url, content)
+        playlist = parse_playlist(content.decode('utf-8'), url)
+        if playlist.is_master:
+            success = await self.aio_process_master_playlist(job, playlist)
+        else:
+            success = await self.aio_process_media_playlist(job, playlist)
 
         return success
 
@@ -681,6 +2237,69 @@ def main():
         default=100,
         help='limit amount of simultaneously opened connections',
     )
+    parser.add_argument(
+        '--adaptive_conn',
+        action='store_true',
+        help='adapt the amount of requests per host to its throughput, '
+        'latency and throttling, up to --limit_conn',
+    )
+    parser.add_argument(
+        '--hedge',
+        action='store_true',
+        help='request fragments again on a fresh connection when they take '
+        'much longer than the p95 fragment time',
+    )
+    parser.add_argument(
+        '--range_merge_size',
+        type=float,
+        default=8,
+        help='merge adjacent #EXT-X-BYTERANGE segments into requests of up to '
+        'this many MiB',
+    )
+    parser.add_argument(
+        '--connect_timeout',
+        type=float,
+        metavar='SECONDS',
+        default=10,
+        help='seconds to establish a connection',
+    )
+    parser.add_argument(
+        '--first_byte_timeout',
+        type=float,
+        metavar='SECONDS',
+        default=30,
+        help='seconds from sending a request to receiving the response headers',
+    )
+    parser.add_argument(
+        '--total_timeout',
+        type=float,
+        metavar='SECONDS',
+        default=600,
+        help='seconds a single request may take in total',
+    )
+    parser.add_argument(
+        '--min_rate',
+        type=float,
+        metavar='KIB',
+        default=0,
+        help='abort and retry fragment transfers slower than this many KiB/s, '
+        'default 0 (disabled)',
+    )
+    parser.add_argument(
+        '--min_rate_window',
+        type=float,
+        metavar='SECONDS',
+        default=20,
+        help='seconds over which --min_rate is measured',
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='amount of m3u8 urls downloaded at the same time, '
+        'they share the --limit_conn budget',
+    )
     parser.add_argument('url', metavar='URL', nargs='+', help='one or more m3u8 URLs')
     parser.add_argument(
         '--auto_rename',
@@ -694,6 +2313,93 @@ def main():
         action='store_true',
         help='attempt to filter out ad segments before combining.',
     )
+    parser.add_argument(
+        '--ad_durations',
+        action='store_true',
+        help='with --cut_ads, also skip discontinuity groups lasting 15, 30 '
+        'or 60 seconds, which may be main content too',
+    )
+    parser.add_argument(
+        '--pipe_mux',
+        action='store_true',
+        help='feed fragments to ffmpeg while downloading, '
+        'for unencrypted playlists without --cut_ads',
+    )
+    parser.add_argument(
+        '--ad_index',
+        metavar='FILE',
+        help='with --cut_ads, keep fingerprints of ads seen in several '
+        'videos in FILE and reuse them in later runs. Content shared by '
+        'unrelated videos, e.g. a site intro, is cut too',
+    )
+    parser.add_argument(
+        '--ad_series_depth',
+        type=int,
+        default=1,
+        metavar='N',
+        help='with --ad_index, videos whose urls share the host and first N '
+        'directories are one series, their shared intros and recaps are not '
+        'ads, default 1',
+    )
+    parser.add_argument(
+        '--output_ts',
+        action='store_true',
+        help='write unencrypted MPEG-TS playlists as one .ts file by '
+        'concatenating fragments, without ffmpeg',
+    )
+    parser.add_argument(
+        '--decrypt',
+        action='store_true',
+        help='decrypt AES-128 fragments while downloading instead of in '
+        'ffmpeg, needs the cryptography package',
+    )
+    parser.add_argument(
+        '--metrics_port',
+        type=int,
+        metavar='PORT',
+        help='serve Prometheus metrics at http://HOST:PORT/metrics while '
+        'downloading',
+    )
+    parser.add_argument(
+        '--metrics_host',
+        default='127.0.0.1',
+        metavar='HOST',
+        help='address the metrics endpoint listens on (default 127.0.0.1)',
+    )
+    parser.add_argument(
+        '--metrics_file',
+        metavar='FILE',
+        help='write metrics as json to FILE every --metrics_interval seconds',
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=5,
+        help='seconds between writes of --metrics_file',
+    )
+    parser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='write spans of every phase and fragment request to FILE in '
+        'Chrome trace-event format',
+    )
+    parser.add_argument(
+        '--live',
+        action='store_true',
+        help='record live/EVENT playlists until #EXT-X-ENDLIST or a limit',
+    )
+    parser.add_argument(
+        '--live_max_time',
+        type=float,
+        default=None,
+        help='stop recording a live playlist after this many seconds',
+    )
+    parser.add_argument(
+        '--live_max_size',
+        type=float,
+        default=None,
+        help='stop recording a live playlist after this many MiB',
+    )
     args = parser.parse_args()
 
     if args.debug:
@@ -712,6 +2418,29 @@ def main():
         limit_conn=args.limit_conn,
         auto_rename=args.auto_rename,
         cut_ads=args.cut_ads,
+        ad_durations=args.ad_durations,
+        max_jobs=args.jobs,
+        pipe_mux=args.pipe_mux,
+        live=args.live,
+        live_max_time=args.live_max_time,
+        live_max_size=args.live_max_size,
+        adaptive_conn=args.adaptive_conn,
+        hedge=args.hedge,
+        range_merge_size=int(args.range_merge_size * 1024 * 1024),
+        output_ts=args.output_ts,
+        decrypt=args.decrypt,
+        ad_index=args.ad_index,
+        ad_series_depth=args.ad_series_depth,
+        connect_timeout=args.connect_timeout,
+        first_byte_timeout=args.first_byte_timeout,
+        total_timeout=args.total_timeout,
+        min_rate=int(args.min_rate * 1024),
+        min_rate_window=args.min_rate_window,
+        metrics_port=args.metrics_port,
+        metrics_host=args.metrics_host,
+        metrics_file=args.metrics_file,
+        metrics_interval=args.metrics_interval,
+        trace=args.trace,
         logger=logger,
     )
     downloader.start()
@@ -0,0 +1,138 @@
+# coding=utf-8
+"""build the output by concatenating fragments, without remuxing.
+
+An fMP4/CMAF playlist is an init segment (ftyp + moov) followed by media
+segments (moof + mdat). Written back to back they already are a valid
+fragmented mp4, so there is nothing for ffmpeg to do but copy bytes. The
+same holds for MPEG-TS fragments when a .ts output is asked for.
+
+The output is preallocated once and filled in a single sequential pass.
+Bytes are moved by the kernel with copy_file_range or sendfile where the
+platform and filesystems allow it, otherwise through one reused buffer.
+
+"""
+
+import errno
+import os
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# errors meaning the zero-copy call can't be used for this pair of files.
+ZERO_COPY_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.ENOTSUP,
+}
+
+
+class Concatenator:
+    """copies byte ranges of files to the current position of dst_fd."""
+
+    def __init__(self, dst_fd):
+        self.dst_fd = dst_fd
+        self.unsupported = set()
+        self._buf = None
+
+    def zero_copy(self, src_fd, offset, count):
+        """return bytes copied in kernel, None if no zero-copy call works."""
+        for name in ('copy_file_range', 'sendfile'):
+            if name in self.unsupported or not hasattr(os, name):
+                continue
+            try:
+                if name == 'copy_file_range':
+                    return os.copy_file_range(src_fd, self.dst_fd, count, offset)
+                return os.sendfile(self.dst_fd, src_fd, offset, count)
+            except OSError as e:
+                if e.errno not in ZERO_COPY_FALLBACK_ERRNOS:
+                    raise
+                self.unsupported.add(name)
+        return None
+
+    def buffered_copy(self, src_fd, offset, count):
+        if self._buf is None:
+            self._buf = memoryview(bytearray(COPY_BUFFER_SIZE))
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        n = os.readv(src_fd, [self._buf[: min(count, COPY_BUFFER_SIZE)]])
+        written = 0
+        while written < n:
+            written += os.write(self.dst_fd, self._buf[written:n])
+        return n
+
+    def copy(self, path, offset, length):
+        """append length bytes of path at offset, length None until EOF.
+
+        Return:
+            bytes copied.
+
+        """
+        src_fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            if length is None:
+                length = os.fstat(src_fd).st_size - offset
+            remaining = length
+            while remaining:
+                n = self.zero_copy(src_fd, offset, remaining)
+                if n is None:
+                    n = self.buffered_copy(src_fd, offset, remaining)
+                if not n:
+                    raise EOFError('%s is shorter than its byte range' % path)
+                offset += n
+                remaining -= n
+        finally:
+            os.close(src_fd)
+        return length
+
+
+def parts_size(parts):
+    return sum(
+        os.path.getsize(path) - offset if length is None else length
+        for path, offset, length in parts
+    )
+
+
+def preallocate(fd, size):
+    """reserve size bytes for fd so the filesystem can lay it out in one go."""
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        # e.g. not supported by the filesystem, just write without it.
+        pass
+
+
+def concat_parts(target, parts):
+    """write parts back to back into target.
+
+    The output is written to "<target>.part" and renamed once complete.
+
+    Args:
+        target: output file path.
+        parts: list of (path, offset, length), length None for the whole
+               file from offset.
+
+    Return:
+        size of target in bytes.
+
+    """
+    part_file = target + '.part'
+    fd = os.open(
+        part_file,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+        0o644,
+    )
+    try:
+        preallocate(fd, parts_size(parts))
+        concatenator = Concatenator(fd)
+        size = 0
+        for path, offset, length in parts:
+            size += concatenator.copy(path, offset, length)
+        # a shorter file than preallocated must not keep the zeroed tail.
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    os.replace(part_file, target)
+    return size
@@ -1,276 +1,331 @@
-import asyncio
-import json
-import logging
-import subprocess
-import traceback
-from collections import defaultdict
-from copy import deepcopy
-from pathlib import Path
-
-
-class CutInsertTs:
-    def __init__(self, logger: logging.Logger = logging.getLogger()):
-        self.logger = logger
-
-    @staticmethod
-    def _get_first_ts_path(lines):
-        for line in lines:
-            if not line:
-                continue
-            candidate = line.strip()
-            if candidate.lower().endswith('.ts'):
-                return candidate
-        return None
-
-    @staticmethod
-    def _group_lines(m3u8_path):
-        with Path(m3u8_path).open() as f:
-            content = f.read()
-        file_lines = content.split('\n')
-        groups = []
-        tmp_lines = []
-        for line in file_lines:
-            if line == '#EXT-X-DISCONTINUITY':
-                groups.append(tmp_lines)
-                tmp_lines = []
-            if line == '#EXT-X-ENDLIST':
-                groups.append(tmp_lines)
-                tmp_lines = []
-            tmp_lines.append(line)
-        groups.append(tmp_lines)
-        return groups
-
-    @staticmethod
-    def _get_top_line_info(
-        ts_path,
-        stream_tags='codec_type,width,height,r_frame_rate,sample_rate,start_pts',
-    ):
-        try:
-            cmd = [
-                'ffprobe',
-                '-v',
-                'error',
-                '-print_format',
-                'json',
-                '-read_intervals',
-                '%+0.1',
-                '-show_entries',
-                f'stream={stream_tags}',
-                '-i',
-                ts_path,
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            data = json.loads(result.stdout)
-
-            info = {}
-            streams = data.get('streams')
-            if streams:
-                stream = streams[0]
-                # return ','.join([str(x) for x in stream.values()])
-                # return stream
-                if stream.get('codec_type') == 'video':
-                    info['tag'] = (
-                        f'{stream["width"]}x{stream["height"]},{stream.get("r_frame_rate", "")}'
-                    )
-                    # info['width'] = stream['width']
-                    # info['height'] = stream['height']
-                    # if 'r_frame_rate' in stream:
-                    #     num, den = map(int, stream['r_frame_rate'].split('/'))
-                    #     info['fps'] = str(round(num / den, 2)) if den != 0 else '0'
-                elif stream.get('codec_type') == 'audio':
-                    info['tag'] = str(stream.get('sample_rate'))
-                info['pts'] = stream.get('start_pts', 0)
-
-            return info
-
-        except Exception:
-            traceback.print_exc()
-
-        return {}
-
-    @staticmethod
-    async def _async_get_top_line_info(
-        ts_path,
-        stream_tags='codec_type,width,height,sample_rate,start_pts,start_time',
-    ):
-        cmd = [
-            'ffprobe',
-            '-v',
-            'error',
-            '-print_format',
-            'json',
-            '-read_intervals',
-            '%+0.1',
-            '-show_entries',
-            f'stream={stream_tags}',
-            '-i',
-            ts_path,
-        ]
-
-        process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-
-        stdout, stderr = await process.communicate()
-
-        if process.returncode == 0:
-            data = json.loads(stdout.decode())
-
-            streams = data.get('streams')
-            if streams:
-                info = {}
-                stream = streams[0]
-                if stream.get('codec_type') == 'video':
-                    info['tag'] = f'{stream["width"]}x{stream["height"]}'
-
-                elif stream.get('codec_type') == 'audio':
-                    info['tag'] = str(stream.get('sample_rate'))
-                info['pts'] = stream.get('start_pts', 0)
-
-                return info
-
-        return None
-
-    async def _async_get_line_info(self, lines):
-        _lines = deepcopy(lines)
-        start_ts_path = self._get_first_ts_path(_lines)
-        if not start_ts_path:
-            return None
-        _lines.reverse()
-        end_ts_path = self._get_first_ts_path(_lines)
-        if not end_ts_path:
-            return None
-        start_info = await self._async_get_top_line_info(start_ts_path)
-        if not start_info:
-            return None
-        end_info = self._get_top_line_info(end_ts_path, stream_tags='start_pts')
-        if not end_info:
-            return None
-
-        return {
-            'tag': start_info['tag'],
-            'start_pts': start_info['pts'],
-            'end_pts': end_info['pts'],
-        }
-
-    @staticmethod
-    def gen_cut_path(from_path):
-        path = Path(from_path)
-        return path.parent / f'{path.stem}_cut{path.suffix}'
-
-    def generate_cut_m3u8(self, from_path, group_line_info):
-        cut_file_path = self.gen_cut_path(from_path)
-
-        needed_lines = []
-        for entry in group_line_info:
-            if entry.get('keep'):
-                needed_lines.extend(entry['lines'])
-
-        with open(cut_file_path, 'w') as f:
-            for line in needed_lines:
-                f.write(line)
-                f.write('\n')
-
-    def add_verify_stream_info(self, group_line_info):
-        tag_duration = defaultdict(int)
-        total_duration = 0
-        for entry in group_line_info:
-            info = entry.get('info')
-            if not info:
-                continue
-            duration = entry.get('duration', 0)
-            tag_duration[info['tag']] += duration
-            total_duration += duration
-
-        if total_duration == 0:
-            return False
-
-        tag_pass = {k: v / total_duration > 0.05 for k, v in tag_duration.items()}
-        any_change = False
-        for entry in group_line_info:
-            info = entry.get('info')
-            if info and tag_pass.get(info['tag']) is False:
-                entry['keep'] = False
-                any_change = True
-            elif 'keep' not in entry:
-                entry['keep'] = True
-
-        if any_change:
-            self.logger.info('Use Stream Info Cut')
-
-        return any_change
-
-    def add_verify_pts(self, group_line_info):
-        info_groups = [x for x in group_line_info if x.get('info')]
-        group_count = len(info_groups)
-        max_segment_duration = 0
-        total_duration = 0
-        needed_ids = []
-        for i in range(group_count):
-            a_entry = info_groups[i]
-            a_info = a_entry['info']
-            prev_end = a_info['end_pts']
-            guessed_ids = [a_entry['id']]
-            seg_duration = a_entry.get('duration', 0)
-            total_duration += seg_duration
-
-            for j in range(i + 1, group_count):
-                b_entry = info_groups[j]
-                b_info = b_entry['info']
-
-                if prev_end < b_info['start_pts']:
-                    guessed_ids.append(b_entry['id'])
-                    prev_end = b_info['start_pts']
-                    seg_duration += b_entry.get('duration', 0)
-            if seg_duration > max_segment_duration:
-                max_segment_duration = seg_duration
-                needed_ids = guessed_ids
-
-        any_change = False
-        if needed_ids and 1 - (max_segment_duration / total_duration) < 0.05:
-            for entry in group_line_info:
-                if not entry.get('info'):
-                    continue
-                if entry['id'] not in needed_ids:
-                    entry['keep'] = False
-                    any_change = True
-                elif 'keep' not in entry:
-                    entry['keep'] = True
-
-        if any_change:
-            self.logger.info('Use PTS Cut')
-
-        return any_change
-
-    async def cut(self, file_path):
-        groups = self._group_lines(file_path)
-
-        group_infos = []
-        tasks = []
-        is_vod = False
-        for idx, lines in enumerate(groups):
-            duration = 0
-            for line in lines:
-                if line.strip().startswith('#EXTINF:'):
-                    duration += float(line.strip()[8:].replace(',', ''))
-                if line.strip() == '#EXT-X-PLAYLIST-TYPE:VOD':
-                    is_vod = True
-
-            tasks.append(self._async_get_line_info(lines))
-            group_infos.append({'duration': duration, 'id': idx, 'lines': lines})
-
-        info_list = await asyncio.gather(*tasks)
-        for entry in group_infos:
-            info = info_list[entry['id']]
-            entry['info'] = info
-
-        any_change = False
-        if is_vod:
-            any_change = self.add_verify_stream_info(group_infos)
-            if not any_change:
-                any_change = self.add_verify_pts(group_infos)
-
-        if any_change:
-            self.generate_cut_m3u8(file_path, group_infos)
-
-        return any_change
+import asyncio
+import json
+import logging
+import os
+import traceback
+from bisect import bisect_left
+from collections import defaultdict
+from pathlib import Path
+
+from aiom3u8downloader.playlist import load_playlist, render_media_playlist
+from aiom3u8downloader.tsinfo import probe_ts
+
+PROBE_CACHE_FILENAME = 'probe_cache.json'
+
+
+class ProbeCache(dict):
+    """line infos of fragments, keyed by path, size and mtime.
+
+    Saved as json next to the media playlist, so a re-run of the same job
+    doesn't probe its fragments again.
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def key(ts_path, stream_info=True):
+        try:
+            st = os.stat(ts_path)
+        except OSError:
+            return None
+        kind = 'stream' if stream_info else 'pts'
+        return f'{kind}:{st.st_size}:{st.st_mtime_ns}:{ts_path}'
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self, f)
+        except OSError:
+            traceback.print_exc()
+
+
+class CutInsertTs:
+    """
+    Args:
+        logger: logger.
+        workers: probes running at once, default the cpu count.
+
+    """
+
+    def __init__(self, logger: logging.Logger = logging.getLogger(), workers=None):
+        self.logger = logger
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = ProbeCache()
+        self._probe_slots = None
+
+    @staticmethod
+    def _get_first_ts_path(segments):
+        for segment in segments:
+            if segment.uri.lower().endswith('.ts'):
+                return segment.uri
+        return None
+
+    @staticmethod
+    def _group_lines(m3u8_path):
+        """return (playlist, segment groups split at discontinuities)."""
+        playlist = load_playlist(m3u8_path)
+        return playlist, playlist.discontinuity_groups()
+
+    @staticmethod
+    def _native_line_info(ts_path, stream_info=True):
+        """line info read by tsinfo, None if ffprobe is needed."""
+        stream = probe_ts(ts_path, stream_info=stream_info)
+        if stream is None:
+            return None
+        info = {'pts': stream['start_pts']}
+        if stream_info:
+            if stream['codec_type'] == 'video':
+                info['tag'] = f'{stream["width"]}x{stream["height"]}'
+            else:
+                info['tag'] = stream['sample_rate']
+        return info
+
+    @staticmethod
+    async def _async_get_top_line_info(
+        ts_path,
+        stream_tags='codec_type,width,height,sample_rate,start_pts,start_time',
+    ):
+        cmd = [
+            'ffprobe',
+            '-v',
+            'error',
+            '-print_format',
+            'json',
+            '-read_intervals',
+            '%+0.1',
+            '-show_entries',
+            f'stream={stream_tags}',
+            '-i',
+            ts_path,
+        ]
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except OSError:
+            # e.g. ffprobe is not installed.
+            traceback.print_exc()
+            return None
+
+        stdout, stderr = await process.communicate()
+
+        if process.returncode == 0:
+            data = json.loads(stdout.decode())
+
+            streams = data.get('streams')
+            if streams:
+                info = {}
+                stream = streams[0]
+                if stream.get('codec_type') == 'video':
+                    info['tag'] = f'{stream["width"]}x{stream["height"]}'
+
+                elif stream.get('codec_type') == 'audio':
+                    info['tag'] = str(stream.get('sample_rate'))
+                info['pts'] = stream.get('start_pts', 0)
+
+                return info
+
+        return None
+
+    async def _probe(self, ts_path, stream_info=True):
+        """line info of a fragment, from the cache or the probe pool.
+
+        At most self.workers probes run at once. tsinfo runs on a worker
+        thread, ffprobe only for fragments it can't read.
+        """
+        key = self.cache.key(ts_path, stream_info)
+        if key is not None and key in self.cache:
+            return self.cache[key]
+        async with self._probe_slots:
+            loop = asyncio.get_event_loop()
+            info = await loop.run_in_executor(
+                None, self._native_line_info, ts_path, stream_info
+            )
+            if not info:
+                if stream_info:
+                    info = await self._async_get_top_line_info(ts_path)
+                else:
+                    info = await self._async_get_top_line_info(
+                        ts_path, stream_tags='start_pts'
+                    )
+        if info and key is not None:
+            self.cache[key] = info
+        return info
+
+    async def _async_get_line_info(self, segments):
+        start_ts_path = self._get_first_ts_path(segments)
+        if not start_ts_path:
+            return None
+        end_ts_path = self._get_first_ts_path(reversed(segments))
+        if not end_ts_path:
+            return None
+        start_info, end_info = await asyncio.gather(
+            self._probe(start_ts_path), self._probe(end_ts_path, stream_info=False)
+        )
+        if not start_info or 'tag' not in start_info:
+            return None
+        if not end_info:
+            return None
+
+        return {
+            'tag': start_info['tag'],
+            'start_pts': start_info['pts'],
+            'end_pts': end_info['pts'],
+        }
+
+    @staticmethod
+    def gen_cut_path(from_path):
+        path = Path(from_path)
+        return path.parent / f'{path.stem}_cut{path.suffix}'
+
+    def generate_cut_m3u8(self, from_path, group_line_info, playlist):
+        cut_file_path = self.gen_cut_path(from_path)
+
+        needed_segments = []
+        for entry in group_line_info:
+            if entry.get('keep'):
+                needed_segments.extend(entry['segments'])
+
+        with open(cut_file_path, 'w') as f:
+            f.write(render_media_playlist(playlist, segments=needed_segments))
+
+    def add_verify_stream_info(self, group_line_info):
+        tag_duration = defaultdict(int)
+        total_duration = 0
+        for entry in group_line_info:
+            info = entry.get('info')
+            if not info:
+                continue
+            duration = entry.get('duration', 0)
+            tag_duration[info['tag']] += duration
+            total_duration += duration
+
+        if total_duration == 0:
+            return False
+
+        tag_pass = {k: v / total_duration > 0.05 for k, v in tag_duration.items()}
+        any_change = False
+        for entry in group_line_info:
+            info = entry.get('info')
+            if info and tag_pass.get(info['tag']) is False:
+                entry['keep'] = False
+                any_change = True
+            elif 'keep' not in entry:
+                entry['keep'] = True
+
+        if any_change:
+            self.logger.info('Use Stream Info Cut')
+
+        return any_change
+
+    @staticmethod
+    def _heaviest_pts_chain(info_groups):
+        """return (duration, ids) of the heaviest chain of groups.
+
+        A chain takes groups in playlist order where each group starts after
+        the previous one ended (end_pts < start_pts), and its weight is the
+        summed duration. This is a weighted longest increasing subsequence,
+        solved in O(n log n) with a Fenwick tree of prefix maxima over the
+        sorted end_pts values. Ties go to the chain of earlier groups.
+        """
+        ends = sorted({x['info']['end_pts'] for x in info_groups})
+        # (chain duration, -index of its last group), (-1, 0) for no chain.
+        tree = [(-1, 0)] * (len(ends) + 1)
+        chain = []
+        parent = []
+        for i, entry in enumerate(info_groups):
+            info = entry['info']
+            prev = (-1, 0)
+            k = bisect_left(ends, info['start_pts'])
+            while k > 0:
+                prev = max(prev, tree[k])
+                k -= k & -k
+            duration = entry.get('duration', 0)
+            if prev[0] < 0:
+                chain.append(duration)
+                parent.append(-1)
+            else:
+                chain.append(prev[0] + duration)
+                parent.append(-prev[1])
+            k = bisect_left(ends, info['end_pts']) + 1
+            while k <= len(ends):
+                tree[k] = max(tree[k], (chain[i], -i))
+                k += k & -k
+
+        if not chain:
+            return 0, []
+        best = max(range(len(chain)), key=lambda i: (chain[i], -i))
+        ids = []
+        i = best
+        while i != -1:
+            ids.append(info_groups[i]['id'])
+            i = parent[i]
+        ids.reverse()
+        return chain[best], ids
+
+    def add_verify_pts(self, group_line_info):
+        info_groups = [x for x in group_line_info if x.get('info')]
+        total_duration = sum(x.get('duration', 0) for x in info_groups)
+        max_segment_duration, needed_ids = self._heaviest_pts_chain(info_groups)
+        needed_ids = set(needed_ids)
+
+        any_change = False
+        if (
+            needed_ids
+            and total_duration
+            and 1 - (max_segment_duration / total_duration) < 0.05
+        ):
+            for entry in group_line_info:
+                if not entry.get('info'):
+                    continue
+                if entry['id'] not in needed_ids:
+                    entry['keep'] = False
+                    any_change = True
+                elif 'keep' not in entry:
+                    entry['keep'] = True
+
+        if any_change:
+            self.logger.info('Use PTS Cut')
+
+        return any_change
+
+    async def cut(self, file_path):
+        playlist, groups = self._group_lines(file_path)
+        self.cache = ProbeCache(Path(file_path).parent / PROBE_CACHE_FILENAME)
+        self._probe_slots = asyncio.Semaphore(self.workers)
+
+        group_infos = []
+        tasks = []
+        is_vod = playlist.is_vod
+        for idx, segments in enumerate(groups):
+            duration = sum(x.duration for x in segments)
+            tasks.append(self._async_get_line_info(segments))
+            group_infos.append({'duration': duration, 'id': idx, 'segments': segments})
+
+        info_list = await asyncio.gather(*tasks)
+        self.cache.save()
+        for entry in group_infos:
+            info = info_list[entry['id']]
+            entry['info'] = info
+
+        any_change = False
+        if is_vod:
+            any_change = self.add_verify_stream_info(group_infos)
+            if not any_change:
+                any_change = self.add_verify_pts(group_infos)
+
+        if any_change:
+            self.generate_cut_m3u8(file_path, group_infos, playlist)
+
+        return any_change
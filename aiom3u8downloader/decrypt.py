@@ -0,0 +1,90 @@
+# coding=utf-8
+"""in-process AES-128 segment decryption.
+
+Segments of an AES-128 playlist are encrypted whole with AES-128-CBC and
+PKCS7 padding. The IV is the key's IV attribute, or the segment's media
+sequence number as a 16 byte big-endian integer (RFC 8216 section 5.2).
+
+Decryption needs the optional cryptography package:
+
+    pip install aiom3u8downloader[decrypt]
+
+"""
+
+import os
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+DECRYPT_CHUNK_SIZE = 1024 * 1024
+# inserted before the extension of a decrypted segment, so it never shares
+# a file with the encrypted download of a run without decryption.
+DECRYPTED_SUFFIX = '.dec'
+
+
+def is_available():
+    return Cipher is not None
+
+
+def unsupported_reason(playlist):
+    """return why playlist can't be decrypted in-process, None if it can."""
+    if not is_available():
+        return 'the cryptography package is not installed'
+    for key in playlist.keys():
+        if key.method != 'AES-128':
+            return 'METHOD=%s is not supported' % key.method
+        if key.keyformat not in (None, 'identity'):
+            return 'KEYFORMAT=%s is not supported' % key.keyformat
+    if any(x.byterange is not None and x.key is not None for x in playlist.segments):
+        return 'encrypted byte range segments are not supported'
+    if any(x.key is not None for x in playlist.init_sections()):
+        return 'encrypted EXT-X-MAP init sections are not supported'
+    return None
+
+
+def decrypted_path(path):
+    """return the path of the decrypted copy of segment file path."""
+    root, ext = os.path.splitext(path)
+    return root + DECRYPTED_SUFFIX + ext
+
+
+def segment_iv(key, seq):
+    """return the 16 byte IV of a segment encrypted with key."""
+    if key.iv:
+        value = key.iv[2:] if key.iv[:2].lower() == '0x' else key.iv
+        return bytes.fromhex(value.rjust(32, '0'))
+    return seq.to_bytes(16, 'big')
+
+
+def load_key(path):
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) != 16:
+        raise ValueError('AES-128 key must be 16 bytes, got %s: %s' % (len(key), path))
+    return key
+
+
+def decrypt_file(src, dst, key, iv):
+    """decrypt src into dst, dst only appears once complete.
+
+    Raises:
+        ValueError: on bad padding, e.g. a wrong key or a truncated file.
+
+    """
+    decryptor = Cipher(
+        algorithms.AES(key), modes.CBC(iv), backend=default_backend()
+    ).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    part_file = dst + '.part'
+    with open(src, 'rb') as fin, open(part_file, 'wb') as fout:
+        while True:
+            chunk = fin.read(DECRYPT_CHUNK_SIZE)
+            if not chunk:
+                break
+            fout.write(unpadder.update(decryptor.update(chunk)))
+        fout.write(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+    os.replace(part_file, dst)
@@ -0,0 +1,96 @@
+# coding=utf-8
+"""per job download journal.
+
+The journal lives in the job's subtempdir and records every finished
+fragment with its size, so a restarted run knows what is done without
+requesting it again. A fragment whose file lost its journaled size is
+downloaded again.
+
+"""
+
+import os
+import sqlite3
+
+JOURNAL_FILENAME = 'journal.sqlite3'
+
+STATUS_DONE = 'done'
+
+
+def has_journaled_size(local_file, size, range_end=None):
+    """return True if local_file still has the size journaled for it.
+
+    Args:
+        range_end: end offset of a byte range, whose sparse file is shared
+                   with other ranges and must only reach it.
+
+    """
+    try:
+        actual = os.path.getsize(local_file)
+    except OSError:
+        return False
+    if range_end is not None:
+        return actual >= range_end
+    return actual == size
+
+
+class DownloadJournal:
+    """sqlite backed record of downloaded fragments.
+
+    Rows are committed in batches of commit_every, uncommitted rows lost on a
+    crash are harmless: the fragment files are complete (see .part handling)
+    and they are reused and journaled again on the next run.
+
+    """
+
+    def __init__(self, subtempdir, commit_every=50):
+        self.path = os.path.join(subtempdir, JOURNAL_FILENAME)
+        self.commit_every = commit_every
+        self._pending = 0
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fragments ('
+            ' url TEXT PRIMARY KEY,'
+            ' seq INTEGER,'
+            ' local_file TEXT,'
+            ' size INTEGER,'
+            ' checksum TEXT,'
+            ' status TEXT)'
+        )
+        self.conn.commit()
+
+    def done_fragments(self):
+        """return {url: (seq, local_file, size, checksum)} of done fragments."""
+        cur = self.conn.execute(
+            'SELECT url, seq, local_file, size, checksum FROM fragments'
+            ' WHERE status = ?',
+            (STATUS_DONE,),
+        )
+        return {row[0]: tuple(row[1:]) for row in cur}
+
+    def mark_done(self, url, seq, local_file, size, checksum=None):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO fragments'
+            ' (url, seq, local_file, size, checksum, status)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (url, seq, local_file, size, checksum, STATUS_DONE),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def forget(self, url):
+        self.conn.execute('DELETE FROM fragments WHERE url = ?', (url,))
+        self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.commit()
+        self.conn.close()
+        self.conn = None
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""live and EVENT playlist recording.
+
+A live media playlist only lists a sliding window of segments. LiveRecording
+keeps track of what has been seen across playlist reloads (by
+#EXT-X-MEDIA-SEQUENCE) and collects the recorded segments into one
+MediaPlaylist, which is written as a local VOD playlist at the end.
+
+"""
+
+import copy
+import time
+
+from aiom3u8downloader.playlist import MediaPlaylist
+
+
+def is_live_playlist(playlist):
+    """return True if the MediaPlaylist can still grow."""
+    return not playlist.endlist
+
+
+class LiveRecording:
+    """state of one live playlist recording.
+
+    Args:
+        url: media playlist url.
+        max_time: stop polling after this many seconds, None for no limit.
+        max_size: stop polling after this many downloaded bytes, None for no
+                  limit.
+
+    """
+
+    def __init__(self, url, max_time=None, max_size=None):
+        self.url = url
+        self.max_time = max_time
+        self.max_size = max_size
+        self.started = time.monotonic()
+        self.downloaded_bytes = 0
+        self.recorded = MediaPlaylist(url)
+        self.recorded.target_duration = 10.0
+        self.recorded.playlist_type = 'VOD'
+        self.recorded.endlist = True
+        self.last_seq = None
+        self.missed = 0
+        self.ended = False
+        self.etag = None
+        self.last_modified = None
+
+    @property
+    def segments(self):
+        return self.recorded.segments
+
+    def update(self, playlist):
+        """merge a reloaded MediaPlaylist.
+
+        Return:
+            list of Segment that have not been seen before.
+
+        """
+        if playlist.target_duration:
+            self.recorded.target_duration = playlist.target_duration
+        if playlist.version is not None:
+            self.recorded.version = playlist.version
+        if not self.recorded.header_tags:
+            self.recorded.header_tags = playlist.header_tags
+        self.ended = playlist.endlist
+        new_segments = [
+            x
+            for x in playlist.segments
+            if self.last_seq is None or x.seq > self.last_seq
+        ]
+        if new_segments:
+            first = new_segments[0].seq
+            if self.last_seq is not None and first > self.last_seq + 1:
+                # segments slid out of the window between two reloads.
+                self.missed += first - self.last_seq - 1
+                new_segments[0].discontinuity = True
+            self.last_seq = new_segments[-1].seq
+            self.recorded.segments.extend(new_segments)
+        return new_segments
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def remember_validators(self, headers):
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+
+    def poll_interval(self, changed):
+        """reload interval, see RFC 8216 section 6.3.4."""
+        if changed:
+            return self.recorded.target_duration
+        return self.recorded.target_duration / 2
+
+    def limit_reached(self):
+        if self.max_time and time.monotonic() - self.started >= self.max_time:
+            return True
+        if self.max_size and self.downloaded_bytes >= self.max_size:
+            return True
+        return False
+
+    def recorded_playlist(self, done_urls):
+        """return a VOD MediaPlaylist of recorded segments in done_urls."""
+        playlist = copy.copy(self.recorded)
+        segments = []
+        prev_seq = None
+        for segment in self.recorded.segments:
+            if segment.url not in done_urls:
+                continue
+            if prev_seq is not None and segment.seq != prev_seq + 1:
+                segment.discontinuity = True
+            prev_seq = segment.seq
+            segments.append(segment)
+        playlist.segments = segments
+        return playlist
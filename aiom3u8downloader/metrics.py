@@ -0,0 +1,457 @@
+# coding=utf-8
+"""download metrics of a batch, broken down by job and host.
+
+Metrics keeps counters, gauges and histograms in plain dicts keyed by label
+values, updating them is a dict lookup. MetricsExporter serves them in the
+Prometheus text format at http://HOST:PORT/metrics and/or writes them as
+json to a file every few seconds, so a fleet of downloader processes can be
+watched for hot or slow origins.
+
+Jobs are labelled by their url without query string, as queries often
+carry access tokens. When a job ends its counters and histograms are folded
+into the FINISHED_JOB label and its gauges dropped, so a long-lived
+downloader keeps series of running jobs only.
+
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit, urlunsplit
+
+from aiohttp import web
+
+BYTES = 'aiom3u8_bytes_total'
+REQUESTS = 'aiom3u8_requests_total'
+ERRORS = 'aiom3u8_request_errors_total'
+RETRIES = 'aiom3u8_retries_total'
+FRAGMENTS = 'aiom3u8_fragments_total'
+FRAGMENT_SECONDS = 'aiom3u8_fragment_seconds'
+TTFB_SECONDS = 'aiom3u8_ttfb_seconds'
+INFLIGHT = 'aiom3u8_inflight_requests'
+QUEUED = 'aiom3u8_queued_requests'
+JOB_FRAGMENTS = 'aiom3u8_job_fragments'
+JOB_FRAGMENTS_DONE = 'aiom3u8_job_fragments_done'
+JOB_ETA_SECONDS = 'aiom3u8_job_eta_seconds'
+JOB_BYTES_PER_SECOND = 'aiom3u8_job_bytes_per_second'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# name -> (type, help, label names)
+DEFINITIONS = {
+    BYTES: (COUNTER, 'response body bytes received', ('job', 'host')),
+    REQUESTS: (COUNTER, 'requests sent', ('job', 'host')),
+    ERRORS: (COUNTER, 'failed requests by cause', ('job', 'host', 'cause')),
+    RETRIES: (COUNTER, 'retried requests by cause', ('job', 'host', 'cause')),
+    FRAGMENTS: (COUNTER, 'fragment downloads by result', ('job', 'host', 'result')),
+    FRAGMENT_SECONDS: (
+        HISTOGRAM,
+        'fragment download time including retries',
+        ('job', 'host'),
+    ),
+    TTFB_SECONDS: (HISTOGRAM, 'time to response headers', ('job', 'host')),
+    INFLIGHT: (GAUGE, 'requests holding a connection slot', ('job', 'host')),
+    QUEUED: (GAUGE, 'requests waiting for a connection slot', ('job', 'host')),
+    JOB_FRAGMENTS: (GAUGE, 'fragments of the job known so far', ('job',)),
+    JOB_FRAGMENTS_DONE: (GAUGE, 'fragments of the job on disk', ('job',)),
+    JOB_ETA_SECONDS: (GAUGE, 'estimated seconds until the job is downloaded', ('job',)),
+    JOB_BYTES_PER_SECOND: (GAUGE, 'average download rate of the job', ('job',)),
+}
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+RESULT_OK = 'ok'
+RESULT_FAILED = 'failed'
+
+# job label of the totals of finished jobs.
+FINISHED_JOB = '(finished)'
+
+
+def url_label(url):
+    """return url without query and fragment."""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape_label(v)) for k, v in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Histogram:
+    """cumulative bucket counts, sum and count of observations."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i] observations <= buckets[i], the last one for +Inf.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        """add the observations of other, with the same buckets."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative(self):
+        """return [(upper bound, cumulative count)] including +Inf."""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def percentile(self, p):
+        """upper bound of the bucket holding the p (0-100) percentile."""
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class JobProgress:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.success = None
+        self.total = 0
+        self.done = 0
+        # fragments reused from an earlier run, they don't count for the rate.
+        self.resumed = None
+
+    def update(self, done, total):
+        if self.resumed is None:
+            self.resumed = done
+        self.done = done
+        self.total = total
+
+    def finish(self, success):
+        self.finished = time.monotonic()
+        self.success = bool(success)
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def eta(self):
+        """estimated seconds until all known fragments are done."""
+        if self.finished:
+            return 0.0
+        fetched = self.done - (self.resumed or 0)
+        if fetched <= 0:
+            return None
+        return (self.total - self.done) * self.elapsed() / fetched
+
+
+class Metrics:
+    """metrics of one AioM3u8Downloader.
+
+    All methods are called from the event loop thread.
+    """
+
+    def __init__(self):
+        # name -> {label values: value}
+        self.values = {name: {} for name in DEFINITIONS}
+        self.jobs = {}
+        # finished jobs by state, their series are folded into FINISHED_JOB.
+        self.finished_jobs = {'done': 0, 'failed': 0}
+
+    def inc(self, name, labels, value=1):
+        series = self.values[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def add(self, name, labels, value):
+        """add value to a gauge, negative to decrease it."""
+        self.inc(name, labels, value)
+
+    def set(self, name, labels, value):
+        self.values[name][labels] = value
+
+    def observe(self, name, labels, value):
+        series = self.values[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+
+    def slot(self, slot, labels):
+        """wrap a limiter slot, counting queued and in-flight requests."""
+        return _TrackedSlot(self, slot, labels)
+
+    def job_started(self, job_url):
+        """return the JobProgress of a new job, to be updated by the caller."""
+        progress = self.jobs[url_label(job_url)] = JobProgress()
+        return progress
+
+    def job_finished(self, job_url):
+        """fold the series of a finished job into the FINISHED_JOB label."""
+        job = url_label(job_url)
+        progress = self.jobs.pop(job, None)
+        if progress is not None:
+            self.finished_jobs['done' if progress.success else 'failed'] += 1
+        for name, (kind, _, _) in DEFINITIONS.items():
+            series = self.values[name]
+            for labels in [x for x in series if x[0] == job]:
+                value = series.pop(labels)
+                folded = (FINISHED_JOB,) + labels[1:]
+                if kind == COUNTER:
+                    self.inc(name, folded, value)
+                elif kind == HISTOGRAM:
+                    series.setdefault(folded, Histogram()).merge(value)
+                # gauges only describe running jobs.
+
+    def job_bytes(self, job):
+        return sum(v for k, v in self.values[BYTES].items() if k[0] == job)
+
+    def update_job_gauges(self):
+        for job, progress in self.jobs.items():
+            labels = (job,)
+            self.set(JOB_FRAGMENTS, labels, progress.total)
+            self.set(JOB_FRAGMENTS_DONE, labels, progress.done)
+            eta = progress.eta()
+            if eta is not None:
+                self.set(JOB_ETA_SECONDS, labels, eta)
+            self.set(
+                JOB_BYTES_PER_SECOND,
+                labels,
+                self.job_bytes(job) / max(progress.elapsed(), 1e-6),
+            )
+
+    def render_prometheus(self):
+        """return all metrics in the Prometheus text exposition format."""
+        self.update_job_gauges()
+        lines = []
+        for name, (kind, help_text, label_names) in DEFINITIONS.items():
+            series = self.values[name]
+            if not series:
+                continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(series.items()):
+                if kind != HISTOGRAM:
+                    formatted = format_labels(label_names, labels)
+                    lines.append('%s%s %s' % (name, formatted, format_value(value)))
+                    continue
+                for bound, count in value.cumulative():
+                    le = (('le', format_value(float(bound))),)
+                    lines.append(
+                        '%s_bucket%s %d'
+                        % (name, format_labels(label_names, labels, le), count)
+                    )
+                formatted = format_labels(label_names, labels)
+                lines.append('%s_sum%s %s' % (name, formatted, format_value(value.sum)))
+                lines.append('%s_count%s %d' % (name, formatted, value.count))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """return metrics as a json serializable dict.
+
+        Besides every series, "jobs" and "hosts" hold ready made summaries.
+        """
+        self.update_job_gauges()
+        series_json = {}
+        for name, (kind, _, label_names) in DEFINITIONS.items():
+            entries = []
+            for labels, value in sorted(self.values[name].items()):
+                entry = {'labels': dict(zip(label_names, labels))}
+                if kind == HISTOGRAM:
+                    entry['buckets'] = [
+                        [format_value(float(bound)), count]
+                        for bound, count in value.cumulative()
+                    ]
+                    entry['sum'] = value.sum
+                    entry['count'] = value.count
+                else:
+                    entry['value'] = value
+                entries.append(entry)
+            if entries:
+                series_json[name] = entries
+
+        jobs = {}
+        for job, progress in self.jobs.items():
+            jobs[job] = {
+                'fragments': progress.total,
+                'fragments_done': progress.done,
+                'bytes': self.job_bytes(job),
+                'elapsed_seconds': progress.elapsed(),
+                'bytes_per_second': self.values[JOB_BYTES_PER_SECOND].get((job,), 0),
+                'eta_seconds': progress.eta(),
+                'state': (
+                    'running'
+                    if progress.finished is None
+                    else ('done' if progress.success else 'failed')
+                ),
+            }
+
+        hosts = {}
+
+        def host_entry(host):
+            return hosts.setdefault(
+                host,
+                {'bytes': 0, 'requests': 0, 'errors': 0, 'retries': 0, 'inflight': 0},
+            )
+
+        for name, key in (
+            (BYTES, 'bytes'),
+            (REQUESTS, 'requests'),
+            (ERRORS, 'errors'),
+            (RETRIES, 'retries'),
+            (INFLIGHT, 'inflight'),
+        ):
+            for labels, value in self.values[name].items():
+                host_entry(labels[1])[key] += value
+        ttfb = {}
+        for (_, host), histogram in self.values[TTFB_SECONDS].items():
+            ttfb.setdefault(host, Histogram()).merge(histogram)
+        for host, histogram in ttfb.items():
+            host_entry(host)['ttfb_p50_seconds'] = histogram.percentile(50)
+            host_entry(host)['ttfb_p95_seconds'] = histogram.percentile(95)
+
+        return {
+            'time': time.time(),
+            'jobs': jobs,
+            'finished_jobs': dict(self.finished_jobs),
+            'hosts': hosts,
+            'series': series_json,
+        }
+
+
+class _TrackedSlot:
+    def __init__(self, metrics, slot, labels):
+        self.metrics = metrics
+        self.slot = slot
+        self.labels = labels
+
+    async def __aenter__(self):
+        self.metrics.add(QUEUED, self.labels, 1)
+        try:
+            await self.slot.__aenter__()
+        finally:
+            self.metrics.add(QUEUED, self.labels, -1)
+        self.metrics.add(INFLIGHT, self.labels, 1)
+        self.metrics.inc(REQUESTS, self.labels)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.metrics.add(INFLIGHT, self.labels, -1)
+        return await self.slot.__aexit__(exc_type, exc, tb)
+
+
+class MetricsExporter:
+    """expose Metrics while a batch runs.
+
+    Args:
+        metrics: the Metrics to expose.
+        port: serve Prometheus text at http://host:port/metrics, None to not
+              serve.
+        host: address to listen on.
+        path: json file rewritten every interval seconds, None to not write.
+        interval: seconds between json writes.
+        logger: logger.
+
+    """
+
+    def __init__(
+        self,
+        metrics,
+        port=None,
+        host='127.0.0.1',
+        path=None,
+        interval=5.0,
+        logger: logging.Logger = logging.getLogger(),
+    ):
+        self.metrics = metrics
+        self.logger = logger
+        self.port = port
+        self.host = host
+        self.path = path
+        self.interval = interval
+        self._runner = None
+        self._writer = None
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            body=self.metrics.render_prometheus().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        )
+
+    def write_json(self):
+        part_file = self.path + '.part'
+        with open(part_file, 'w') as f:
+            json.dump(self.metrics.to_json(), f, indent=2)
+        os.replace(part_file, self.path)
+
+    async def _write_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write_json()
+            except OSError as e:
+                # keep downloading, the next write may work again.
+                self.logger.warning('writing metrics to %s failed: %s', self.path, e)
+
+    async def start(self):
+        if self.port is not None:
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle_metrics)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            self.logger.info(
+                'serving metrics at http://%s:%s/metrics', self.host, self.port
+            )
+        if self.path:
+            self._writer = asyncio.ensure_future(self._write_periodically())
+
+    async def stop(self):
+        """stop serving, and write the final state of the json file."""
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+            self.write_json()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
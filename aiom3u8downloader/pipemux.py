@@ -0,0 +1,158 @@
+# coding=utf-8
+"""mux fragments while they are being downloaded.
+
+PipedMuxer starts ffmpeg reading MPEG-TS from stdin, and feeds it every
+fragment in playlist order as soon as the contiguous prefix of the playlist
+is on disk. Downloads may only run window fragments ahead of the feeder, so
+the amount of finished but not yet fed fragments stays bounded.
+
+"""
+
+import asyncio
+import logging
+import os
+from collections import deque
+
+FEED_CHUNK_SIZE = 1024 * 1024
+
+
+class PipedMuxer:
+    def __init__(
+        self,
+        target_mp4,
+        window=256,
+        logger: logging.Logger = logging.getLogger(),
+    ):
+        self.target_mp4 = target_mp4
+        self.window = max(1, window)
+        self.logger = logger
+        self.total = 0
+        self.next_seq = 0
+        self.ready = {}
+        self.skipped = 0
+        self.broken = False
+        self.proc = None
+        self._cond = asyncio.Condition()
+        self._feeder = None
+        self._stderr_task = None
+        self._stderr_tail = deque(maxlen=50)
+
+    def command(self):
+        return [
+            'ffmpeg',
+            '-loglevel',
+            'info',
+            '-fflags',
+            '+genpts',
+            '-f',
+            'mpegts',
+            '-i',
+            'pipe:0',
+            '-acodec',
+            'copy',
+            '-vcodec',
+            'copy',
+            '-bsf:a',
+            'aac_adtstoasc',
+            self.target_mp4,
+        ]
+
+    async def start(self, total):
+        """start ffmpeg and the feeder for a playlist of total fragments."""
+        self.total = total
+        cmd = self.command()
+        self.logger.info('Running: %s', cmd)
+        self.proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        # ffmpeg blocks once its stderr pipe is full, keep draining it.
+        self._stderr_task = asyncio.ensure_future(self._drain_stderr())
+        self._feeder = asyncio.ensure_future(self._feed())
+
+    async def _drain_stderr(self):
+        async for line in self.proc.stderr:
+            self._stderr_tail.append(line.decode('utf-8', 'replace').rstrip())
+
+    async def wait_turn(self, seq):
+        """wait until fragment seq is inside the reorder window."""
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self.broken or seq < self.next_seq + self.window
+            )
+        if self.broken:
+            raise RuntimeError('ffmpeg pipe is closed')
+
+    async def fragment_done(self, seq, local_file):
+        """hand over a finished fragment, local_file is None if it failed."""
+        async with self._cond:
+            self.ready[seq] = local_file
+            self._cond.notify_all()
+
+    async def _feed(self):
+        try:
+            await self._feed_fragments()
+        except Exception:
+            # wake up downloads waiting for their turn so they fail fast.
+            async with self._cond:
+                self.broken = True
+                self._cond.notify_all()
+            raise
+
+    async def _feed_fragments(self):
+        while self.next_seq < self.total:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.next_seq in self.ready)
+                local_file = self.ready.pop(self.next_seq)
+            if local_file is None:
+                self.skipped += 1
+                self.logger.warning('pipe mux skips failed fragment #%s', self.next_seq)
+            else:
+                with open(local_file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(FEED_CHUNK_SIZE), b''):
+                        self.proc.stdin.write(chunk)
+                        await self.proc.stdin.drain()
+            async with self._cond:
+                self.next_seq += 1
+                self._cond.notify_all()
+        self.proc.stdin.close()
+
+    async def finish(self):
+        """wait until every fragment is fed and ffmpeg exits.
+
+        Return:
+            ffmpeg exit code.
+
+        """
+        try:
+            await self._feeder
+        except Exception:
+            # e.g. ffmpeg exited early, its exit code tells why.
+            self.logger.exception('feeding ffmpeg failed')
+            if self.proc.stdin and not self.proc.stdin.is_closing():
+                self.proc.stdin.close()
+        await self._stderr_task
+        returncode = await self.proc.wait()
+        if self.broken and returncode == 0:
+            returncode = 1
+        if returncode != 0:
+            self.logger.error('---------------------------------------------')
+            self.logger.error(f'run ffmpeg command failed: exitcode={returncode}')
+            if self._stderr_tail:
+                self.logger.error('=> ' + '\n'.join(self._stderr_tail))
+            self.logger.error('---------------------------------------------')
+        return returncode
+
+    async def abort(self):
+        """stop ffmpeg and remove the incomplete output."""
+        if self._feeder:
+            self._feeder.cancel()
+        if self.proc and self.proc.returncode is None:
+            self.proc.kill()
+            await self.proc.wait()
+        if self._stderr_task:
+            await asyncio.gather(self._stderr_task, return_exceptions=True)
+        if os.path.exists(self.target_mp4):
+            os.remove(self.target_mp4)
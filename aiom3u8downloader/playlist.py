@@ -0,0 +1,465 @@
+# coding=utf-8
+"""HLS playlist model.
+
+parse_playlist() reads a master or media playlist in a single pass and
+returns a compact model, every stage of the downloader works from it:
+choosing a variant, downloading keys and segments, writing the local
+playlist and cutting ads.
+
+"""
+
+import re
+from urllib.parse import urljoin
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+KEY_URI_PATTERN = re.compile(r'^(.*URI=")([^"]+)(".*)$')
+
+# playlist level tags written back unchanged, other unknown tags are kept
+# with the segment they precede.
+HEADER_TAGS = (
+    '#EXT-X-INDEPENDENT-SEGMENTS',
+    '#EXT-X-ALLOW-CACHE',
+    '#EXT-X-DISCONTINUITY-SEQUENCE',
+    '#EXT-X-START',
+)
+
+
+class UrlResolver:
+    """urljoin against one base url, with a fast path for plain relative
+    uris like "seg-1.ts" that make up almost all of a large playlist."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.base_dir = urljoin(base_url, '.') if base_url else ''
+
+    def __call__(self, uri):
+        if (
+            self.base_dir
+            and uri[0] not in './?#'
+            and ':' not in uri
+            and '/.' not in uri
+        ):
+            return self.base_dir + uri
+        return urljoin(self.base_url, uri)
+
+
+def parse_attributes(value):
+    """parse an attribute list like 'METHOD=AES-128,URI="k.key"'."""
+    attrs = {}
+    for name, attr_value in ATTRIBUTE_PATTERN.findall(value):
+        if attr_value.startswith('"') and attr_value.endswith('"'):
+            attr_value = attr_value[1:-1]
+        attrs[name] = attr_value
+    return attrs
+
+
+def parse_byterange(value):
+    """parse '<length>[@<offset>]', return (length, offset or None)."""
+    length, _, offset = value.partition('@')
+    return int(length), int(offset) if offset else None
+
+
+class Key:
+    """an #EXT-X-KEY, shared by all segments it applies to."""
+
+    __slots__ = ('line', 'method', 'uri', 'url', 'iv', 'keyformat')
+
+    def __init__(self, line, base_url):
+        self.line = line
+        attrs = parse_attributes(line[len('#EXT-X-KEY:'):])
+        self.method = attrs.get('METHOD', 'NONE')
+        self.uri = attrs.get('URI')
+        self.url = urljoin(base_url, self.uri) if self.uri else None
+        self.iv = attrs.get('IV')
+        self.keyformat = attrs.get('KEYFORMAT')
+
+
+class InitSection:
+    """an #EXT-X-MAP, shared by all segments it applies to."""
+
+    __slots__ = ('line', 'uri', 'url', 'byterange', 'key')
+
+    def __init__(self, line, base_url, key=None):
+        self.line = line
+        # Key in effect at the EXT-X-MAP, the init section is encrypted too.
+        self.key = key
+        attrs = parse_attributes(line[len('#EXT-X-MAP:'):])
+        self.uri = attrs.get('URI')
+        self.url = urljoin(base_url, self.uri) if self.uri else None
+        self.byterange = (
+            parse_byterange(attrs['BYTERANGE']) if 'BYTERANGE' in attrs else None
+        )
+
+
+class Segment:
+    """a media segment.
+
+    Attributes:
+        uri: the uri line as written in the playlist.
+        url: absolute url of the segment.
+        seq: media sequence number.
+        duration: EXTINF duration in seconds.
+        extinf: the raw EXTINF line, kept to rewrite it unchanged.
+        byterange: (length, offset) of EXT-X-BYTERANGE or None.
+        key: Key in effect, None if not encrypted.
+        map: InitSection in effect or None.
+        discontinuity: True if an EXT-X-DISCONTINUITY precedes it.
+        tags: other tags in front of the segment, e.g. PROGRAM-DATE-TIME.
+
+    """
+
+    __slots__ = (
+        'uri',
+        'url',
+        'seq',
+        'duration',
+        'extinf',
+        'byterange',
+        'key',
+        'map',
+        'discontinuity',
+        'tags',
+    )
+
+    def __init__(
+        self, uri, url, seq, duration, extinf, byterange, key, map_, discontinuity, tags
+    ):
+        self.uri = uri
+        self.url = url
+        self.seq = seq
+        self.duration = duration
+        self.extinf = extinf
+        self.byterange = byterange
+        self.key = key
+        self.map = map_
+        self.discontinuity = discontinuity
+        self.tags = tags
+
+
+class Variant:
+    __slots__ = ('uri', 'url', 'resolution', 'bandwidth', 'attrs')
+
+    def __init__(self, uri, url, attrs):
+        self.uri = uri
+        self.url = url
+        self.attrs = attrs
+        self.resolution = attrs.get('RESOLUTION')
+        self.bandwidth = int(attrs['BANDWIDTH']) if 'BANDWIDTH' in attrs else None
+
+
+class MasterPlaylist:
+    is_master = True
+
+    def __init__(self, url):
+        self.url = url
+        self.variants = []
+
+
+class MediaPlaylist:
+    is_master = False
+
+    def __init__(self, url):
+        self.url = url
+        self.version = None
+        self.target_duration = None
+        self.media_sequence = 0
+        self.playlist_type = None
+        self.endlist = False
+        # other playlist level tags, written back unchanged.
+        self.header_tags = []
+        self.segments = []
+
+    @property
+    def is_vod(self):
+        return self.playlist_type == 'VOD'
+
+    @property
+    def duration(self):
+        return sum(x.duration for x in self.segments)
+
+    @property
+    def is_fmp4(self):
+        """True if every segment is an fMP4 fragment of an EXT-X-MAP."""
+        return bool(self.segments) and all(x.map is not None for x in self.segments)
+
+    def keys(self):
+        """return distinct keys in playlist order, METHOD=NONE excluded."""
+        keys = []
+        seen = set()
+        for segment in self.segments:
+            key = segment.key
+            if key is not None and id(key) not in seen:
+                seen.add(id(key))
+                keys.append(key)
+        return keys
+
+    def init_sections(self):
+        """return distinct EXT-X-MAP sections in playlist order."""
+        sections = []
+        seen = set()
+        for segment in self.segments:
+            section = segment.map
+            if section is not None and id(section) not in seen:
+                seen.add(id(section))
+                sections.append(section)
+        return sections
+
+    def discontinuity_groups(self):
+        """split segments at every EXT-X-DISCONTINUITY."""
+        groups = []
+        current = []
+        for segment in self.segments:
+            if segment.discontinuity:
+                groups.append(current)
+                current = []
+            current.append(segment)
+        groups.append(current)
+        return groups
+
+
+def is_master_content(content):
+    return '#EXT-X-STREAM-INF' in content
+
+
+def parse_playlist(content, url):
+    """parse playlist text in a single pass.
+
+    Args:
+        content: playlist text.
+        url: playlist url, relative uris are resolved against it.
+
+    Return:
+        MasterPlaylist or MediaPlaylist.
+
+    """
+    if is_master_content(content):
+        return _parse_master(content, url)
+    return _parse_media(content, url)
+
+
+def _parse_master(content, url):
+    playlist = MasterPlaylist(url)
+    attrs = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line.startswith('#EXT-X-STREAM-INF:'):
+                attrs = parse_attributes(line[len('#EXT-X-STREAM-INF:'):])
+            continue
+        playlist.variants.append(Variant(line, urljoin(url, line), attrs or {}))
+        attrs = None
+    return playlist
+
+
+def _parse_media(content, url):
+    playlist = MediaPlaylist(url)
+    resolve = UrlResolver(url)
+    segments = playlist.segments
+    header_tags = playlist.header_tags
+    key = None
+    map_ = None
+    duration = 0.0
+    extinf = None
+    byterange = None
+    discontinuity = False
+    tags = []
+    seq = None
+    # per uri end offset of the previous byte range, see RFC 8216 4.3.2.2.
+    range_end = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != '#':
+            segment_url = resolve(line)
+            if byterange is not None:
+                length, offset = byterange
+                if offset is None:
+                    offset = range_end.get(segment_url, 0)
+                range_end[segment_url] = offset + length
+                byterange = (length, offset)
+            seq = playlist.media_sequence if seq is None else seq + 1
+            segments.append(
+                Segment(
+                    line,
+                    segment_url,
+                    seq,
+                    duration,
+                    extinf,
+                    byterange,
+                    key,
+                    map_,
+                    discontinuity,
+                    tags,
+                )
+            )
+            duration = 0.0
+            extinf = None
+            byterange = None
+            discontinuity = False
+            tags = []
+            continue
+        tag, _, value = line.partition(':')
+        if tag == '#EXTINF':
+            extinf = line
+            duration = float(value.split(',', 1)[0] or 0)
+        elif tag == '#EXT-X-BYTERANGE':
+            byterange = parse_byterange(value)
+        elif tag == '#EXT-X-KEY':
+            key = None if 'METHOD=NONE' in value else Key(line, url)
+        elif tag == '#EXT-X-MAP':
+            map_ = InitSection(line, url, key)
+        elif tag == '#EXT-X-DISCONTINUITY':
+            discontinuity = True
+        elif tag == '#EXT-X-MEDIA-SEQUENCE':
+            playlist.media_sequence = int(value)
+        elif tag == '#EXT-X-TARGETDURATION':
+            playlist.target_duration = float(value)
+        elif tag == '#EXT-X-VERSION':
+            playlist.version = int(value)
+        elif tag == '#EXT-X-PLAYLIST-TYPE':
+            playlist.playlist_type = value
+        elif tag == '#EXT-X-ENDLIST':
+            playlist.endlist = True
+        elif tag == '#EXTM3U':
+            pass
+        elif not segments and tag in HEADER_TAGS:
+            header_tags.append(line)
+        else:
+            tags.append(line)
+    return playlist
+
+
+def render_media_playlist(
+    playlist,
+    segment_uri=None,
+    key_line=None,
+    map_line=None,
+    segments=None,
+    playlist_type=None,
+    endlist=None,
+):
+    """return playlist text for a MediaPlaylist.
+
+    Args:
+        playlist: the MediaPlaylist.
+        segment_uri: function(segment) returning the uri line to write,
+                     default the original uri.
+        key_line: function(key) returning the EXT-X-KEY line to write.
+        map_line: function(init_section) returning the EXT-X-MAP line.
+        segments: subset of playlist.segments to write, default all.
+        playlist_type: overrides playlist.playlist_type.
+        endlist: overrides playlist.endlist.
+
+    """
+    if segments is None:
+        segments = playlist.segments
+    playlist_type = playlist_type or playlist.playlist_type
+    endlist = playlist.endlist if endlist is None else endlist
+    lines = ['#EXTM3U']
+    if playlist.version is not None:
+        lines.append('#EXT-X-VERSION:%d' % playlist.version)
+    if playlist.target_duration is not None:
+        lines.append('#EXT-X-TARGETDURATION:%g' % playlist.target_duration)
+    lines.append(
+        '#EXT-X-MEDIA-SEQUENCE:%d'
+        % (segments[0].seq if segments else playlist.media_sequence)
+    )
+    if playlist_type:
+        lines.append('#EXT-X-PLAYLIST-TYPE:%s' % playlist_type)
+    lines.extend(playlist.header_tags)
+    append = lines.append
+    # compare raw lines, segments of reloaded live playlists carry equal
+    # but distinct Key objects.
+    current_key = None
+    current_map = None
+    for segment in segments:
+        if segment.discontinuity:
+            append('#EXT-X-DISCONTINUITY')
+        segment_key = segment.key.line if segment.key else None
+        if segment_key != current_key:
+            if segment.key is None:
+                append('#EXT-X-KEY:METHOD=NONE')
+            else:
+                append(key_line(segment.key) if key_line else segment_key)
+            current_key = segment_key
+        if segment.map is not None and segment.map.line != current_map:
+            append(map_line(segment.map) if map_line else segment.map.line)
+            current_map = segment.map.line
+        lines.extend(segment.tags)
+        append(segment.extinf or '#EXTINF:%g,' % segment.duration)
+        if segment.byterange is not None:
+            append('#EXT-X-BYTERANGE:%d@%d' % segment.byterange)
+        append(segment_uri(segment) if segment_uri else segment.uri)
+    if endlist:
+        append('#EXT-X-ENDLIST')
+    append('')
+    return '\n'.join(lines)
+
+
+def load_playlist(path, url=None):
+    """parse a local playlist file."""
+    with open(path, 'r') as f:
+        return parse_playlist(f.read(), url or '')
+
+
+class ByteRangeRequest:
+    """one Range request covering adjacent EXT-X-BYTERANGE segments."""
+
+    __slots__ = ('url', 'offset', 'length', 'segments')
+
+    def __init__(self, url, offset, length, segments):
+        self.url = url
+        self.offset = offset
+        self.length = length
+        self.segments = segments
+
+    @property
+    def end(self):
+        return self.offset + self.length
+
+    @property
+    def key(self):
+        """journal key of the request."""
+        return '%s#bytes=%d-%d' % (self.url, self.offset, self.end - 1)
+
+    @property
+    def seq(self):
+        # None for an init section range.
+        return self.segments[0].seq if self.segments else None
+
+
+def coalesce_byte_ranges(segments, max_size):
+    """merge adjacent byte ranges of the same url into larger requests.
+
+    Args:
+        segments: segments with a byterange.
+        max_size: a merged request never grows beyond this many bytes, a
+                  single larger segment is still requested on its own.
+
+    Return:
+        list of ByteRangeRequest.
+
+    """
+    by_url = {}
+    for segment in segments:
+        by_url.setdefault(segment.url, []).append(segment)
+    requests = []
+    for url, url_segments in by_url.items():
+        url_segments.sort(key=lambda x: x.byterange[1])
+        current = None
+        for segment in url_segments:
+            length, offset = segment.byterange
+            if (
+                current is not None
+                and offset == current.end
+                and current.length + length <= max_size
+            ):
+                current.length += length
+                current.segments.append(segment)
+                continue
+            current = ByteRangeRequest(url, offset, length, [segment])
+            requests.append(current)
+    return requests
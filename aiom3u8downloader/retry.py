@@ -0,0 +1,179 @@
+# coding=utf-8
+"""retry policy of http requests.
+
+RetryPolicy decides whether and when a failed request is retried:
+
+- failures are classified into retry, retry-after and fail-fast, a 404 is
+  not retried at all while a 503 with Retry-After waits as long as asked.
+- delays use exponential backoff with full jitter, so fragments failing at
+  the same time don't retry in lockstep.
+- retry budgets per job and per host cap prompt retries at a ratio of
+  requests. Beyond the budget a failed request is requeued after a long
+  delay instead, so a broken origin isn't hammered with retries, while a
+  short outage doesn't fail every fragment it hit.
+
+Subclass RetryPolicy and pass it as AioM3u8Downloader(retry_policy=...) to
+change any of this.
+
+"""
+
+import asyncio
+import random
+
+import aiohttp
+
+from aiom3u8downloader.scheduler import (
+    THROTTLE_STATUSES,
+    SlowTransferError,
+    parse_retry_after,
+)
+
+RETRY = 'retry'
+RETRY_AFTER = 'retry_after'
+FAIL_FAST = 'fail_fast'
+
+# client errors that may succeed when asked again.
+RETRYABLE_CLIENT_STATUSES = (408, 425) + THROTTLE_STATUSES
+
+
+def response_status(exc):
+    """return http status of a failed request, None for transport errors."""
+    return getattr(exc, 'status', None)
+
+
+def response_retry_after(exc):
+    headers = getattr(exc, 'headers', None) or {}
+    return parse_retry_after(headers.get('Retry-After'))
+
+
+def failure_cause(exc):
+    """return a short label of why a request failed, e.g. http_503."""
+    status = response_status(exc)
+    if status is not None:
+        return 'http_%d' % status
+    if isinstance(exc, SlowTransferError):
+        return 'slow_transfer'
+    if isinstance(exc, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(exc, aiohttp.ClientPayloadError):
+        return 'payload'
+    if isinstance(exc, (aiohttp.ClientConnectionError, OSError)):
+        return 'connection'
+    return type(exc).__name__
+
+
+class RetryBudget:
+    """token bucket allowing retries for a ratio of requests.
+
+    Every request deposits ratio tokens, every retry withdraws one. The
+    bucket starts with minimum tokens so small jobs can retry at all.
+
+    """
+
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.tokens = float(minimum)
+        self.maximum = float(minimum)
+
+    def on_request(self):
+        self.maximum += self.ratio
+        self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def can_retry(self):
+        return self.tokens >= 1
+
+    def spend(self):
+        self.tokens -= 1
+
+
+class RetryPolicy:
+    """
+    Args:
+        max_attempts: attempts of one request, including the first one.
+        base: backoff of the first retry in seconds.
+        cap: maximum backoff in seconds.
+        budget_ratio: retries allowed per request, per job and per host.
+        budget_minimum: retries always allowed per job and per host.
+
+    """
+
+    def __init__(
+        self, max_attempts=4, base=1.0, cap=30.0, budget_ratio=0.2, budget_minimum=10
+    ):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.budget_ratio = budget_ratio
+        self.budget_minimum = budget_minimum
+        self.budgets = {}
+        self.retries = 0
+        self.exhausted = 0
+
+    def budget(self, key):
+        if key not in self.budgets:
+            self.budgets[key] = RetryBudget(self.budget_ratio, self.budget_minimum)
+        return self.budgets[key]
+
+    def forget(self, key):
+        """drop the budget of key, e.g. of a finished job."""
+        self.budgets.pop(key, None)
+
+    def on_request(self, budget_keys):
+        for key in budget_keys:
+            self.budget(key).on_request()
+
+    def classify(self, exc):
+        """return (decision, retry_after seconds or None) for a failure."""
+        status = response_status(exc)
+        if status is not None:
+            if status in THROTTLE_STATUSES:
+                retry_after = response_retry_after(exc)
+                if retry_after is not None:
+                    return RETRY_AFTER, retry_after
+                return RETRY, None
+            if 400 <= status < 500 and status not in RETRYABLE_CLIENT_STATUSES:
+                return FAIL_FAST, None
+            return RETRY, None
+        if isinstance(
+            exc,
+            (aiohttp.ClientError, asyncio.TimeoutError, SlowTransferError, OSError),
+        ):
+            return RETRY, None
+        # anything else is a bug or a malformed resource, retrying won't help.
+        return FAIL_FAST, None
+
+    def backoff(self, attempt):
+        """exponential backoff with full jitter."""
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+    def requeue_delay(self):
+        """delay of a retry over budget, behind the retries within it."""
+        return random.uniform(self.cap / 2, self.cap)
+
+    def next_delay(self, exc, attempt, budget_keys=()):
+        """return seconds to wait before retrying, None to give up.
+
+        Args:
+            exc: the exception the attempt failed with.
+            attempt: 0 based number of the failed attempt.
+            budget_keys: retry budgets the retry is charged to.
+
+        """
+        decision, retry_after = self.classify(exc)
+        if decision == FAIL_FAST:
+            return None
+        if attempt + 1 >= self.max_attempts:
+            return None
+        budgets = [self.budget(key) for key in budget_keys]
+        self.retries += 1
+        if all(x.can_retry() for x in budgets):
+            for budget in budgets:
+                budget.spend()
+            delay = self.backoff(attempt)
+        else:
+            # over budget, requeue the request instead of dropping it.
+            self.exhausted += 1
+            delay = self.requeue_delay()
+        if decision == RETRY_AFTER:
+            delay = max(delay, retry_after)
+        return delay
@@ -0,0 +1,315 @@
+# coding=utf-8
+"""fragment request scheduling shared by all jobs in a batch."""
+
+import asyncio
+import math
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# statuses telling us the origin is overloaded or throttling.
+THROTTLE_STATUSES = (429, 503)
+
+
+def parse_retry_after(value):
+    """return Retry-After header value in seconds, or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def get_host(url):
+    return urlparse(url).netloc
+
+
+class HostController:
+    """AIMD controller of in-flight requests against one host.
+
+    The limit grows by one after every window of limit completed requests as
+    long as the window throughput keeps improving and the time to first byte
+    stays close to the best one seen. It shrinks by 10% when throughput drops
+    or requests start queueing at the origin, and is halved on a throttle
+    status or connection error, at most once per window so a burst of
+    concurrent failures doesn't collapse it to 1. Retry-After blocks the host
+    until the given time.
+
+    """
+
+    def __init__(self, host, initial=8, maximum=100, minimum=1):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.inflight = 0
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.best_rate = 0.0
+        self.min_latency = None
+        self.latency = None
+        self._window_start = time.monotonic()
+        self._window_done = 0
+        self._window_bytes = 0
+        self._last_decrease = 0.0
+
+    @property
+    def allowed(self):
+        return max(self.minimum, int(self.limit))
+
+    def blocked_for(self):
+        return self.blocked_until - time.monotonic()
+
+    def on_success(self, nbytes, latency=None):
+        if latency is not None:
+            if self.min_latency is None:
+                self.min_latency = self.latency = latency
+            self.min_latency = min(self.min_latency, latency)
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        self.requests += 1
+        self._window_done += 1
+        self._window_bytes += nbytes
+        if self._window_done < self.allowed:
+            return
+        now = time.monotonic()
+        rate = self._window_bytes / max(now - self._window_start, 1e-6)
+        queueing = (
+            self.min_latency is not None
+            and self.latency > 3 * self.min_latency + 0.05
+        )
+        if rate >= self.best_rate * 0.95 and not queueing:
+            # more concurrency still helps, probe further.
+            self.best_rate = max(self.best_rate, rate)
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            # the origin or the link is saturated.
+            self.limit = max(self.minimum, self.limit * 0.9)
+            self.best_rate = rate
+        self._reset_window(now)
+
+    def on_error(self, status=None, retry_after=None):
+        self.requests += 1
+        self.errors += 1
+        now = time.monotonic()
+        if status in THROTTLE_STATUSES:
+            self.throttled += 1
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        if status is not None and status not in THROTTLE_STATUSES:
+            # e.g. 404, it says nothing about load.
+            return
+        if self._last_decrease >= self._window_start and now - self._last_decrease < 1:
+            # already decreased for this window.
+            return
+        self.limit = max(self.minimum, self.limit / 2)
+        self._last_decrease = now
+        self._reset_window(now)
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_done = 0
+        self._window_bytes = 0
+
+
+class SlowTransferError(Exception):
+    """transfer rate stayed below the minimum for a whole window."""
+
+
+class RateWatchdog:
+    """sliding window minimum transfer rate check of one response body.
+
+    Args:
+        min_rate: minimum bytes per second, 0 disables the check.
+        window: length of the sliding window in seconds.
+
+    """
+
+    def __init__(self, min_rate, window):
+        self.min_rate = min_rate
+        self.window = window
+        self.received = 0
+        self.started = time.monotonic()
+        self.samples = deque([(self.started, 0)])
+
+    def update(self, nbytes):
+        """account nbytes more, raise SlowTransferError if too slow."""
+        if not self.min_rate:
+            return
+        now = time.monotonic()
+        self.received += nbytes
+        self.samples.append((now, self.received))
+        # keep one sample at or before the window start.
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+        if now - self.started < self.window:
+            return
+        t0, received0 = self.samples[0]
+        rate = (self.received - received0) / max(now - t0, 1e-6)
+        if rate < self.min_rate:
+            raise SlowTransferError(
+                '%.0f B/s over the last %.0fs, minimum is %s B/s'
+                % (rate, now - t0, self.min_rate)
+            )
+
+
+class LatencyTracker:
+    """percentiles of fragment download times of one job.
+
+    Percentiles are recomputed every recompute_every samples, so asking for
+    them once per fragment stays cheap on large playlists.
+
+    """
+
+    def __init__(self, recompute_every=20):
+        self.samples = []
+        self.recompute_every = recompute_every
+        self._sorted = []
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        if len(self.samples) % self.recompute_every == 0:
+            self._sorted = sorted(self.samples)
+
+    def percentile(self, p):
+        """return the p (0-100) percentile, None without enough samples."""
+        if not self._sorted:
+            return None
+        idx = min(len(self._sorted) - 1, int(len(self._sorted) * p / 100.0))
+        return self._sorted[idx]
+
+
+class FairShareLimiter:
+    """global in-flight fragment budget split fairly between active jobs.
+
+    every job may have at most ceil(limit / active_jobs) fragment requests in
+    flight, and all jobs together at most limit. the share is recomputed when
+    a job registers or unregisters, so the last running job of a batch gets
+    the whole budget back.
+
+    With adaptive=True every host additionally gets a HostController, which
+    finds the concurrency the host is happy with, with limit as the ceiling.
+
+    """
+
+    def __init__(self, limit, adaptive=False, initial_host_limit=8):
+        self.limit = max(1, int(limit))
+        self.adaptive = adaptive
+        self.initial_host_limit = initial_host_limit
+        self.inflight = 0
+        self.job_inflight = {}
+        self.hosts = {}
+        self._cond = None
+
+    @property
+    def cond(self):
+        # created lazily so the limiter can be built outside a running loop.
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def reset(self):
+        """forget requests in flight, and bind to the running loop.
+
+        A condition is bound to the loop it is first used in, a downloader
+        used by a second asyncio.run() needs a new one.
+        """
+        self._cond = asyncio.Condition()
+        self.inflight = 0
+        self.job_inflight = {}
+        for controller in self.hosts.values():
+            controller.inflight = 0
+
+    def share(self):
+        return max(1, math.ceil(self.limit / max(1, len(self.job_inflight))))
+
+    def host_controller(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostController(
+                host, initial=self.initial_host_limit, maximum=self.limit
+            )
+        return self.hosts[host]
+
+    async def register(self, job):
+        async with self.cond:
+            self.job_inflight.setdefault(job, 0)
+            self.cond.notify_all()
+
+    async def unregister(self, job):
+        async with self.cond:
+            self.job_inflight.pop(job, None)
+            self.cond.notify_all()
+
+    def _can_acquire(self, job, host):
+        if self.inflight >= self.limit:
+            return False
+        if self.job_inflight.get(job, 0) >= self.share():
+            return False
+        if self.adaptive and host is not None:
+            controller = self.host_controller(host)
+            if controller.inflight >= controller.allowed:
+                return False
+        return True
+
+    def _blocked_for(self, host):
+        if not self.adaptive or host is None:
+            return 0
+        return self.host_controller(host).blocked_for()
+
+    async def acquire(self, job, host=None):
+        async with self.cond:
+            self.job_inflight.setdefault(job, 0)
+            while True:
+                delay = self._blocked_for(host)
+                if delay <= 0 and self._can_acquire(job, host):
+                    break
+                try:
+                    await asyncio.wait_for(
+                        self.cond.wait(), delay if delay > 0 else None
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self.inflight += 1
+            self.job_inflight[job] += 1
+            if self.adaptive and host is not None:
+                self.host_controller(host).inflight += 1
+
+    async def release(self, job, host=None):
+        async with self.cond:
+            self.inflight -= 1
+            if job in self.job_inflight:
+                self.job_inflight[job] -= 1
+            if self.adaptive and host is not None:
+                self.host_controller(host).inflight -= 1
+            self.cond.notify_all()
+
+    def report_success(self, host, nbytes, latency=None):
+        if self.adaptive:
+            self.host_controller(host).on_success(nbytes, latency)
+
+    def report_error(self, host, status=None, retry_after=None):
+        if self.adaptive:
+            self.host_controller(host).on_error(status, retry_after)
+
+    def slot(self, job, host=None):
+        return _Slot(self, job, host)
+
+
+class _Slot:
+    def __init__(self, limiter, job, host):
+        self.limiter = limiter
+        self.job = job
+        self.host = host
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.job, self.host)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter.release(self.job, self.host)
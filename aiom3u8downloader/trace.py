@@ -0,0 +1,288 @@
+# coding=utf-8
+"""phase and request spans in Chrome trace-event format.
+
+A trace file opens in chrome://tracing or https://ui.perfetto.dev. Every job
+is shown as a process: its first row holds the phases (playlist fetch, keys,
+fragments, ad cutting, mux, cleanup), the following rows are request lanes,
+each holding one fragment request at a time with its connect, response
+header and transfer spans. Time spent waiting for a connection slot and
+writing to disk are arguments of the request and transfer spans, and a
+counter track shows queued and in-flight requests.
+
+Events are appended to the file in the JSON array format every
+FLUSH_EVENTS events and on save(), which also terminates the array, so a
+long-lived downloader doesn't keep them in memory. Lanes of a job are
+forgotten when it finishes.
+
+Tracing is off unless a file is given, then NULL_TRACER is used, whose
+methods do nothing.
+
+"""
+
+import contextvars
+import heapq
+import json
+import time
+
+import aiohttp
+
+from aiom3u8downloader.metrics import url_label
+
+PHASE_TID = 0
+FLUSH_EVENTS = 10000
+ARRAY_END = '\n]\n'
+
+# (pid, tid) of the request lane of the running task.
+current_lane = contextvars.ContextVar('current_lane', default=None)
+
+
+def microseconds(seconds):
+    return round(seconds * 1e6, 1)
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_CONTEXT = _NullContext()
+
+
+class NullTracer:
+    """tracer used when tracing is off."""
+
+    enabled = False
+
+    def span(self, job, name, **args):
+        return NULL_CONTEXT
+
+    def request(self, job, url, queued):
+        return NULL_CONTEXT
+
+    def lane_span(self, name, start, end, **args):
+        pass
+
+    def job_finished(self, job):
+        pass
+
+    def trace_configs(self):
+        return None
+
+    def save(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    """
+    Args:
+        path: trace json file, events are appended to it.
+
+    """
+
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self.origin = time.monotonic()
+        # events not written yet.
+        self.events = []
+        self.written = 0
+        # file offset of ARRAY_END, where the next events go.
+        self.end_offset = None
+        self.pids = {}
+        self.last_pid = 0
+        # pid -> heap of free lane tids, next new tid, requests in flight.
+        self.free_lanes = {}
+        self.next_lane = {}
+        self.inflight = {}
+
+    def job_pid(self, job):
+        pid = self.pids.get(job)
+        if pid is None:
+            self.last_pid += 1
+            pid = self.pids[job] = self.last_pid
+            self.metadata('process_name', pid, None, url_label(job.url))
+            self.metadata('thread_name', pid, PHASE_TID, 'phases')
+            self.free_lanes[pid] = []
+            self.next_lane[pid] = PHASE_TID + 1
+            self.inflight[pid] = 0
+        return pid
+
+    def job_finished(self, job):
+        """forget the lanes of job, its events stay in the trace."""
+        pid = self.pids.pop(job, None)
+        if pid is not None:
+            del self.free_lanes[pid], self.next_lane[pid], self.inflight[pid]
+
+    def add(self, event):
+        self.events.append(event)
+        if len(self.events) >= FLUSH_EVENTS:
+            self.save()
+
+    def metadata(self, kind, pid, tid, name):
+        event = {'name': kind, 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+        if tid is not None:
+            event['tid'] = tid
+        self.add(event)
+
+    def complete(self, name, pid, tid, start, end, args=None):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'pid': pid,
+            'tid': tid,
+            'ts': microseconds(start - self.origin),
+            'dur': microseconds(max(0.0, end - start)),
+        }
+        if args:
+            event['args'] = args
+        self.add(event)
+
+    def counter(self, pid, name, **values):
+        self.add(
+            {
+                'name': name,
+                'ph': 'C',
+                'pid': pid,
+                'ts': microseconds(time.monotonic() - self.origin),
+                'args': values,
+            }
+        )
+
+    def span(self, job, name, **args):
+        """context manager recording a phase of job."""
+        return _Span(self, self.job_pid(job), PHASE_TID, name, args)
+
+    def request(self, job, url, queued):
+        """context manager recording a request on a free lane of job.
+
+        Args:
+            queued: monotonic time the request started waiting for a slot.
+
+        """
+        return _Request(self, self.job_pid(job), url, queued)
+
+    def lane_span(self, name, start, end, **args):
+        """record a span on the request lane of the running task."""
+        lane = current_lane.get()
+        if lane is not None:
+            self.complete(name, lane[0], lane[1], start, end, args)
+
+    def acquire_lane(self, pid):
+        free = self.free_lanes[pid]
+        if free:
+            tid = heapq.heappop(free)
+        else:
+            tid = self.next_lane[pid]
+            self.next_lane[pid] += 1
+            self.metadata('thread_name', pid, tid, 'requests %d' % tid)
+        self.inflight[pid] += 1
+        self.counter(pid, 'requests', inflight=self.inflight[pid])
+        return tid
+
+    def release_lane(self, pid, tid):
+        heapq.heappush(self.free_lanes[pid], tid)
+        self.inflight[pid] -= 1
+        self.counter(pid, 'requests', inflight=self.inflight[pid])
+
+    def trace_configs(self):
+        """aiohttp trace configs adding dns and connect spans to lanes."""
+        config = aiohttp.TraceConfig()
+        tracer = self
+
+        def phase(name):
+            async def on_start(session, context, params):
+                context.started = getattr(context, 'started', {})
+                context.started[name] = time.monotonic()
+
+            async def on_end(session, context, params):
+                started = getattr(context, 'started', {}).pop(name, None)
+                if started is not None:
+                    tracer.lane_span(name, started, time.monotonic())
+
+            return on_start, on_end
+
+        on_start, on_end = phase('dns')
+        config.on_dns_resolvehost_start.append(on_start)
+        config.on_dns_resolvehost_end.append(on_end)
+        on_start, on_end = phase('connect')
+        config.on_connection_create_start.append(on_start)
+        config.on_connection_create_end.append(on_end)
+        return [config]
+
+    def save(self):
+        """append the pending events, the file is a complete json array."""
+        if self.end_offset is None:
+            f = open(self.path, 'w')
+            f.write('[')
+        else:
+            f = open(self.path, 'r+')
+            f.seek(self.end_offset)
+        with f:
+            for event in self.events:
+                f.write(',\n' if self.written else '\n')
+                f.write(json.dumps(event))
+                self.written += 1
+            self.events = []
+            self.end_offset = f.tell()
+            f.write(ARRAY_END)
+            f.truncate()
+
+
+class _Span:
+    def __init__(self, tracer, pid, tid, name, args):
+        self.tracer = tracer
+        self.pid = pid
+        self.tid = tid
+        self.name = name
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.complete(
+            self.name, self.pid, self.tid, self.started, time.monotonic(), self.args
+        )
+        return False
+
+
+class _Request:
+    def __init__(self, tracer, pid, url, queued):
+        self.tracer = tracer
+        self.pid = pid
+        self.url = url
+        self.queued = queued
+        self.started = None
+        self.tid = None
+        self.token = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.tid = self.tracer.acquire_lane(self.pid)
+        self.token = current_lane.set((self.pid, self.tid))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_lane.reset(self.token)
+        args = {
+            'url': url_label(self.url),
+            'queue_ms': round((self.started - self.queued) * 1000, 3),
+        }
+        if exc_type is not None:
+            args['error'] = exc_type.__name__
+        self.tracer.complete(
+            'GET', self.pid, self.tid, self.started, time.monotonic(), args
+        )
+        self.tracer.release_lane(self.pid, self.tid)
+        return False
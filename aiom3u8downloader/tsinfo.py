@@ -0,0 +1,388 @@
+# coding=utf-8
+"""read stream parameters of an MPEG-TS fragment without ffprobe.
+
+probe_ts() memory-maps the fragment and walks its 188 byte packets to the
+PAT, the PMT and the first PES packet of the first elementary stream, which
+is what `ffprobe -show_entries stream=... -read_intervals %+0.1` reports as
+streams[0]. Resolution comes from the H.264/HEVC SPS or the MPEG-2 sequence
+header, the sample rate from the ADTS, MPEG audio or AC-3 frame header. Only
+the head of the file is touched.
+
+"""
+
+import mmap
+import os
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# stop looking for the first PES packet and its parameters after this much.
+MAX_SCAN_SIZE = 1024 * 1024
+# PES payload collected to find a SPS or an audio frame header.
+MAX_PES_SIZE = 64 * 1024
+
+VIDEO_STREAM_TYPES = {
+    0x01: 'mpeg1video',
+    0x02: 'mpeg2video',
+    0x10: 'mpeg4',
+    0x1B: 'h264',
+    0x24: 'hevc',
+}
+AUDIO_STREAM_TYPES = {
+    0x03: 'mp3',
+    0x04: 'mp3',
+    0x0F: 'aac',
+    0x11: 'aac_latm',
+    0x81: 'ac3',
+    0x87: 'eac3',
+}
+
+ADTS_SAMPLE_RATES = (
+    96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025,
+    8000, 7350,
+)
+MPEG_AUDIO_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),  # MPEG-2.5
+}
+AC3_SAMPLE_RATES = (48000, 44100, 32000)
+
+
+def iter_packets(buf, limit):
+    """yield (pid, payload_unit_start, payload) of the packets in buf[:limit]."""
+    start = 0
+    end = min(len(buf), limit)
+    while start + TS_PACKET_SIZE < end:
+        if buf[start] == TS_SYNC_BYTE and buf[start + TS_PACKET_SIZE] == TS_SYNC_BYTE:
+            break
+        start += 1
+    for pos in range(start, end - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        if buf[pos] != TS_SYNC_BYTE:
+            return
+        pid = (buf[pos + 1] & 0x1F) << 8 | buf[pos + 2]
+        pusi = bool(buf[pos + 1] & 0x40)
+        afc = (buf[pos + 3] >> 4) & 0x3
+        payload = pos + 4
+        if afc & 0x2:
+            payload += 1 + buf[pos + 4]
+        if not afc & 0x1 or payload >= pos + TS_PACKET_SIZE:
+            continue
+        yield pid, pusi, buf[payload : pos + TS_PACKET_SIZE]
+
+
+def psi_section(payload):
+    """return the section starting in a payload_unit_start packet."""
+    pointer = payload[0]
+    section = payload[1 + pointer :]
+    if len(section) < 3:
+        return None
+    length = (section[1] & 0x0F) << 8 | section[2]
+    return section[: 3 + length]
+
+
+def parse_pat(section):
+    """return PID of the first program's PMT, None if not found."""
+    if section[0] != 0x00:
+        return None
+    for pos in range(8, len(section) - 4 - 3, 4):
+        program_number = section[pos] << 8 | section[pos + 1]
+        if program_number != 0:
+            return (section[pos + 2] & 0x1F) << 8 | section[pos + 3]
+    return None
+
+
+def parse_pmt(section):
+    """return [(stream_type, pid)] in PMT order."""
+    if section[0] != 0x02:
+        return []
+    program_info_length = (section[10] & 0x0F) << 8 | section[11]
+    pos = 12 + program_info_length
+    end = len(section) - 4
+    streams = []
+    while pos + 5 <= end:
+        stream_type = section[pos]
+        pid = (section[pos + 1] & 0x1F) << 8 | section[pos + 2]
+        es_info_length = (section[pos + 3] & 0x0F) << 8 | section[pos + 4]
+        streams.append((stream_type, pid))
+        pos += 5 + es_info_length
+    return streams
+
+
+def parse_pts(data):
+    return (
+        ((data[0] >> 1) & 0x07) << 30
+        | data[1] << 22
+        | (data[2] >> 1) << 15
+        | data[3] << 7
+        | data[4] >> 1
+    )
+
+
+def parse_pes_header(payload):
+    """return (pts or None, offset of the PES payload), None if not a PES."""
+    if len(payload) < 9 or payload[0:3] != b'\x00\x00\x01':
+        return None
+    header_length = payload[8]
+    pts = None
+    if payload[7] & 0x80 and len(payload) >= 14:
+        pts = parse_pts(payload[9:14])
+    return pts, 9 + header_length
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def u(self, n):
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]
+            value = value << 1 | (byte >> (7 - (self.pos & 7))) & 1
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+    def skip(self, n):
+        self.pos += n
+
+
+def unescape_rbsp(nal):
+    """remove emulation prevention bytes (00 00 03)."""
+    return bytes(nal).replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def iter_nal_units(data):
+    """yield NAL units of an Annex B byte stream."""
+    data = bytes(data)
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        nal = data[start:] if end == -1 else data[start:end]
+        yield nal.rstrip(b'\x00')
+        start = end
+
+
+def parse_h264_sps(nal):
+    """return (width, height) of an H.264 SPS NAL unit."""
+    r = BitReader(unescape_rbsp(nal[1:]))
+    profile_idc = r.u(8)
+    r.skip(16)
+    r.ue()
+    chroma_format_idc = 1
+    separate_colour_plane = 0
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = r.ue()
+        if chroma_format_idc == 3:
+            separate_colour_plane = r.u(1)
+        r.ue()
+        r.ue()
+        r.skip(1)
+        if r.u(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if r.u(1):
+                    last, next_ = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_:
+                            next_ = (last + r.se() + 256) % 256
+                        last = next_ or last
+    r.ue()
+    pic_order_cnt_type = r.ue()
+    if pic_order_cnt_type == 0:
+        r.ue()
+    elif pic_order_cnt_type == 1:
+        r.skip(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()
+    r.skip(1)
+    width_mbs = r.ue() + 1
+    height_map_units = r.ue() + 1
+    frame_mbs_only = r.u(1)
+    if not frame_mbs_only:
+        r.skip(1)
+    r.skip(1)
+    width = width_mbs * 16
+    height = (2 - frame_mbs_only) * height_map_units * 16
+    if r.u(1):
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        if chroma_format_idc == 0 or separate_colour_plane:
+            crop_x, crop_y = 1, 2 - frame_mbs_only
+        else:
+            crop_x = 1 if chroma_format_idc == 3 else 2
+            crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    return width, height
+
+
+def parse_hevc_sps(nal):
+    """return (width, height) of an HEVC SPS NAL unit."""
+    r = BitReader(unescape_rbsp(nal[2:]))
+    r.skip(4)
+    max_sub_layers_minus1 = r.u(3)
+    r.skip(1)
+    # profile_tier_level
+    r.skip(96)
+    sub_layer_flags = [(r.u(1), r.u(1)) for _ in range(max_sub_layers_minus1)]
+    if max_sub_layers_minus1:
+        r.skip(2 * (8 - max_sub_layers_minus1))
+    for profile_present, level_present in sub_layer_flags:
+        r.skip(88 * profile_present + 8 * level_present)
+    r.ue()
+    chroma_format_idc = r.ue()
+    if chroma_format_idc == 3:
+        r.skip(1)
+    width = r.ue()
+    height = r.ue()
+    if r.u(1):
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        sub_width = 2 if chroma_format_idc in (1, 2) else 1
+        sub_height = 2 if chroma_format_idc == 1 else 1
+        width -= sub_width * (left + right)
+        height -= sub_height * (top + bottom)
+    return width, height
+
+
+def video_size(codec, es):
+    """return (width, height) from the start of a video elementary stream."""
+    if codec in ('mpeg1video', 'mpeg2video'):
+        pos = bytes(es).find(b'\x00\x00\x01\xb3')
+        if pos == -1 or pos + 7 > len(es):
+            return None
+        b = es[pos + 4 : pos + 7]
+        return b[0] << 4 | b[1] >> 4, (b[1] & 0x0F) << 8 | b[2]
+    for nal in iter_nal_units(es):
+        if not nal:
+            continue
+        try:
+            if codec == 'h264' and nal[0] & 0x1F == 7:
+                return parse_h264_sps(nal)
+            if codec == 'hevc' and (nal[0] >> 1) & 0x3F == 33:
+                return parse_hevc_sps(nal)
+        except IndexError:
+            # truncated SPS.
+            return None
+    return None
+
+
+def audio_sample_rate(codec, es):
+    """return the sample rate from the start of an audio elementary stream."""
+    es = bytes(es)
+    if codec == 'aac':
+        for pos in range(len(es) - 3):
+            if es[pos] == 0xFF and es[pos + 1] & 0xF6 == 0xF0:
+                index = (es[pos + 2] >> 2) & 0x0F
+                if index < len(ADTS_SAMPLE_RATES):
+                    return ADTS_SAMPLE_RATES[index]
+    elif codec == 'mp3':
+        for pos in range(len(es) - 3):
+            if es[pos] == 0xFF and es[pos + 1] & 0xE0 == 0xE0:
+                version = (es[pos + 1] >> 3) & 0x3
+                index = (es[pos + 2] >> 2) & 0x3
+                if version in MPEG_AUDIO_SAMPLE_RATES and index < 3:
+                    return MPEG_AUDIO_SAMPLE_RATES[version][index]
+    elif codec in ('ac3', 'eac3'):
+        pos = es.find(b'\x0b\x77')
+        if pos != -1 and pos + 5 <= len(es):
+            fscod = es[pos + 4] >> 6
+            if fscod < 3:
+                return AC3_SAMPLE_RATES[fscod]
+    return None
+
+
+def scan_first_stream(buf, stream_info=True):
+    """return (stream_type, pts, elementary stream head) of the first stream."""
+    pmt_pid = None
+    first = None
+    pts = None
+    es = bytearray()
+    for pid, pusi, payload in iter_packets(buf, MAX_SCAN_SIZE):
+        if first is None:
+            if pid == 0 and pusi and pmt_pid is None:
+                section = psi_section(payload)
+                if section:
+                    pmt_pid = parse_pat(section)
+            elif pid == pmt_pid and pusi:
+                section = psi_section(payload)
+                streams = parse_pmt(section) if section else []
+                if streams:
+                    first = streams[0]
+            continue
+        if pid != first[1]:
+            continue
+        if pusi:
+            if pts is not None:
+                # the next PES packet, the first one is complete.
+                break
+            header = parse_pes_header(payload)
+            if header is None or header[0] is None:
+                continue
+            pts = header[0]
+            if not stream_info:
+                break
+            es += payload[header[1] :]
+        elif pts is not None:
+            es += payload
+        if len(es) >= MAX_PES_SIZE:
+            break
+    if pts is None:
+        return None
+    return first[0], pts, es
+
+
+def probe_ts(path, stream_info=True):
+    """return ffprobe-like info of the first stream of a TS fragment.
+
+    Args:
+        path: the fragment.
+        stream_info: False to only read start_pts.
+
+    Return:
+        dict with start_pts and, with stream_info, codec_type plus width and
+        height or sample_rate. None if the file can't be read this way, e.g.
+        not MPEG-TS or a codec this module doesn't know.
+
+    """
+    try:
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                found = scan_first_stream(memoryview(buf), stream_info)
+                if found is None:
+                    return None
+                stream_type, pts, es = found
+                es = bytes(es)
+    except (OSError, ValueError):
+        return None
+    info = {'start_pts': pts}
+    if not stream_info:
+        return info
+    if stream_type in VIDEO_STREAM_TYPES:
+        size = video_size(VIDEO_STREAM_TYPES[stream_type], es)
+        if size is None:
+            return None
+        info['codec_type'] = 'video'
+        info['width'], info['height'] = size
+    elif stream_type in AUDIO_STREAM_TYPES:
+        sample_rate = audio_sample_rate(AUDIO_STREAM_TYPES[stream_type], es)
+        if sample_rate is None:
+            return None
+        info['codec_type'] = 'audio'
+        info['sample_rate'] = str(sample_rate)
+    else:
+        return None
+    return info
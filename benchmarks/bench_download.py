@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""end-to-end download benchmark against a local HLS origin.
+
+Every scenario starts benchmarks/origin.py with its settings in one process
+and runs AioM3u8Downloader in another, so peak RSS is the downloader's own.
+Muxing is skipped, the synthetic fragments are not real media. Results are
+saved as json and can be compared with an earlier run:
+
+    python benchmarks/bench_download.py --output after.json --compare before.json
+    python benchmarks/bench_download.py --scenarios baseline,errors --limit_conn 50
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from origin import OriginConfig, serve  # noqa: E402
+
+from aiom3u8downloader.aiodownloadm3u8 import AioM3u8Downloader  # noqa: E402
+
+SCENARIOS = {
+    'baseline': {},
+    'latency': {'latency': 0.05},
+    'bandwidth': {'bandwidth': 2 * 1024 * 1024},
+    'errors': {'error_rate': 0.05},
+    'throttle': {'throttle_rate': 0.05, 'retry_after': 1},
+    'stalls': {'stall_rate': 0.01, 'stall_time': 3.0},
+    'encrypted': {'encrypted': True},
+    'image': {'image': True},
+    'ads': {'ad_every': 20},
+    'large': {'segments': 2000, 'segment_size': 64 * 1024},
+}
+
+# seconds a scenario may run, see --timeout.
+SCENARIO_TIMEOUT = 600
+
+# result fields compared by --compare, True if larger is better.
+COMPARED = {
+    'fragments_per_s': True,
+    'mb_per_s': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False,
+    'elapsed_s': False,
+}
+
+
+class BenchDownloader(AioM3u8Downloader):
+    """records fragment timings and bytes, doesn't mux."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fragment_times = []
+        self.fragment_bytes = 0
+        self.download_started = None
+        self.download_finished = None
+
+    async def aio_download_fragment(self, job, url, seq=None):
+        if self.download_started is None and seq is not None:
+            self.download_started = time.monotonic()
+        started = time.monotonic()
+        result = await super().aio_download_fragment(job, url, seq=seq)
+        if seq is not None:
+            _, local_file, success = result
+            if success:
+                self.fragment_times.append(time.monotonic() - started)
+                self.fragment_bytes += os.path.getsize(local_file)
+            self.download_finished = time.monotonic()
+        return result
+
+    async def aio_mux(self, job):
+        # an empty output file, outside the temp dir removed after muxing.
+        target_mp4 = self.get_target_path(job)
+        open(target_mp4, 'wb').close()
+        return target_mp4
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_downloader(url, options, results):
+    """downloader process: download url, put the measurements to results."""
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tempdir:
+        downloader = BenchDownloader(
+            [url],
+            os.path.join(tempdir, 'out.mp4'),
+            tempdir=tempdir,
+            logger=logging.getLogger('bench'),
+            **options
+        )
+        started = time.monotonic()
+        downloader.start()
+        elapsed = time.monotonic() - started
+    # ru_maxrss is KiB on Linux, bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / 1024.0 / 1024.0 if sys.platform == 'darwin' else rss / 1024.0
+    transfer = (downloader.download_finished or 0) - (downloader.download_started or 0)
+    transfer = max(transfer, 1e-6)
+    results.put(
+        {
+            'fragments': len(downloader.fragment_times),
+            'mb': downloader.fragment_bytes / 1024.0 / 1024.0,
+            'fragments_per_s': len(downloader.fragment_times) / transfer,
+            'mb_per_s': downloader.fragment_bytes / 1024.0 / 1024.0 / transfer,
+            'p50_ms': (percentile(downloader.fragment_times, 50) or 0) * 1000,
+            'p99_ms': (percentile(downloader.fragment_times, 99) or 0) * 1000,
+            'peak_rss_mb': rss_mb,
+            'elapsed_s': elapsed,
+            'retries': downloader.retry_policy.retries,
+        }
+    )
+
+
+def wait_result(process, results, timeout):
+    """return the result process puts to results.
+
+    Raises:
+        RuntimeError: if process exits without a result, or none arrives
+                      within timeout seconds.
+
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if process.exitcode is not None:
+            try:
+                # put right before exiting.
+                return results.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError(
+                    'downloader exited with code %s without a result'
+                    % process.exitcode
+                )
+        if time.monotonic() > deadline:
+            raise RuntimeError('no result after %ss' % timeout)
+
+
+def run_scenario(name, origin_options, downloader_options, timeout=SCENARIO_TIMEOUT):
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Queue()
+    origin = ctx.Process(
+        target=serve, args=(OriginConfig(**origin_options), 0, ready), daemon=True
+    )
+    origin.start()
+    downloader = None
+    try:
+        base_url = ready.get(timeout=30)
+        results = ctx.Queue()
+        downloader = ctx.Process(
+            target=run_downloader,
+            args=(base_url + '/master.m3u8', downloader_options, results),
+        )
+        downloader.start()
+        result = wait_result(downloader, results, timeout)
+        downloader.join(timeout=30)
+        if downloader.exitcode != 0:
+            raise RuntimeError('downloader exited with code %s' % downloader.exitcode)
+    finally:
+        if downloader is not None and downloader.is_alive():
+            downloader.terminate()
+            downloader.join()
+        origin.terminate()
+        origin.join()
+    result['scenario'] = name
+    return result
+
+
+def print_results(results, baseline=None):
+    header = '%-10s %9s %8s %8s %8s %9s %8s %7s' % (
+        'scenario',
+        'frag/s',
+        'MB/s',
+        'p50 ms',
+        'p99 ms',
+        'RSS MB',
+        'time s',
+        'retries',
+    )
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(
+            '%-10s %9.1f %8.1f %8.1f %8.1f %9.1f %8.2f %7d'
+            % (
+                result['scenario'],
+                result['fragments_per_s'],
+                result['mb_per_s'],
+                result['p50_ms'],
+                result['p99_ms'],
+                result['peak_rss_mb'],
+                result['elapsed_s'],
+                result['retries'],
+            )
+        )
+        old = (baseline or {}).get(result['scenario'])
+        if old:
+            deltas = []
+            for key, larger_is_better in COMPARED.items():
+                if not old.get(key):
+                    continue
+                change = (result[key] - old[key]) / old[key] * 100
+                better = change > 0 if larger_is_better else change < 0
+                deltas.append('%s %+.1f%%%s' % (key, change, '' if better else ' (worse)'))
+            print('           vs previous: ' + ', '.join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--scenarios',
+        default=','.join(SCENARIOS),
+        help='comma separated, from: %s' % ', '.join(SCENARIOS),
+    )
+    parser.add_argument('--segments', type=int, help='override segment count')
+    parser.add_argument('--segment_size', type=int, help='override segment bytes')
+    parser.add_argument('--limit_conn', type=int, default=100)
+    parser.add_argument('--adaptive_conn', action='store_true')
+    parser.add_argument('--hedge', action='store_true')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=SCENARIO_TIMEOUT,
+        help='seconds a scenario may run, default %s' % SCENARIO_TIMEOUT,
+    )
+    parser.add_argument('--output', help='save results as json')
+    parser.add_argument('--compare', help='json of an earlier run to compare with')
+    args = parser.parse_args()
+
+    downloader_options = {
+        'limit_conn': args.limit_conn,
+        'adaptive_conn': args.adaptive_conn,
+        'hedge': args.hedge,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {x['scenario']: x for x in json.load(f)['results']}
+
+    results = []
+    failed = []
+    for name in args.scenarios.split(','):
+        origin_options = dict(SCENARIOS[name])
+        for key in ('segments', 'segment_size'):
+            if getattr(args, key):
+                origin_options[key] = getattr(args, key)
+        try:
+            results.append(
+                run_scenario(name, origin_options, downloader_options, args.timeout)
+            )
+        except RuntimeError as e:
+            print('scenario %s failed: %s' % (name, e))
+            failed.append(name)
+
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(
+                {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'options': downloader_options,
+                    'results': results,
+                },
+                f,
+                indent=2,
+            )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""compare fMP4 output by direct concatenation against the ffmpeg mux.
+
+A synthetic fMP4 HLS rendition is generated with ffmpeg, then the output is
+built both ways from the same local files:
+
+    python benchmarks/bench_fmp4_concat.py --duration 600 --rounds 3
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aiom3u8downloader.aiodownloadm3u8 import ffmpeg_mux_command  # noqa: E402
+from aiom3u8downloader.concat import concat_parts  # noqa: E402
+from aiom3u8downloader.playlist import load_playlist  # noqa: E402
+
+
+def generate_fmp4_hls(workdir, duration, segment_time):
+    """write an fMP4 HLS rendition into workdir, return its playlist path."""
+    playlist_path = os.path.join(workdir, 'media.m3u8')
+    cmd = [
+        'ffmpeg',
+        '-nostdin',
+        '-loglevel',
+        'error',
+        '-f',
+        'lavfi',
+        '-i',
+        'testsrc=size=1280x720:rate=30',
+        '-f',
+        'lavfi',
+        '-i',
+        'sine=frequency=440:sample_rate=48000',
+        '-t',
+        str(duration),
+        '-c:v',
+        'libx264',
+        '-preset',
+        'ultrafast',
+        '-g',
+        str(30 * segment_time),
+        '-c:a',
+        'aac',
+        '-f',
+        'hls',
+        '-hls_time',
+        str(segment_time),
+        '-hls_playlist_type',
+        'vod',
+        '-hls_segment_type',
+        'fmp4',
+        playlist_path,
+    ]
+    subprocess.run(cmd, check=True)
+    return playlist_path
+
+
+def playlist_parts(playlist_path):
+    playlist = load_playlist(playlist_path)
+    base = os.path.dirname(playlist_path)
+    parts = [(os.path.join(base, playlist.segments[0].map.uri), 0, None)]
+    parts.extend((os.path.join(base, x.uri), 0, None) for x in playlist.segments)
+    return parts
+
+
+def bench_concat(playlist_path, target):
+    parts = playlist_parts(playlist_path)
+    started = time.monotonic()
+    concat_parts(target, parts)
+    return time.monotonic() - started
+
+
+def bench_ffmpeg(playlist_path, target):
+    if os.path.exists(target):
+        os.remove(target)
+    cmd = ffmpeg_mux_command(playlist_path, target)
+    started = time.monotonic()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=int, default=300, help='seconds of video')
+    parser.add_argument('--segment_time', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        playlist_path = generate_fmp4_hls(workdir, args.duration, args.segment_time)
+        for name, bench in (('concat', bench_concat), ('ffmpeg', bench_ffmpeg)):
+            target = os.path.join(workdir, name + '.mp4')
+            timings = sorted(bench(playlist_path, target) for _ in range(args.rounds))
+            print(
+                '%-7s best %.3fs  median %.3fs  output %.1fMiB'
+                % (
+                    name,
+                    timings[0],
+                    timings[len(timings) // 2],
+                    os.path.getsize(target) / 1024 / 1024.0,
+                )
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""microbenchmarks of the playlist, path-rewrite and ad-cut hot paths.
+
+Every case runs on generated fixtures, without network, at each size
+(segments for the path and playlist cases, discontinuity groups for
+add_verify_pts) and reports the best time per item. A run fails (exit
+status 1) when
+
+- the per-item time at the largest size exceeds MAX_SCALING times the one
+  at the smallest size, which catches accidentally quadratic code,
+- a per-item time is over its BUDGET_US ceiling,
+- with --baseline, a per-item time is more than --tolerance slower than in
+  the saved run.
+
+    python benchmarks/bench_micro.py --save before.json
+    python benchmarks/bench_micro.py --baseline before.json --tolerance 0.2
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aiom3u8downloader.aiodownloadm3u8 import (  # noqa: E402
+    AioM3u8Downloader,
+    DownloadJob,
+    get_local_file_for_url,
+    windows_safe_filename_without_path,
+)
+from aiom3u8downloader.cut_insert_ts import CutInsertTs  # noqa: E402
+
+SIZES = (1000, 10000, 100000)
+# a discontinuity every this many segments in generated playlists.
+GROUP_SIZE = 5
+# every this many groups of add_verify_pts is an ad with its own pts.
+AD_EVERY = 50
+MAX_SCALING = 3.0
+# generous per-item ceilings in microseconds, for a slow CI machine.
+BUDGET_US = {
+    'rewrite_http_link_in_m3u8_file': 150.0,
+    'get_local_file_for_url': 40.0,
+    'windows_safe_filename_without_path': 10.0,
+    '_group_lines': 100.0,
+    'add_verify_pts': 40.0,
+}
+
+M3U8_URL = 'https://cdn.example.com/vod/2024/show/index.m3u8?token=abc'
+
+
+def segment_url(n):
+    if n % 7 == 0:
+        return 'https://img.example.com/vod/2024/show/seg-%06d.png' % n
+    return '/vod/2024/show/1080p/seg-%06d.ts?st=%d&e=1700000000' % (n, n)
+
+
+def media_playlist_text(n):
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        '#EXT-X-TARGETDURATION:6',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+        '#EXT-X-KEY:METHOD=AES-128,URI="https://keys.example.com/k.key",'
+        'IV=0x00000000000000000000000000000001',
+    ]
+    for i in range(n):
+        if i and i % GROUP_SIZE == 0:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines += ['#EXTINF:6.006,', segment_url(i)]
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def write_playlist(tempdir, n):
+    path = os.path.join(tempdir, 'media-%d.m3u8' % n)
+    with open(path, 'w') as f:
+        f.write(media_playlist_text(n))
+    return path
+
+
+def group_line_info(n):
+    groups = []
+    pts = 0
+    for i in range(n):
+        if i % AD_EVERY == AD_EVERY - 1:
+            # ads carry their own, unrelated timestamps.
+            start = 900000 * (i % 3)
+            info = {'tag': '1920x1080', 'start_pts': start, 'end_pts': start + 810000}
+            groups.append({'id': i, 'duration': 10.0, 'info': info})
+            continue
+        info = {'tag': '1920x1080', 'start_pts': pts, 'end_pts': pts + 4860000}
+        groups.append({'id': i, 'duration': 60.0, 'info': info})
+        pts += 5400000
+    return groups
+
+
+class Cases:
+    """setup(n) returns the argument of run(arg), called before every round."""
+
+    def __init__(self, tempdir):
+        self.tempdir = tempdir
+        self.logger = logging.getLogger('bench_micro')
+        self.logger.disabled = True
+        self.downloader = AioM3u8Downloader(
+            [], os.path.join(tempdir, 'out.mp4'), tempdir=tempdir, logger=self.logger
+        )
+        self.cutter = CutInsertTs(self.logger)
+        self.playlists = {}
+
+    def playlist(self, n):
+        if n not in self.playlists:
+            self.playlists[n] = write_playlist(self.tempdir, n)
+        return self.playlists[n]
+
+    def setup_rewrite_http_link_in_m3u8_file(self, n):
+        path = self.playlist(n)
+        local_file = os.path.join(self.tempdir, 'rewritten-%d.m3u8' % n)
+        return DownloadJob(M3U8_URL, self.tempdir), path, local_file
+
+    def run_rewrite_http_link_in_m3u8_file(self, arg):
+        job, path, local_file = arg
+        # read the original, so every round rewrites http links.
+        with open(path) as f, open(local_file, 'w') as out:
+            out.write(f.read())
+        self.downloader.rewrite_http_link_in_m3u8_file(job, local_file, M3U8_URL)
+
+    def setup_get_local_file_for_url(self, n):
+        return ['https://cdn.example.com' + segment_url(i) for i in range(n)]
+
+    def run_get_local_file_for_url(self, urls):
+        tempdir = self.tempdir
+        for url in urls:
+            get_local_file_for_url(tempdir, url)
+
+    def setup_windows_safe_filename_without_path(self, n):
+        return ['/vod/show:%d/seg<%d>|"q"?*.ts' % (i, i) for i in range(n)]
+
+    def run_windows_safe_filename_without_path(self, names):
+        for name in names:
+            windows_safe_filename_without_path(name)
+
+    def setup__group_lines(self, n):
+        return self.playlist(n)
+
+    def run__group_lines(self, path):
+        self.cutter._group_lines(path)
+
+    def setup_add_verify_pts(self, n):
+        return group_line_info(n)
+
+    def run_add_verify_pts(self, groups):
+        if not self.cutter.add_verify_pts(groups):
+            raise RuntimeError('add_verify_pts fixture was not cut')
+
+
+def measure(cases, name, n, rounds):
+    """return best seconds per item of rounds runs."""
+    setup = getattr(cases, 'setup_' + name)
+    run = getattr(cases, 'run_' + name)
+    best = None
+    for _ in range(rounds):
+        arg = setup(n)
+        started = time.perf_counter()
+        run(arg)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / n
+
+
+def check(results, baseline, tolerance):
+    """return a list of threshold violations."""
+    failures = []
+    for name, per_size in results.items():
+        sizes = sorted(per_size, key=int)
+        small, large = per_size[sizes[0]], per_size[sizes[-1]]
+        if len(sizes) > 1 and large > small * MAX_SCALING:
+            failures.append(
+                '%s: %.2fus/item at %s vs %.2fus/item at %s, over %.1fx'
+                % (name, large * 1e6, sizes[-1], small * 1e6, sizes[0], MAX_SCALING)
+            )
+        for size, value in per_size.items():
+            if value * 1e6 > BUDGET_US[name]:
+                failures.append(
+                    '%s at %s: %.2fus/item over budget of %.2fus'
+                    % (name, size, value * 1e6, BUDGET_US[name])
+                )
+            old = (baseline or {}).get(name, {}).get(size)
+            if old and value > old * (1 + tolerance):
+                failures.append(
+                    '%s at %s: %.2fus/item, %+.1f%% vs baseline'
+                    % (name, size, value * 1e6, (value / old - 1) * 100)
+                )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes',
+        default=','.join(str(x) for x in SIZES),
+        help='comma separated item counts',
+    )
+    parser.add_argument(
+        '--cases', default=','.join(BUDGET_US), help='comma separated case names'
+    )
+    parser.add_argument('--rounds', type=int, default=5, help='best of ROUNDS runs')
+    parser.add_argument('--save', help='save results as json')
+    parser.add_argument('--baseline', help='json of an earlier run to compare with')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.3,
+        help='allowed slowdown against the baseline, default 0.3 (30%%)',
+    )
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        cases = Cases(tempdir)
+        print('%-36s %10s %12s %12s' % ('case', 'items', 'us/item', 'total ms'))
+        for name in args.cases.split(','):
+            results[name] = {}
+            for n in sizes:
+                per_item = measure(cases, name, n, args.rounds)
+                results[name][str(n)] = per_item
+                print(
+                    '%-36s %10d %12.3f %12.2f'
+                    % (name, n, per_item * 1e6, per_item * n * 1e3)
+                )
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(
+                {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results},
+                f,
+                indent=2,
+            )
+
+    failures = check(results, baseline, args.tolerance)
+    for failure in failures:
+        print('FAIL ' + failure)
+    if failures:
+        sys.exit(1)
+    print('all thresholds passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""local stand-in HLS origin serving synthetic playlists.
+
+Serves a master playlist at /master.m3u8 with one media playlist per
+variant. Segment bodies are random bytes (not real media, and "encrypted"
+segments are not real ciphertext), which is all the downloader needs to be
+measured. Latency, bandwidth, errors, 429s, stalls, image-disguised
+segments and inserted ad groups are configurable:
+
+    python benchmarks/origin.py --segments 500 --latency 0.05 --error_rate 0.02
+
+"""
+
+import argparse
+import asyncio
+import random
+import re
+
+from aiohttp import web
+
+IMG_HEADER = b'\x89PNG\r\n\x1a\n' + b'\x00' * 204
+WRITE_CHUNK_SIZE = 16 * 1024
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+class OriginConfig:
+    """
+    Args:
+        segments: media segments per variant.
+        segment_size: bytes per segment.
+        segment_duration: EXTINF duration.
+        variants: variants in the master playlist.
+        latency: seconds before every segment response starts.
+        bandwidth: bytes per second of every segment response, 0 unlimited.
+        error_rate: share of segment requests answered with 500.
+        throttle_rate: share of segment requests answered with 429.
+        retry_after: Retry-After seconds of 429 responses.
+        stall_rate: share of segment responses that stall halfway.
+        stall_time: seconds a stalled response hangs.
+        encrypted: add an AES-128 EXT-X-KEY.
+        image: serve segments as .png with a fake image header.
+        ad_every: insert an ad group every ad_every segments, 0 for none.
+        ad_segments: segments per ad group.
+        seed: random seed of bodies and failures.
+
+    """
+
+    def __init__(
+        self,
+        segments=200,
+        segment_size=256 * 1024,
+        segment_duration=4.0,
+        variants=1,
+        latency=0.0,
+        bandwidth=0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after=1,
+        stall_rate=0.0,
+        stall_time=5.0,
+        encrypted=False,
+        image=False,
+        ad_every=0,
+        ad_segments=3,
+        seed=1,
+    ):
+        self.segments = segments
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+        self.variants = variants
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.encrypted = encrypted
+        self.image = image
+        self.ad_every = ad_every
+        self.ad_segments = ad_segments
+        self.seed = seed
+
+
+class Origin:
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        size = max(16, config.segment_size)
+        self.blob = random.Random(config.seed).getrandbits(8 * size).to_bytes(size, 'big')
+        self.requests = 0
+        self.failures = 0
+
+    def master_playlist(self):
+        lines = ['#EXTM3U']
+        for i in range(self.config.variants):
+            lines.append(
+                '#EXT-X-STREAM-INF:BANDWIDTH=%d,RESOLUTION=%dx%d'
+                % (1000000 * (i + 1), 640 * (i + 1), 360 * (i + 1))
+            )
+            lines.append('v%d/media.m3u8' % i)
+        return '\n'.join(lines) + '\n'
+
+    def media_playlist(self):
+        config = self.config
+        ext = 'png' if config.image else 'ts'
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-TARGETDURATION:%d' % config.segment_duration,
+            '#EXT-X-MEDIA-SEQUENCE:0',
+            '#EXT-X-PLAYLIST-TYPE:VOD',
+        ]
+        if config.encrypted:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="/key.key"')
+        for n in range(config.segments):
+            if config.ad_every and n and n % config.ad_every == 0:
+                lines.append('#EXT-X-DISCONTINUITY')
+                for a in range(config.ad_segments):
+                    lines += ['#EXTINF:%.1f,' % config.segment_duration, '/ads/a%d.ts' % a]
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines += ['#EXTINF:%.1f,' % config.segment_duration, 's%d.%s' % (n, ext)]
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def segment_body(self, name):
+        body = name.encode().ljust(16, b'\x00') + self.blob[16:]
+        if self.config.image and name.endswith('.png'):
+            body = IMG_HEADER + body
+        return body
+
+    async def handle_master(self, request):
+        return web.Response(text=self.master_playlist())
+
+    async def handle_media(self, request):
+        return web.Response(text=self.media_playlist())
+
+    async def handle_key(self, request):
+        return web.Response(body=b'0123456789abcdef')
+
+    async def handle_segment(self, request):
+        config = self.config
+        self.requests += 1
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        roll = self.random.random()
+        if roll < config.error_rate:
+            self.failures += 1
+            raise web.HTTPInternalServerError()
+        roll -= config.error_rate
+        if roll < config.throttle_rate:
+            self.failures += 1
+            raise web.HTTPTooManyRequests(
+                headers={'Retry-After': str(config.retry_after)}
+            )
+        stall = self.random.random() < config.stall_rate
+
+        body = self.segment_body(request.match_info['name'])
+        start, end = 0, len(body)
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        mo = RANGE_PATTERN.match(request.headers.get('Range', ''))
+        if mo:
+            start = int(mo.group(1))
+            if mo.group(2):
+                end = min(end, int(mo.group(2)) + 1)
+            if start >= len(body):
+                raise web.HTTPRequestRangeNotSatisfiable()
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, len(body))
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        pos = start
+        stall_at = start + (end - start) // 2 if stall else None
+        while pos < end:
+            chunk = body[pos : min(end, pos + WRITE_CHUNK_SIZE)]
+            if stall_at is not None and pos >= stall_at:
+                stall_at = None
+                await asyncio.sleep(config.stall_time)
+            await response.write(chunk)
+            pos += len(chunk)
+            if config.bandwidth:
+                await asyncio.sleep(len(chunk) / config.bandwidth)
+        await response.write_eof()
+        return response
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/master.m3u8', self.handle_master)
+        app.router.add_get('/v{variant}/media.m3u8', self.handle_media)
+        app.router.add_get('/key.key', self.handle_key)
+        app.router.add_get('/v{variant}/{name}', self.handle_segment)
+        app.router.add_get('/ads/{name}', self.handle_segment)
+        return app
+
+
+async def start_origin(config, host='127.0.0.1', port=0):
+    """start serving config, return (runner, base url)."""
+    runner = web.AppRunner(Origin(config).make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, 'http://%s:%d' % (host, port)
+
+
+def serve(config, port, ready=None):
+    """run an origin until killed, put its base url to the ready queue."""
+
+    async def run():
+        runner, base_url = await start_origin(config, port=port)
+        if ready is not None:
+            ready.put(base_url)
+        else:
+            print('serving %s/master.m3u8' % base_url, flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    defaults = OriginConfig()
+    for name, value in vars(defaults).items():
+        kwargs = {'default': value}
+        if isinstance(value, bool):
+            kwargs['action'] = 'store_true'
+        else:
+            kwargs['type'] = type(value)
+        parser.add_argument('--' + name, **kwargs)
+    args = vars(parser.parse_args())
+    port = args.pop('port')
+    serve(OriginConfig(**args), port)
+
+
+if __name__ == '__main__':
+    main()
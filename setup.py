@@ -33,6 +33,9 @@ setup(
         'requests>=2.25.1',
         'aiohttp>=3.8.1'
     ],
+    extras_require={
+        'decrypt': ['cryptography'],
+    },
     include_package_data=True,
     entry_points={
         'console_scripts': [
@@ -0,0 +1,175 @@
+# coding=utf-8
+"""end-to-end downloads against the local benchmark origin.
+
+    python -m unittest discover tests
+
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from origin import OriginConfig, start_origin  # noqa: E402
+
+from aiom3u8downloader.aiodownloadm3u8 import AioM3u8Downloader  # noqa: E402
+
+LOGGER = logging.getLogger('test_download')
+LOGGER.disabled = True
+
+
+class DownloadTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.runner, base_url = await start_origin(
+            OriginConfig(segments=20, segment_size=4096)
+        )
+        self.url = base_url + '/master.m3u8'
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    def downloader(self, **kwargs):
+        # random fragment bodies can't be muxed, concatenate them instead.
+        return AioM3u8Downloader(
+            tempdir=self.tempdir.name, output_ts=True, logger=LOGGER, **kwargs
+        )
+
+    def output(self, name):
+        return os.path.join(self.tempdir.name, name)
+
+    async def test_same_url_twice(self):
+        async with self.downloader() as downloader:
+            for name in ('a.ts', 'b.ts'):
+                result = await downloader.download(self.url, self.output(name))
+                self.assertTrue(result, result.error)
+                self.assertEqual(result.failed_fragments, [])
+                self.assertEqual(os.path.getsize(result.output), 20 * 4096)
+
+    async def test_same_url_twice_concurrently(self):
+        async with self.downloader(max_jobs=2) as downloader:
+            results = await asyncio.gather(
+                downloader.download(self.url, self.output('a.ts')),
+                downloader.download(self.url, self.output('b.ts')),
+            )
+        for result in results:
+            self.assertTrue(result, result.error)
+            self.assertEqual(os.path.getsize(result.output), 20 * 4096)
+
+    async def test_finished_jobs_are_forgotten(self):
+        trace = self.output('trace.json')
+        async with self.downloader(trace=trace) as downloader:
+            for name in ('a.ts', 'b.ts'):
+                result = await downloader.download(self.url, self.output(name))
+                self.assertTrue(result, result.error)
+            self.assertEqual(downloader.url_subtempdir, {})
+            self.assertEqual(downloader.reserved_paths, set())
+            self.assertEqual(downloader.metrics.jobs, {})
+            self.assertEqual(downloader.metrics.finished_jobs['done'], 2)
+            self.assertNotIn(('job', self.url), downloader.retry_policy.budgets)
+            self.assertEqual(downloader.tracer.pids, {})
+        with open(trace) as f:
+            events = json.load(f)
+        self.assertEqual(len({x['pid'] for x in events}), 2)
+
+
+class ResumeTest(unittest.IsolatedAsyncioTestCase):
+    """a server answering range requests from the wrong offset."""
+
+    body = bytes(range(256)) * 64
+
+    async def asyncSetUp(self):
+        async def handle(request):
+            headers = {}
+            if request.headers.get('Range'):
+                # ignores the requested start.
+                headers['Content-Range'] = 'bytes 0-%d/%d' % (
+                    len(self.body) - 1,
+                    len(self.body),
+                )
+                return web.Response(status=206, body=self.body, headers=headers)
+            return web.Response(body=self.body)
+
+        app = web.Application()
+        app.router.add_get('/seg.ts', handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = 'http://127.0.0.1:%d/seg.ts' % port
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_resume_from_wrong_offset_restarts(self):
+        local_file = os.path.join(self.tempdir.name, 'seg.ts')
+        with open(local_file + '.part', 'wb') as f:
+            f.write(self.body[:1000])
+        downloader = AioM3u8Downloader(tempdir=self.tempdir.name, logger=LOGGER)
+        async with downloader:
+            job = downloader.new_job(self.url, local_file + '.mp4')
+            await downloader.limiter.register(job)
+            checksum = await downloader.aio_stream_url_to_file(
+                job, self.url, local_file
+            )
+        self.assertIsNotNone(checksum)
+        with open(local_file, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+
+
+class LoopTest(unittest.TestCase):
+    """the origin runs in a thread, the downloads in asyncio.run()."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.runner, base_url = self.loop.run_until_complete(
+                start_origin(OriginConfig(segments=20, segment_size=4096))
+            )
+            self.url = base_url + '/master.m3u8'
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait(10)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop.close()
+
+    def test_download_in_two_event_loops(self):
+        # a low limit_conn makes requests wait on the limiter.
+        downloader = AioM3u8Downloader(
+            tempdir=self.tempdir.name, output_ts=True, limit_conn=2, logger=LOGGER
+        )
+        for name in ('a.ts', 'b.ts'):
+            output = os.path.join(self.tempdir.name, name)
+            result = asyncio.run(downloader.download(self.url, output))
+            self.assertTrue(result, result.error)
+            self.assertEqual(result.failed_fragments, [])
+
+
+if __name__ == '__main__':
+    unittest.main()